@@ -0,0 +1,395 @@
+"""ASGI server mode
+
+An alternative to the Flask app in `pdcam.server`, where waiting for frames is
+done on an asyncio event loop instead of by a thread per request. Long-polling
+`/latest` requests are woken by frame events from `Video`, and `/video/`
+streams subscribe to the camera's FrameBroadcaster as the Flask app's do, so
+idle clients cost no threads, and each frame is encoded once per variant for
+all stream clients of both apps. Only JPEG encoding runs on other threads.
+
+Like the Flask app, it can serve several cameras of a
+`pdcam.cameras.CameraGroup`, each under `/cam/<id>/`.
+
+Run with any ASGI server, e.g. `pdcam server --asgi` (which uses uvicorn).
+"""
+import asyncio
+import collections
+import json
+from urllib.parse import parse_qs
+
+from pdcam.electrodes import stats_to_bytes, stats_to_dict
+from pdcam.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from pdcam.video import StreamClient, StreamVariant, Video, format_transform_event
+
+
+class CounterEvents(object):
+    """Bridges notifications of an increasing counter, such as the frame
+    number, from a background thread to an event loop
+    """
+    def __init__(self, loop, value, add_listener, remove_listener):
+        self.loop = loop
+        self.value = value
+        self.event = asyncio.Event()
+        self.remove_listener = remove_listener
+        add_listener(self.on_change)
+
+    def close(self):
+        self.remove_listener(self.on_change)
+
+    def on_change(self, value):
+        # Called on the background thread
+        try:
+            self.loop.call_soon_threadsafe(self._notify, value)
+        except RuntimeError:
+            # The loop has closed without the listener being removed
+            pass
+
+    def _notify(self, value):
+        self.value = value
+        event = self.event
+        self.event = asyncio.Event()
+        event.set()
+
+    def stopped(self):
+        """Whether the counter will no longer increase"""
+        return False
+
+    async def wait_for(self, min_value):
+        """Wait until the counter is at least `min_value`, or has stopped
+        """
+        while self.value < min_value and not self.stopped():
+            await self.event.wait()
+        return self.value
+
+
+class AsyncStreamClient(StreamClient):
+    """A StreamClient whose frames are awaited on an event loop
+
+    The broadcaster thread puts frames as for any StreamClient, and wakes
+    the loop.
+    """
+    def __init__(self, loop, name, variant, max_queue=2):
+        super().__init__(name, variant, max_queue)
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def _wake(self):
+        # Called on the broadcaster thread
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # The loop has closed
+            pass
+
+    def put(self, frame_num, jpeg):
+        super().put(frame_num, jpeg)
+        self._wake()
+
+    def close(self):
+        super().close()
+        self._wake()
+
+    async def get_async(self):
+        """Wait until a frame is available and return (frame_num, jpeg)
+
+        Returns None once the client is closed.
+        """
+        while True:
+            with self.cv:
+                if self.closed:
+                    return None
+                if len(self.queue) > 0:
+                    self.sent += 1
+                    return self.queue.popleft()
+                # Cleared while holding the lock, so a frame put after the
+                # check above sets the event again
+                self.event.clear()
+            await self.event.wait()
+
+
+class FrameEvents(CounterEvents):
+    """Events for each frame captured by `camera`, counted by frame number
+    """
+    def __init__(self, camera, loop):
+        self.camera = camera
+        super().__init__(loop, camera.frame_number, camera.add_frame_listener, camera.remove_frame_listener)
+
+    def stopped(self):
+        # The camera notifies frame listeners once more when it stops
+        return not self.camera.running
+
+
+class TransformEvents(CounterEvents):
+    """Events for each transform update published by `camera`, counted by version
+    """
+    def __init__(self, camera, loop):
+        super().__init__(
+            loop, camera.transform_version, camera.add_transform_listener, camera.remove_transform_listener)
+
+
+def _cors_headers():
+    return [
+        (b'access-control-allow-origin', b'*'),
+        (b'access-control-allow-headers', b'Content-Type, X-Min-Frame-Number'),
+        (b'access-control-expose-headers', b'X-Frame-Number'),
+    ]
+
+
+async def _respond(send, status, body, content_type, headers=None):
+    if headers is None:
+        headers = []
+    headers = headers + _cors_headers() + [
+        (b'content-type', content_type),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _min_frame(params, headers):
+    """Get the frame number requested by the X-Min-Frame-Number header or
+    the min_frame parameter, or 0. Raises ValueError if it isn't an integer."""
+    min_frame = headers.get(b'x-min-frame-number')
+    if min_frame is None:
+        min_frame = params.get('min_frame', [None])[0]
+    if min_frame is None:
+        return 0
+    try:
+        return int(min_frame)
+    except ValueError:
+        raise ValueError("min_frame must be an integer")
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class _CameraState(object):
+    """Event bridges for one camera, created on first use"""
+    def __init__(self, camera):
+        self.camera = camera
+        self.frames = None
+        self.transforms = None
+
+    def frame_events(self):
+        if self.frames is None:
+            self.frames = FrameEvents(self.camera, asyncio.get_running_loop())
+        return self.frames
+
+    def transform_events(self):
+        if self.transforms is None:
+            self.transforms = TransformEvents(self.camera, asyncio.get_running_loop())
+        return self.transforms
+
+    def close(self):
+        for events in (self.frames, self.transforms):
+            if events is not None:
+                events.close()
+
+
+def _camera_routes(camera, state, render_metrics):
+    """Route handlers serving one camera"""
+    events = state.frame_events
+    transform_events = state.transform_events
+
+    def variant(params, default_quality):
+        return StreamVariant.from_args(lambda key: params.get(key, [None])[0], default_quality)
+
+    async def latest(scope, params, headers, receive, send):
+        try:
+            latest_variant = variant(params, camera.JPEG_QUALITY)
+            min_frame = _min_frame(params, headers)
+        except ValueError as ex:
+            await _respond(send, 400, str(ex).encode(), b'text/plain')
+            return
+
+        await events().wait_for(min_frame)
+        loop = asyncio.get_running_loop()
+        jpeg, frame_num = await loop.run_in_executor(None, camera.latest_jpeg, min_frame, *latest_variant)
+        if jpeg is None:
+            await _respond(send, 503, b'Capture stopped', b'text/plain')
+            return
+        await _respond(send, 200, jpeg, b'image/jpeg', [(b'x-frame-number', str(frame_num).encode())])
+
+    async def video(scope, params, headers, receive, send):
+        try:
+            video_variant = variant(params, camera.MJPEG_QUALITY)
+        except ValueError as ex:
+            await _respond(send, 400, str(ex).encode(), b'text/plain')
+            return
+        client_addr = scope.get('client')
+        client = AsyncStreamClient(asyncio.get_running_loop(), client_addr[0] if client_addr else "", video_variant)
+        broadcaster = camera.subscribe(video_variant, client)
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': _cors_headers() + [(b'content-type', b'multipart/x-mixed-replace; boundary=frame')],
+            })
+            while True:
+                # A slow client drops its oldest queued frames, as for Flask clients
+                waiter = asyncio.ensure_future(client.get_async())
+                await asyncio.wait([waiter, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiter.cancel()
+                    return
+                item = waiter.result()
+                if item is None:
+                    # The camera has stopped
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    return
+                _, jpeg = item
+                # Send the shared encoded bytes as-is, rather than concatenating
+                # them into a new part body for each client
+                for body in (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n', jpeg, b'\r\n'):
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            disconnected.cancel()
+            camera.unsubscribe(broadcaster, client)
+
+    async def transform(scope, params, headers, receive, send):
+        await _respond(send, 200, json.dumps(camera.transform_data()).encode(), b'application/json')
+
+    async def transform_stream(scope, params, headers, receive, send):
+        """Server-sent events, with an event each time the transform changes"""
+        version = camera.resume_version(headers.get(b'last-event-id'))
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': _cors_headers() + [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+        })
+        events = transform_events()
+        while not disconnected.done():
+            waiter = asyncio.ensure_future(events.wait_for(version + 1))
+            await asyncio.wait([waiter, disconnected], timeout=15.0, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                break
+            if not waiter.done():
+                waiter.cancel()
+                body = b': keepalive\n\n'
+            else:
+                new_version, data = camera.wait_transform(version, 0)
+                if data is None:
+                    continue
+                version = new_version
+                body = format_transform_event(version, data)
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    async def electrodes(scope, params, headers, receive, send):
+        try:
+            min_frame = _min_frame(params, headers)
+        except ValueError as ex:
+            await _respond(send, 400, str(ex).encode(), b'text/plain')
+            return
+
+        await events().wait_for(min_frame)
+        loop = asyncio.get_running_loop()
+        ids, stats, frame_num = await loop.run_in_executor(None, camera.electrode_stats, min_frame)
+        frame_header = [(b'x-frame-number', str(frame_num).encode())]
+        if params.get('format', [None])[0] == 'binary':
+            body = stats_to_bytes(ids, stats) if stats is not None else b''
+            await _respond(send, 200, body, b'application/octet-stream', frame_header)
+            return
+        data = stats_to_dict(ids, stats) if stats is not None else None
+        body = json.dumps({'frame': frame_num, 'electrodes': data}).encode()
+        await _respond(send, 200, body, b'application/json', frame_header)
+
+    async def streams(scope, params, headers, receive, send):
+        await _respond(send, 200, json.dumps(camera.stream_stats()).encode(), b'application/json')
+
+    async def metrics(scope, params, headers, receive, send):
+        await _respond(send, 200, render_metrics().encode(), METRICS_CONTENT_TYPE.encode())
+
+    return {
+        '/latest': latest,
+        '/video': video,
+        '/video/': video,
+        '/transform': transform,
+        '/transform/events': transform_stream,
+        '/electrodes': electrodes,
+        '/streams': streams,
+        '/metrics': metrics,
+    }
+
+
+def create_asgi_app(cameras):
+    """Create an ASGI application serving frames and transforms from cameras
+
+    `cameras` is a `pdcam.video.Video`, or a `pdcam.cameras.CameraGroup` of
+    several. Each camera of a group is served under `/cam/<id>/`, and the
+    first camera is also served at the top level.
+    """
+    if isinstance(cameras, Video):
+        group = None
+        default = cameras
+    else:
+        group = cameras
+        default = group.default
+
+    # One set of event bridges per camera, shared by the default camera's
+    # top level and `/cam/<id>/` routes
+    states = collections.OrderedDict()
+
+    def state_for(camera):
+        return states.setdefault(id(camera), _CameraState(camera))
+
+    routes = _camera_routes(default, state_for(default), (group or default).render_metrics)
+    camera_routes = {}
+    if group is not None:
+        for camera_id, camera in group.cameras.items():
+            camera_routes[camera_id] = _camera_routes(camera, state_for(camera), camera.render_metrics)
+
+    async def camera_list(scope, params, headers, receive, send):
+        info = group.info() if group is not None else []
+        await _respond(send, 200, json.dumps(info).encode(), b'application/json')
+
+    routes['/cameras'] = camera_list
+
+    def find_handler(path):
+        handler = routes.get(path)
+        if handler is None and path.startswith('/cam/'):
+            camera_id, _, path = path[len('/cam/'):].partition('/')
+            handler = camera_routes.get(camera_id, {}).get('/' + path)
+        return handler
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                for state in states.values():
+                    state.frame_events()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for state in states.values():
+                    state.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] == 'OPTIONS':
+            await _respond(send, 204, b'', b'text/plain')
+            return
+
+        handler = find_handler(scope['path'])
+        if handler is None:
+            await _respond(send, 404, b'Not Found', b'text/plain')
+            return
+
+        params = parse_qs(scope.get('query_string', b'').decode())
+        headers = dict(scope.get('headers', []))
+        await handler(scope, params, headers, receive, send)
+
+    return app
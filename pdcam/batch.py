@@ -0,0 +1,183 @@
+"""Offline grid locating over recorded image directories and videos
+
+Frames are split into chunks of consecutive frames, and each chunk is read
+and located by a worker process, so that decoding as well as detection is
+spread over all cores and no pixel data is passed between processes.
+
+Results are written to a NumPy `.npz` file with one row per frame:
+
+* frame: Frame index
+* name: Image file name (directories only)
+* found: Whether the grid was located
+* transform: (N, 3, 3) grid to image transforms, NaN where not found
+* error: RMS reprojection error of the fiducial corners, in pixels, NaN
+    where not found
+* matched: Number of fiducials matched to the reference
+* read_seconds, locate_seconds: Time taken to read and locate each frame
+
+and one row per fiducial found:
+
+* fiducial_frame: Index of the frame the fiducial was found in
+* fiducial_label: Tag ID
+* fiducial_corners: (M, 4, 2) corner coordinates
+"""
+import cv2
+import glob
+import json
+import multiprocessing
+import numpy as np
+import os
+import time
+
+from pdcam.grid import NO_SOLUTION, GridLocator, GridReference
+from pdcam.sources import ReplaySource
+
+# Per-process locator, created by `_init_worker`
+_locator = None
+_END = object()
+
+
+def list_images(path):
+    """Image files in a directory, in sorted filename order"""
+    files = sorted(glob.glob(os.path.join(path, '*')))
+    return [f for f in files if os.path.splitext(f)[1].lower() in ReplaySource.IMAGE_EXTENSIONS]
+
+
+def video_frame_count(path):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Unable to open video %s" % path)
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return count
+
+
+def make_chunks(path, chunk_size):
+    """Split a directory or video into tasks of up to `chunk_size` frames
+
+    Each task is (path, first frame index, image files or frame count).
+    """
+    if os.path.isdir(path):
+        images = list_images(path)
+        return [(path, start, images[start:start + chunk_size]) for start in range(0, len(images), chunk_size)]
+    count = video_frame_count(path)
+    return [(path, start, min(chunk_size, count - start)) for start in range(0, count, chunk_size)]
+
+
+def _read_chunk(path, start, frames):
+    """Yield the images of a chunk"""
+    if isinstance(frames, list):
+        for filename in frames:
+            yield cv2.imread(filename)
+        return
+
+    capture = cv2.VideoCapture(path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    try:
+        for _ in range(frames):
+            flag, image = capture.read()
+            if not flag:
+                return
+            yield image
+    finally:
+        capture.release()
+
+
+def _init_worker(reference, track, decimate):
+    global _locator
+    _locator = GridLocator(GridReference.from_dict(reference), track=track, decimate=decimate)
+
+
+def locate_chunk(task):
+    """Locate the grid in every frame of a chunk
+
+    Returns a list of (frame index, transform, fiducials, read seconds,
+    locate seconds, GridSolution) tuples, with fiducials as (label, corners)
+    pairs.
+    """
+    path, start, frames = task
+    results = []
+    images = _read_chunk(path, start, frames)
+    index = start
+    while True:
+        t0 = time.perf_counter()
+        image = next(images, _END)
+        t1 = time.perf_counter()
+        if image is _END:
+            break
+        if image is None:
+            print("Unable to read frame %d" % index)
+            transform, fiducials, solution = None, [], NO_SOLUTION
+        else:
+            transform, fiducials = _locator.find_grid_transform(image)
+            solution = _locator.last_solution
+        t2 = time.perf_counter()
+        results.append((index, transform, [(f.label, f.corners) for f in fiducials], t1 - t0, t2 - t1, solution))
+        index += 1
+    return results
+
+
+def run_batch(reference, path, output, workers=None, chunk_size=32, track=False, decimate=1, progress=True):
+    """Locate the grid in every frame of a directory or video, and save the
+    results to `output` (see module docs for the format)
+
+    Arguments:
+    * reference: Reference data, as loaded from a reference json file
+    * path: Directory of images, or video file
+    * output: Path of the .npz file to write
+    * workers: Number of worker processes (default: one per CPU)
+    * chunk_size: Number of consecutive frames per task
+    * track, decimate: GridLocator options
+
+    Returns the number of frames processed.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    chunks = make_chunks(path, chunk_size)
+    is_dir = os.path.isdir(path)
+
+    rows = []
+    start = time.monotonic()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, _init_worker, (reference, track, decimate)) as pool:
+        for i, chunk_results in enumerate(pool.imap(locate_chunk, chunks)):
+            rows.extend(chunk_results)
+            if progress:
+                elapsed = time.monotonic() - start
+                print("%d/%d chunks, %d frames, %.1f fps" % (i + 1, len(chunks), len(rows), len(rows) / elapsed))
+
+    n = len(rows)
+    transforms = np.full((n, 3, 3), np.nan)
+    errors = np.full(n, np.nan, dtype=np.float32)
+    found = np.zeros(n, dtype=bool)
+    fiducial_frame = []
+    fiducial_label = []
+    fiducial_corners = []
+    for i, (index, transform, fiducials, _, _, solution) in enumerate(rows):
+        if transform is not None:
+            transforms[i] = transform
+            errors[i] = solution.error
+            found[i] = True
+        for label, corners in fiducials:
+            fiducial_frame.append(index)
+            fiducial_label.append(label)
+            fiducial_corners.append(corners)
+
+    data = {
+        'frame': np.array([r[0] for r in rows], dtype=np.int32),
+        'found': found,
+        'transform': transforms,
+        'error': errors,
+        'matched': np.array([r[5].matched for r in rows], dtype=np.int32),
+        'read_seconds': np.array([r[3] for r in rows], dtype=np.float32),
+        'locate_seconds': np.array([r[4] for r in rows], dtype=np.float32),
+        'fiducial_frame': np.array(fiducial_frame, dtype=np.int32),
+        'fiducial_label': np.array(fiducial_label, dtype=np.int32),
+        'fiducial_corners': np.array(fiducial_corners, dtype=np.float32).reshape((-1, 4, 2)),
+        'reference': np.array(json.dumps(reference)),
+    }
+    if is_dir:
+        names = [os.path.basename(f) for _, _, files in chunks for f in files]
+        data['name'] = np.array(names[:n])
+    np.savez_compressed(output, **data)
+    return n
@@ -0,0 +1,119 @@
+"""End-to-end benchmark of the capture, locate and encode pipeline
+
+Runs a `Video` (normally with a synthetic or replayed frame source) for a fixed
+duration with some number of simulated MJPEG clients, and measures capture
+frame rate, grid locate rate and latency, and the frame rate delivered to
+clients.
+"""
+import numpy as np
+import threading
+import time
+
+
+def run_benchmark(video, duration=10.0, clients=1, markup=False):
+    """Measure pipeline throughput and latency of a running Video
+
+    Returns a dict of results.
+    """
+    lock = threading.Lock()
+    frame_times = []
+    locate_latencies = []
+    locate_found = [0]
+
+    def on_frame(frame_num):
+        with lock:
+            frame_times.append(time.monotonic())
+
+    def on_locate(transform, fiducials):
+        if previous_callback is not None:
+            previous_callback(transform, fiducials)
+        _, timestamp = video.grid_finder.latest_frame
+        with lock:
+            if timestamp is not None:
+                locate_latencies.append(time.monotonic() - timestamp)
+            if transform is not None:
+                locate_found[0] += 1
+
+    client_frames = [0] * clients
+    stop = threading.Event()
+
+    def client_entry(i):
+        generator = video.mjpeg_frame_generator(markup, name="benchmark-%d" % i)
+        for chunk in generator:
+            if stop.is_set():
+                generator.close()
+                return
+            if chunk.startswith(b'--frame'):
+                client_frames[i] += 1
+
+    video.add_frame_listener(on_frame)
+    previous_callback = None
+    if video.grid_finder is not None:
+        previous_callback = video.grid_finder.callback
+        video.grid_finder.callback = on_locate
+
+    threads = [threading.Thread(target=client_entry, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+
+    time.sleep(duration)
+
+    stop.set()
+    video.remove_frame_listener(on_frame)
+    if video.grid_finder is not None:
+        video.grid_finder.callback = previous_callback
+
+    with lock:
+        results = {
+            'duration': duration,
+            'capture_fps': len(frame_times) / duration,
+            'locate_rate': len(locate_latencies) / duration,
+            'locate_success': locate_found[0] / max(1, len(locate_latencies)),
+            'client_fps': [n / duration for n in client_frames],
+        }
+        if len(locate_latencies) > 0:
+            results['locate_latency_p50'] = float(np.percentile(locate_latencies, 50))
+            results['locate_latency_p95'] = float(np.percentile(locate_latencies, 95))
+    return results
+
+
+def print_results(results):
+    print("Capture: %.1f fps" % results['capture_fps'])
+    print("Locate: %.1f/s, %.0f%% found" % (results['locate_rate'], results['locate_success'] * 100))
+    if 'locate_latency_p50' in results:
+        print("Locate latency: p50 %.1f ms, p95 %.1f ms" % (
+            results['locate_latency_p50'] * 1000, results['locate_latency_p95'] * 1000))
+    for i, fps in enumerate(results['client_fps']):
+        print("Client %d: %.1f fps" % (i, fps))
+
+
+def summarize_benchmarks(report):
+    """Reduce a pytest-benchmark JSON report to the statistics used for
+    comparison, keyed by benchmark name
+    """
+    return {
+        'machine_info': report.get('machine_info', {}),
+        'benchmarks': {
+            b['name']: {k: b['stats'][k] for k in ('min', 'median', 'mean', 'stddev')}
+            for b in report['benchmarks']
+        },
+    }
+
+
+def compare_benchmarks(baseline, current, tolerance=0.25, stat='median'):
+    """Compare benchmark summaries (see `summarize_benchmarks`)
+
+    Returns a list of (name, baseline time, current time, ratio) for each
+    benchmark in both summaries, slowest relative to baseline first, and the
+    subset of those which are more than `tolerance` slower than the baseline.
+    """
+    rows = []
+    for name, stats in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        old = baseline['benchmarks'][name][stat]
+        new = stats[stat]
+        rows.append((name, old, new, new / old))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    regressions = [row for row in rows if row[3] > 1.0 + tolerance]
+    return rows, regressions
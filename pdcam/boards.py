@@ -0,0 +1,210 @@
+"""Identifying which electrode board is in view from its tag IDs
+
+Each board's fiducials carry their own set of AprilTag IDs, so the board in an
+image can be identified from the labels of the tags found in it. A
+`BoardRegistry` indexes boards by their tag IDs, and a `BoardLocator` locates
+whichever registered board is in view, so boards can be swapped without
+restarting the server.
+
+Boards are registered from reference files, which are the usual reference
+json (as saved by `pdcam measure`), with these keys in addition:
+
+* labels: Tag ID of each fiducial (required)
+* layout: Name of the electrode layout, one of `pdcam.layouts.LAYOUTS`
+* name: Optional board name (default: the file name)
+"""
+import apriltag
+import glob
+import json
+import os
+from typing import List
+
+from pdcam.grid import NO_SOLUTION, Fiducial, GridLocator, GridReference, find_fiducials
+from pdcam.layouts import LAYOUTS
+
+
+class Board(object):
+    """A registered board
+
+    The GridReference is built from the reference data on first use.
+
+    Arguments:
+    * name: Board name
+    * labels: Tag ID of each fiducial, in reference order
+    * layout: Electrode layout
+    * data: Reference data, as loaded from a reference json file, or a
+        GridReference
+    """
+    def __init__(self, name, labels, layout, data):
+        self.name = name
+        self.labels = list(labels)
+        self.layout = layout
+        self._data = data
+        self._reference = data if isinstance(data, GridReference) else None
+
+    @property
+    def reference(self):
+        if self._reference is None:
+            self._reference = GridReference.from_dict(self._data)
+        return self._reference
+
+
+class BoardRegistry(object):
+    """Boards indexed by their tag IDs
+
+    Each tag ID may belong to only one board, so that any tag found in an
+    image identifies its board with a single dict lookup.
+    """
+    def __init__(self):
+        self.boards = {}
+        self.by_labels = {}
+        self.by_tag = {}
+
+    def __len__(self):
+        return len(self.boards)
+
+    def add(self, board):
+        if board.name in self.boards:
+            raise ValueError("Board %s is already registered" % board.name)
+        if len(board.labels) == 0:
+            raise ValueError("Board %s has no tag labels" % board.name)
+        for label in board.labels:
+            other = self.by_tag.get(label)
+            if other is not None:
+                raise ValueError("Tag %s of board %s is already used by board %s" % (label, board.name, other.name))
+        self.boards[board.name] = board
+        self.by_labels[frozenset(board.labels)] = board
+        for label in board.labels:
+            self.by_tag[label] = board
+        return board
+
+    def add_reference(self, name, reference: GridReference, layout):
+        """Register a board from a GridReference with labels"""
+        if reference.labels is None:
+            raise ValueError("Reference for board %s has no tag labels" % name)
+        return self.add(Board(name, reference.labels, layout, reference))
+
+    def add_file(self, path):
+        """Register a board from a reference file (see module docs)"""
+        with open(path) as f:
+            data = json.loads(f.read())
+        name = data.get('name', os.path.splitext(os.path.basename(path))[0])
+        if data.get('labels') is None:
+            raise ValueError("Reference %s has no tag labels" % path)
+        layout_name = data.get('layout')
+        if layout_name not in LAYOUTS:
+            raise ValueError("Reference %s has unknown layout %r; use one of %s" % (
+                path, layout_name, ", ".join(sorted(LAYOUTS))))
+        return self.add(Board(name, data['labels'], LAYOUTS[layout_name], data))
+
+    @staticmethod
+    def from_path(path):
+        """Load a registry from a reference file, or a directory of them
+
+        Files in a directory without tag labels are skipped.
+        """
+        registry = BoardRegistry()
+        if not os.path.isdir(path):
+            registry.add_file(path)
+            return registry
+        for filename in sorted(glob.glob(os.path.join(path, '*.json'))):
+            try:
+                registry.add_file(filename)
+            except (ValueError, KeyError) as ex:
+                print("Skipping board reference %s: %s" % (filename, ex))
+        return registry
+
+    def known(self, fiducials: List[Fiducial]):
+        """Filter out fiducials whose tag IDs don't belong to any board"""
+        return [f for f in fiducials if f.label in self.by_tag]
+
+    def identify(self, labels):
+        """Get the board with the given tag IDs
+
+        If they aren't exactly one board's tags, the board with the most of
+        the tags is returned, or None if there is a tie or no tag is known.
+        """
+        labels = frozenset(labels)
+        board = self.by_labels.get(labels)
+        if board is not None:
+            return board
+        votes = {}
+        for label in labels:
+            board = self.by_tag.get(label)
+            if board is not None:
+                votes[board.name] = votes.get(board.name, 0) + 1
+        if len(votes) == 0:
+            return None
+        ranked = sorted(votes.items(), key=lambda item: -item[1])
+        if len(ranked) > 1 and ranked[0][1] == ranked[1][1]:
+            return None
+        return self.boards[ranked[0][0]]
+
+
+class BoardLocator(object):
+    """Locates whichever board of a BoardRegistry is in view
+
+    Has the same interface as GridLocator. Detected tags whose IDs belong to
+    no registered board are discarded, then the board is identified from the
+    remaining tag IDs. A GridLocator for each board is created the first time
+    the board is seen, and kept for use while that board stays in view, so
+    tracking and the precomputed reference geometry carry over between
+    images. All of the GridLocators share one AprilTag detector.
+
+    A BoardLocator is not thread-safe; use one per thread.
+
+    Arguments:
+    * registry: BoardRegistry of the boards which may be in view
+    * track, refresh_frames, decimate: See GridLocator
+    """
+    def __init__(self, registry: BoardRegistry, track=False, refresh_frames=10, decimate=1):
+        self.registry = registry
+        self.track = track
+        self.refresh_frames = refresh_frames
+        self.decimate = decimate
+        self.detector = apriltag.Detector()
+        self.locators = {}
+        # Board currently in view, and its locator
+        self.board = None
+        self.locator = None
+        self.last_solution = NO_SOLUTION
+
+    @property
+    def reference(self):
+        """Reference of the board currently in view, or None"""
+        return self.board.reference if self.board is not None else None
+
+    def _locator(self, board):
+        locator = self.locators.get(board.name)
+        if locator is None:
+            locator = GridLocator(board.reference, track=self.track, refresh_frames=self.refresh_frames,
+                                  decimate=self.decimate)
+            locator.detector = self.detector
+            self.locators[board.name] = locator
+        return locator
+
+    def find_grid_transform(self, image):
+        """Locate the board in view
+
+        Returns (transform, fiducials), as `GridLocator.find_grid_transform`.
+        """
+        self.last_solution = NO_SOLUTION
+        if self.locator is not None:
+            transform, fiducials = self.locator.find_grid_transform(image)
+            self.last_solution = self.locator.last_solution
+            if transform is not None:
+                return transform, fiducials
+        else:
+            fiducials = find_fiducials(image, self.detector, self.decimate)
+        fiducials = self.registry.known(fiducials)
+
+        board = self.registry.identify(f.label for f in fiducials)
+        if board is None or board is self.board:
+            # Not a known board, or the current board's locator already failed
+            return None, fiducials
+        print("Identified board %s" % board.name)
+        self.board = board
+        self.locator = self._locator(board)
+        transform = self.locator.transform_from_fiducials(fiducials)
+        self.last_solution = self.locator.last_solution
+        return transform, fiducials
@@ -0,0 +1,177 @@
+"""Several cameras, each viewing its own board, served from one process
+
+A camera config file is a JSON list with an entry for each camera:
+
+    [
+        {"id": "left", "reference": "board_v4.json", "layout": "v4", "source": "picamera"},
+        {"id": "right", "reference": "misl_v5_ref.json", "layout": "v5", "source": "opencv:1", "flip": true}
+    ]
+
+`reference` paths are relative to the config file, `layout` is one of
+`pdcam.layouts.LAYOUTS`, and `source` is a `pdcam.sources.source_from_spec`
+description. Only `id` is required; by default a camera has no reference,
+the v3 layout, and the Raspberry Pi camera as its source. Instead of a fixed
+board, a camera can identify its board from a `boards` directory of labelled
+references (see `pdcam.boards`).
+"""
+import collections
+import json
+import os
+import re
+import threading
+
+from pdcam import metrics
+from pdcam.boards import BoardRegistry
+from pdcam.grid import GridReference
+from pdcam.layouts import LAYOUTS
+from pdcam.sources import source_from_spec
+from pdcam.video import Video
+
+CAMERA_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class CameraConfig(collections.namedtuple('CameraConfig', ['id', 'reference', 'layout', 'flip', 'source', 'boards'])):
+    """Settings for one camera of a CameraGroup
+
+    * id: Name of the camera in URLs
+    * reference: GridReference of the camera's board, or None
+    * layout: Electrode layout of the board
+    * flip: Whether to flip the image
+    * source: FrameSource, or None for the Raspberry Pi camera
+    * boards: Optional `pdcam.boards.BoardRegistry`, to identify the board
+        in view rather than using `reference` and `layout`
+    """
+    __slots__ = ()
+
+    def __new__(cls, id, reference, layout, flip, source, boards=None):
+        return super().__new__(cls, id, reference, layout, flip, source, boards)
+
+    @staticmethod
+    def from_dict(data, base_dir=".", width=Video.WIDTH, height=Video.HEIGHT):
+        """Create from an entry of a camera config file (see module docs)
+        """
+        camera_id = str(data['id'])
+        if not CAMERA_ID_PATTERN.match(camera_id):
+            raise ValueError("Invalid camera id '%s'; use letters, digits, '-' and '_'" % camera_id)
+        layout_name = data.get('layout', 'v3')
+        if layout_name not in LAYOUTS:
+            raise ValueError("Unknown layout '%s' for camera %s; use one of %s" % (
+                layout_name, camera_id, ", ".join(sorted(LAYOUTS))))
+        reference = data.get('reference')
+        if reference is not None:
+            with open(os.path.join(base_dir, reference)) as f:
+                reference = GridReference.from_dict(json.loads(f.read()))
+        source = data.get('source')
+        if source is not None:
+            source = source_from_spec(source, width, height)
+        boards = data.get('boards')
+        if boards is not None:
+            boards = BoardRegistry.from_path(os.path.join(base_dir, boards))
+        return CameraConfig(
+            camera_id, reference, LAYOUTS[layout_name], bool(data.get('flip', False)), source, boards)
+
+
+def load_camera_configs(path):
+    """Load a list of CameraConfig from a camera config file
+    """
+    with open(path) as f:
+        data = json.loads(f.read())
+    configs = [CameraConfig.from_dict(d, os.path.dirname(path)) for d in data]
+    ids = [c.id for c in configs]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Camera ids must be unique")
+    return configs
+
+
+class CameraGroup(object):
+    """A set of Videos sharing one process's CPU
+
+    Each camera has its own source, reference, layout and locator state, but
+    the cameras share:
+
+    * With `locate_workers` > 0, a single `pdcam.pool.LocatePool` of worker
+        processes, so the locate CPU is bounded by the number of workers
+        rather than growing with the number of cameras.
+    * A semaphore allowing at most `encode_slots` frames to be rendered and
+        JPEG encoded at once, across all cameras and stream variants.
+
+    Arguments:
+    * configs: List of CameraConfig. The first is the default camera.
+    * locate_workers: Number of locate worker processes (default
+        `Video.LOCATE_WORKERS`)
+    * encode_slots: Maximum concurrent encodes (default one per CPU)
+    """
+    def __init__(self, configs, locate_workers=None, encode_slots=None):
+        if len(configs) == 0:
+            raise ValueError("At least one camera is required")
+        if locate_workers is None:
+            locate_workers = Video.LOCATE_WORKERS
+        if encode_slots is None:
+            encode_slots = os.cpu_count() or 1
+        self.encode_slots = threading.BoundedSemaphore(encode_slots)
+        self.locate_pool = None
+        # Cameras identifying their boards locate on their own thread
+        references = [
+            c.reference for c in configs
+            if c.reference is not None and len(c.reference.fiducials) > 0 and c.boards is None
+        ]
+        if locate_workers > 0 and len(references) > 0:
+            # Imported here so the multiprocessing machinery is only loaded when used
+            from pdcam.pool import LocatePool
+            self.locate_pool = LocatePool(
+                references,
+                locate_workers,
+                (Video.HEIGHT, Video.WIDTH, 3),
+                track=Video.TRACK_FIDUCIALS,
+                refresh_frames=Video.TRACK_REFRESH_FRAMES,
+                decimate=Video.DECIMATE)
+
+        self.cameras = collections.OrderedDict()
+        for c in configs:
+            self.cameras[c.id] = Video(
+                c.reference, c.layout, c.flip, c.source,
+                locate_pool=self.locate_pool, encode_slots=self.encode_slots, boards=c.boards)
+
+    @property
+    def default(self):
+        """The first camera, which is also served at the top level routes"""
+        return next(iter(self.cameras.values()))
+
+    def get(self, camera_id):
+        return self.cameras.get(camera_id)
+
+    def stop(self):
+        """Stop every camera, and the shared locate pool
+        """
+        for camera in self.cameras.values():
+            camera.stop()
+        if self.locate_pool is not None:
+            self.locate_pool.stop()
+
+    def info(self):
+        """Summary of each camera, as a JSON serializable list"""
+        return [
+            {
+                'id': camera_id,
+                'board': camera.board.name if camera.board is not None else None,
+                'frame': camera.frame_number,
+                'located': camera.grid_finder is not None and camera.grid_finder.latest()[0] is not None,
+                'rows': len(camera.grid_layout),
+                'columns': len(camera.grid_layout[0]) if len(camera.grid_layout) > 0 else 0,
+            }
+            for camera_id, camera in self.cameras.items()
+        ]
+
+    def render_metrics(self):
+        """Render pipeline metrics in the Prometheus text format
+
+        With several cameras, each camera's gauges are labelled by camera id.
+        The stage timers and counters in `pdcam.metrics.REGISTRY` are totals
+        for all cameras.
+        """
+        if len(self.cameras) == 1:
+            return self.default.render_metrics()
+        extra = []
+        for camera_id, camera in self.cameras.items():
+            extra.extend(camera.metric_samples({'camera': camera_id}))
+        return metrics.render(extra)
@@ -0,0 +1,147 @@
+"""Per-electrode image statistics, for detecting droplets on the device
+"""
+import cv2
+import numpy as np
+import threading
+
+from pdcam.plotting import template_polylines
+
+# BGR weights for intensity, as used by cv2.cvtColor
+GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+
+class ElectrodeSampler(object):
+    """Computes color statistics of the image within each electrode
+
+    A label image assigning each pixel to an electrode is rasterized from the
+    electrode polygons, and cached until the integer polygon positions change.
+    Only the indices of the labelled pixels are kept, so that each sample is a
+    single gather of those pixels followed by `np.bincount` reductions, with no
+    per-electrode loop.
+
+    Cells of the layout with the same electrode number are treated as one
+    electrode.
+
+    Arguments:
+    * layout: Electrode layout
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        cells = [
+            (x, y, e)
+            for y, row in enumerate(layout)
+            for x, e in enumerate(row)
+            if e is not None
+        ]
+        self.ids = sorted(set(e for _, _, e in cells))
+        index = {e: i for i, e in enumerate(self.ids)}
+        # Electrode index of each template polygon, in template_polylines order
+        # (row major, skipping empty cells)
+        self.cell_index = np.array([index[e] for _, _, e in cells], dtype=np.int64)
+        self.lock = threading.Lock()
+        self.labels = None
+        self.labels_key = None
+        self.previous = None
+
+    def _build_labels(self, polylines, shape):
+        """Rasterize the electrode polygons into (pixel indices, electrode indices, counts)"""
+        points = polylines.reshape((-1, 2))
+        x, y, w, h = cv2.boundingRect(points)
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, shape[1]), min(y + h, shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.zeros(len(self.ids))
+
+        # Label 0 is background
+        canvas = np.zeros((y1 - y0, x1 - x0), dtype=np.uint16)
+        offset = np.array([x0, y0], dtype=np.int32)
+        for i, polygon in zip(self.cell_index, polylines):
+            cv2.fillPoly(canvas, [polygon - offset], int(i) + 1)
+
+        ys, xs = np.nonzero(canvas)
+        electrode = canvas[ys, xs].astype(np.int64) - 1
+        pixels = (ys + y0) * shape[1] + (xs + x0)
+        counts = np.bincount(electrode, minlength=len(self.ids)).astype(np.float64)
+        return pixels, electrode, counts
+
+    def sample(self, image, transform):
+        """Compute the statistics of each electrode in a BGR image
+
+        Returns None if `transform` is None. Otherwise returns a dict of
+        arrays, in the order of `ids`:
+
+        * mean: (N, 3) mean RGB color
+        * intensity: Mean gray level
+        * variance: Variance of the gray level
+        * change: Mean absolute change in gray level of each pixel since the
+            previous sample, or NaN if the electrode positions have changed
+        * pixels: Number of pixels sampled
+        """
+        if transform is None:
+            return None
+        polylines = template_polylines(self.layout, transform)
+        key = (polylines.tobytes(), image.shape)
+
+        with self.lock:
+            if key != self.labels_key:
+                self.labels = self._build_labels(polylines, image.shape)
+                self.labels_key = key
+                self.previous = None
+            pixels, electrode, counts = self.labels
+            previous = self.previous
+
+            n = len(self.ids)
+            safe_counts = np.maximum(counts, 1)
+            values = image.reshape((-1, image.shape[2]))[pixels].astype(np.float32)
+            gray = np.dot(values, GRAY_WEIGHTS)
+
+            mean = np.empty((n, 3))
+            for c in range(3):
+                # Reverse channels, so colors are reported as RGB
+                mean[:, c] = np.bincount(electrode, values[:, 2 - c], minlength=n) / safe_counts
+            intensity = np.bincount(electrode, gray, minlength=n) / safe_counts
+            variance = np.bincount(electrode, gray * gray, minlength=n) / safe_counts - intensity ** 2
+            if previous is not None:
+                change = np.bincount(electrode, np.abs(gray - previous), minlength=n) / safe_counts
+            else:
+                change = np.full(n, np.nan)
+            self.previous = gray
+
+        return {
+            'mean': mean,
+            'intensity': intensity,
+            'variance': np.maximum(variance, 0),
+            'change': change,
+            'pixels': counts.astype(np.int64),
+        }
+
+
+def stats_to_dict(ids, stats, decimals=1):
+    """Columnar, JSON serializable form of ElectrodeSampler statistics
+
+    NaN values are converted to None.
+    """
+    def column(a):
+        a = np.round(a, decimals).tolist()
+        return [None if v != v else v for v in a]
+
+    return {
+        'ids': list(ids),
+        'mean': np.round(stats['mean'], decimals).tolist(),
+        'intensity': column(stats['intensity']),
+        'variance': column(stats['variance']),
+        'change': column(stats['change']),
+        'pixels': [int(n) for n in stats['pixels']],
+    }
+
+
+# Columns of the binary format
+BINARY_COLUMNS = ('id', 'r', 'g', 'b', 'intensity', 'variance', 'change')
+
+
+def stats_to_bytes(ids, stats):
+    """Pack ElectrodeSampler statistics as little-endian float32 rows of
+    `BINARY_COLUMNS`"""
+    rows = np.column_stack([
+        np.array(ids, dtype=np.float64), stats['mean'], stats['intensity'], stats['variance'], stats['change']])
+    return rows.astype('<f4').tobytes()
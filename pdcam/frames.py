@@ -0,0 +1,111 @@
+"""Reference counted frame storage shared by the capture thread and readers
+"""
+import numpy as np
+import threading
+
+
+class FrameSlot(object):
+    def __init__(self, shape):
+        self.image = np.empty(shape, dtype=np.uint8)
+        self.number = 0
+        self.timestamp = None
+        self.refcount = 0
+
+
+class FrameRef(object):
+    """A borrowed reference to a captured frame
+
+    The frame's image won't be overwritten until the reference is released.
+    Readers must treat the image as read-only, since it is shared. Use as a
+    context manager, or call `release` exactly once.
+    """
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+        self.image = slot.image
+        self.number = slot.number
+        self.timestamp = slot.timestamp
+
+    def release(self):
+        self.ring.release(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FrameRing(object):
+    """A pool of preallocated frame buffers
+
+    The capture thread fills a free slot and publishes it as the latest frame.
+    Readers borrow the latest frame and use it in place, without copying and
+    without holding any lock. The writer never waits for readers: if every
+    slot is borrowed, a new slot is allocated, up to `max_slots`.
+
+    Arguments:
+    * shape: Shape of each frame
+    * nslots: Number of slots to preallocate
+    * max_slots: Maximum number of slots to grow to
+    """
+    def __init__(self, shape, nslots=3, max_slots=8):
+        self.shape = shape
+        self.max_slots = max_slots
+        self.slots = [FrameSlot(shape) for _ in range(nslots)]
+        self.latest_slot = None
+        self.cv = threading.Condition()
+
+    def _free_slot(self):
+        for slot in self.slots:
+            if slot.refcount == 0 and slot is not self.latest_slot:
+                return slot
+        if len(self.slots) < self.max_slots:
+            slot = FrameSlot(self.shape)
+            self.slots.append(slot)
+            return slot
+        return None
+
+    def acquire_write(self):
+        """Get a slot for the writer to fill
+
+        Only waits if every slot up to `max_slots` is borrowed, which happens
+        only if readers are leaking references.
+        """
+        with self.cv:
+            slot = self._free_slot()
+            while slot is None:
+                self.cv.wait()
+                slot = self._free_slot()
+            # Hold a reference while writing, so the slot isn't handed out again
+            slot.refcount += 1
+            return slot
+
+    def publish(self, slot, number, timestamp):
+        """Make a slot filled by the writer the latest frame
+        """
+        with self.cv:
+            slot.number = number
+            slot.timestamp = timestamp
+            slot.refcount -= 1
+            self.latest_slot = slot
+            self.cv.notify_all()
+
+    def abandon(self, slot):
+        """Return a slot acquired for writing without publishing it
+        """
+        self.release(slot)
+
+    def borrow_latest(self):
+        """Borrow the most recently published frame, or None if there is none
+        """
+        with self.cv:
+            if self.latest_slot is None:
+                return None
+            self.latest_slot.refcount += 1
+            return FrameRef(self, self.latest_slot)
+
+    def release(self, slot):
+        with self.cv:
+            slot.refcount -= 1
+            self.cv.notify_all()
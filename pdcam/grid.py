@@ -1,15 +1,23 @@
 """Utilities for locating the electrode grid in an image
 """
+import collections
 import cv2
 import logging
-import itertools
 import numpy as np
 import apriltag
-from typing import List, Dict, Tuple
+from typing import List, Tuple
+
+from pdcam.metrics import stage_timer
 
 
 logger = logging.getLogger()
 
+_enhance_timer = stage_timer('enhance')
+_detect_timer = stage_timer('detect')
+_refine_timer = stage_timer('refine')
+_match_timer = stage_timer('match')
+_homography_timer = stage_timer('homography')
+
 class Fiducial(object):
     def __init__(self, corners, label=""):
         self.corners = corners
@@ -20,6 +28,18 @@ class ControlPoint(object):
         self.grid = grid_coord
         self.image = image_coord
 
+class GridSolution(collections.namedtuple('GridSolution', ['transform', 'error', 'matched', 'inliers'])):
+    """A grid transform, with measures of its quality
+
+    * transform: Grid to image transform, or None if no solution was found
+    * error: RMS reprojection error of the inlier fiducial corners, in pixels
+    * matched: Number of fiducials matched to the reference
+    * inliers: Number of fiducial corners consistent with the transform
+    """
+    __slots__ = ()
+
+NO_SOLUTION = GridSolution(None, None, 0, 0)
+
 class GridReference(object):
     """Represents locations extracted from a reference image of an electrode 
     board, which relate electrode grid positions to QR code positions, and can
@@ -27,22 +47,30 @@ class GridReference(object):
     image in which the same QR codes have been found. 
 
     Arguments:
+    * fiducials: Corners of each fiducial in the reference image
+    * control_points: Electrode grid coordinates and their reference image location
+    * labels: Optional tag ID of each fiducial. When provided, fiducials are
+        matched by ID rather than by their relative positions.
     """
-    def __init__(self, fiducials: List[List[int]], control_points: List[ControlPoint]):
+    def __init__(self, fiducials: List[List[int]], control_points: List[ControlPoint], labels: List[int]=None):
         if not isinstance(fiducials, list):
             raise ValueError("fiducials should be a list")
+        if labels is not None and len(labels) != len(fiducials):
+            raise ValueError("labels should have one entry per fiducial")
 
         self.fiducials = fiducials
         self.control_points = control_points
+        self.labels = labels
 
     @staticmethod
     def from_dict(data):
-        fiducials = data['fiducials']
+        # Older reference files stored the fiducials under 'qr'
+        fiducials = data['fiducials'] if 'fiducials' in data else data['qr']
         control_points = [
             ControlPoint(tuple(p['grid']), tuple(p['image']))
             for p in data['electrodes']
         ]
-        return GridReference(fiducials, control_points)
+        return GridReference(fiducials, control_points, data.get('labels'))
 
 
 def sort_fiducials(qr_a, qr_b):
@@ -50,93 +78,430 @@ def sort_fiducials(qr_a, qr_b):
 
     In general, when we find fiducials in an image, we don't expect them to be 
     returned in a consistent order. Additionally, the image coordinate may be 
-    rotated from image to image. Here we match fiducials by trying all permutations
-    of matches and taking the best fit. We assume that the fiducials are all
-    aligned in similar directions; this is a constraint on fiducials placement.
+    rotated from image to image. Here we express the position of each fiducial
+    relative to the centroid of all fiducials, in a coordinate system aligned
+    with the fiducials' common direction, and match fiducials with a minimum
+    cost assignment on the squared distances between those positions. We
+    assume that the fiducials are all aligned in similar directions; this is a
+    constraint on fiducials placement.
+
+    Both lists must hold the same fiducials. `GridLocator` uses the same
+    assignment as its first guess when matching by position, and checks it,
+    so that missing and extra fiducials are handled there.
+
+    Returns qr_a unchanged, and qr_b reordered to match it.
     """
+    _, order = fiducial_order(qr_a, qr_b)
+    return np.array(qr_a, dtype=np.float64).tolist(), np.array(qr_b, dtype=np.float64)[order].tolist()
+
+def fiducial_order(qr_a, qr_b):
+    """Assign the fiducials of qr_b to those of qr_a (see `sort_fiducials`)
 
-    qr_a = np.array(qr_a)
-    qr_b = np.array(qr_b)
-
-    # Get unit vectors defining our common coordinate system in each image
-    ux_a = np.array([0.0, 0.0])
-    ux_b = np.array([0.0, 0.0])
-    for qr in qr_a:
-        ux_a += qr[1] - qr[0]
-    for qr in qr_b:
-        ux_b += qr[1] - qr[0]
-    ux_a /= np.linalg.norm(ux_a)
-    ux_b /= np.linalg.norm(ux_b)
-
-    def displacements(qrcodes, ux):
-        uy = np.array([ux[1], ux[0]])
-        #uy_b = np.array([ux_b[1], ux_b[0]])
-        displacements = []
-        for i in range(1, len(qrcodes)):
-            d = qrcodes[i][0] - qrcodes[0][0]
-            d2 = np.array([np.dot(ux, d), np.dot(uy, d)])
-            displacements.append(d2)
-        return np.array(displacements)
-
-    best_error = float("inf")
-    best_permutation = []
-    d_a = displacements(qr_a, ux_a)
-    for perm in itertools.permutations(qr_b):
-        d_perm = displacements(perm, ux_b)
-        error = np.sum(np.square(d_perm - d_a))
-        if error < best_error:
-            best_error = error
-            best_permutation = perm
-
-    return qr_a.tolist(), [p.tolist() for p in list(best_permutation)]
-
-def enhance(image):
+    The lists may differ in length, in which case only as many fiducials as
+    the shorter one holds are assigned. Returns the assigned indices of qr_a
+    and of qr_b, as `scipy.optimize.linear_sum_assignment` does.
+    """
+    # scipy.optimize is slow to import, and only needed to match by position
+    from scipy.optimize import linear_sum_assignment
+
+    qr_a = np.array(qr_a, dtype=np.float64)
+    qr_b = np.array(qr_b, dtype=np.float64)
+
+    def displacements(qrcodes):
+        # Unit vectors defining our common coordinate system in each image
+        ux = np.sum(qrcodes[:, 1] - qrcodes[:, 0], axis=0)
+        ux /= np.linalg.norm(ux)
+        uy = np.array([-ux[1], ux[0]])
+        d = qrcodes[:, 0] - np.mean(qrcodes[:, 0], axis=0)
+        return np.dot(d, np.array([ux, uy]).T)
+
+    d_a = displacements(qr_a)
+    d_b = displacements(qr_b)
+    cost = np.sum(np.square(d_a[:, None, :] - d_b[None, :, :]), axis=2)
+    return linear_sum_assignment(cost)
+
+def enhance(image, block_size=55):
     image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, blockSize=55, C=5)
+    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, blockSize=block_size, C=5)
     return image
 
-def find_fiducials(image):
-    detector = apriltag.Detector()
-    result = detector.detect(enhance(image))
+def refine_corners(image, fiducials: List[Fiducial], window):
+    """Refine fiducial corners to sub-pixel accuracy in a full resolution image
+
+    Corners are searched for within +/- `window` pixels of their current
+    position.
+
+    AprilTag corners are reported with the origin at the corner of the first
+    pixel, whereas OpenCV puts it at the pixel center, so corners are shifted
+    by half a pixel on the way in and out of `cornerSubPix`.
+    """
+    if len(fiducials) == 0:
+        return fiducials
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    corners = np.array([f.corners for f in fiducials], dtype=np.float32).reshape((-1, 1, 2)) - 0.5
+    # Scaled up corners of a tag at the image edge can land just outside it
+    np.clip(corners[:, :, 0], 0, gray.shape[1] - 1, out=corners[:, :, 0])
+    np.clip(corners[:, :, 1], 0, gray.shape[0] - 1, out=corners[:, :, 1])
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.01)
+    corners = cv2.cornerSubPix(gray, corners, (window, window), (-1, -1), criteria)
+    corners = corners.reshape((len(fiducials), 4, 2)).astype(np.float64) + 0.5
+    return [Fiducial(c.tolist(), f.label) for c, f in zip(corners, fiducials)]
+
+def find_fiducials(image, detector=None, decimate=1):
+    """Find AprilTag fiducials in an image
+
+    Arguments:
+    * image: RGB or BGR image to search
+    * detector: An apriltag.Detector to reuse. A new one is created if not provided.
+    * decimate: Integer factor by which to downscale the image for detection.
+        When greater than 1, tag corners are refined in the full resolution
+        image afterwards.
+    """
+    if detector is None:
+        detector = apriltag.Detector()
+
+    if decimate > 1:
+        small = cv2.resize(image, None, fx=1.0 / decimate, fy=1.0 / decimate, interpolation=cv2.INTER_AREA)
+        # Keep the threshold block the same size relative to the image; it must be odd
+        block_size = max(3, int(55 / decimate) | 1)
+        with _enhance_timer.time():
+            enhanced = enhance(small, block_size)
+    else:
+        with _enhance_timer.time():
+            enhanced = enhance(image)
+    with _detect_timer.time():
+        result = detector.detect(enhanced)
 
     fiducials = [
         Fiducial(tag.corners.tolist(), tag.tag_id) 
         for tag in result]
+
+    if decimate > 1:
+        for f in fiducials:
+            f.corners = [[p[0] * decimate, p[1] * decimate] for p in f.corners]
+        with _refine_timer.time():
+            fiducials = refine_corners(image, fiducials, decimate + 1)
+
     return fiducials
 
-def find_grid_transform(reference: GridReference, image):
-    """Provide transform to move from electrode grid coordinates to pixel 
-    coordinates in a new image. 
+class GridLocator(object):
+    """Locates the electrode grid for a single GridReference
+
+    Holds a long-lived AprilTag detector, and caches everything which can be
+    computed from the reference alone (the grid to reference image homography,
+    and the reference fiducial corners), so that locating the grid in a new
+    image only requires tag detection and one homography fit.
+
+    With `track=True`, fiducials are searched for only in padded regions
+    around their positions in the previous image, and a full image scan is
+    done only when a tag is lost, or after `refresh_frames` tracked images.
+
+    Fiducials are matched to the reference by tag ID, so the grid can be
+    located with some tags missing (at least `MIN_FIDUCIALS`), or with
+    extra tags in view. If the reference has no labels, or its tag IDs
+    aren't unique, fiducials are matched by position instead (see
+    `_match_by_position`), which also copes with missing and extra tags. The
+    tag IDs of an unlabelled reference are learned from the first image in
+    which every fiducial is matched by position with a distinct ID, after
+    which matching is by ID. The homography is fit to all matched tag corners
+    with RANSAC, so that a misplaced or misidentified tag is rejected rather
+    than skewing the fit, and the quality of each solution is kept in
+    `last_solution`.
+
+    A GridLocator is not thread-safe; use one per thread.
 
     Arguments:
-    * reference: Control points and fiducials from a reference/calibration image
-        of the electrode board
-    * image: An image (numpy array) of the reference board with all fiducials visible
+    * reference: The GridReference for the board to be located
+    * track: Enable searching near previous fiducial positions
+    * refresh_frames: Maximum number of consecutive tracked images before
+        forcing a full image scan
+    * roi_padding: Padding added around each previous tag position, as a
+        fraction of the tag size
+    * decimate: Downscale factor used for tag detection (see `find_fiducials`)
     """
+    # Smallest region to search when tracking. Keeps the adaptive threshold
+    # block from covering most of a small region.
+    MIN_ROI_SIZE = 160
+    # Fewest fiducials to fit a transform to. One tag's corners determine a
+    # homography, but too poorly across the whole board.
+    MIN_FIDUCIALS = 2
+    # Largest distance, in pixels, of a corner from its reprojected
+    # reference position for it to count as an inlier
+    RANSAC_THRESHOLD = 3.0
+    # Largest mean corner distance of a fiducial from a projected reference
+    # fiducial for them to match by position, as a fraction of the tag size
+    POSITION_TOLERANCE = 0.5
+    # Probability with which the position search finds the best match before
+    # stopping, as in RANSAC
+    POSITION_CONFIDENCE = 0.99
+    # Most found fiducials sampled by the position search. Each is paired
+    # with every reference fiducial, and the best pairing refined.
+    MAX_POSITION_SAMPLES = 8
+    # RANSAC iterations used to check the first position assignment. A
+    # mostly correct assignment needs few; a wrong one is left to the search.
+    POSITION_RANSAC_ITERATIONS = 100
 
-    fiducials = find_fiducials(image)
+    def __init__(self, reference: GridReference, track=False, refresh_frames=10, roi_padding=1.0, decimate=1):
+        self.reference = reference
+        self.decimate = decimate
+        self.track = track
+        self.refresh_frames = refresh_frames
+        self.roi_padding = roi_padding
+        self.tracked_fiducials = None
+        self.tracked_count = 0
+        self.detector = apriltag.Detector()
+        self.H0 = self._reference_homography(reference)
+        # Reference corners of each fiducial
+        self.ref_corners = np.array(reference.fiducials, dtype=np.float64).reshape((-1, 4, 2))
+        # Reference fiducial index of each tag ID, if the IDs are known and unique
+        self.labels = None
+        if reference.labels is not None and len(set(reference.labels)) == len(reference.labels):
+            self.labels = {label: i for i, label in enumerate(reference.labels)}
+        # Samples fiducials for the position search
+        self.rng = np.random.default_rng(0)
+        self.last_solution = NO_SOLUTION
 
-    if len(fiducials) != len(reference.fiducials):
-        logger.warn("Found %d fiducials, needed %d", len(fiducials), len(reference.fiducials))
-        return None, fiducials
+    @staticmethod
+    def _reference_homography(reference: GridReference):
+        """Get transform from grid to reference image coordinates
+        """
+        if len(reference.control_points) < 4:
+            return None
+        src_points = np.array([cp.grid for cp in reference.control_points])
+        dst_points = np.array([cp.image for cp in reference.control_points])
+        H0, _ = cv2.findHomography(src_points, dst_points)
+        return H0
+
+    def find_fiducials(self, image):
+        if not self.track:
+            return find_fiducials(image, self.detector, self.decimate)
+
+        if self.tracked_fiducials is not None and self.tracked_count < self.refresh_frames:
+            fiducials = self._find_tracked_fiducials(image)
+            if fiducials is not None:
+                self.tracked_fiducials = fiducials
+                self.tracked_count += 1
+                return fiducials
+
+        fiducials = find_fiducials(image, self.detector, self.decimate)
+        self.tracked_count = 0
+        # Only track once a complete set of tags has been found; otherwise
+        # missing tags would not be picked up until the next refresh
+        if len(fiducials) > 0 and len(fiducials) == len(self.reference.fiducials):
+            self.tracked_fiducials = fiducials
+        else:
+            self.tracked_fiducials = None
+        return fiducials
+
+    def _roi(self, corners, shape):
+        corners = np.array(corners)
+        x0, y0 = np.min(corners, axis=0)
+        x1, y1 = np.max(corners, axis=0)
+        pad = max(x1 - x0, y1 - y0) * self.roi_padding
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        half = max((x1 - x0) / 2 + pad, (y1 - y0) / 2 + pad, self.MIN_ROI_SIZE / 2)
+        x0 = max(int(cx - half), 0)
+        y0 = max(int(cy - half), 0)
+        x1 = min(int(cx + half) + 1, shape[1])
+        y1 = min(int(cy + half) + 1, shape[0])
+        return x0, y0, x1, y1
+
+    def _find_tracked_fiducials(self, image):
+        """Search for each tracked fiducial in a region around its last position
+
+        Returns None if any of the tracked fiducials is not found.
+        """
+        fiducials = []
+        for prev in self.tracked_fiducials:
+            x0, y0, x1, y1 = self._roi(prev.corners, image.shape)
+            found = [f for f in find_fiducials(image[y0:y1, x0:x1], self.detector, self.decimate) if f.label == prev.label]
+            if len(found) != 1:
+                return None
+            corners = [[p[0] + x0, p[1] + y0] for p in found[0].corners]
+            fiducials.append(Fiducial(corners, prev.label))
+        return fiducials
+
+    def find_grid_transform(self, image):
+        """Provide transform to move from electrode grid coordinates to pixel 
+        coordinates in a new image. 
+
+        See `find_grid_transform` for details.
+        """
+        fiducials = self.find_fiducials(image)
+        return self.transform_from_fiducials(fiducials), fiducials
+
+    def transform_from_fiducials(self, fiducials: List[Fiducial]):
+        """Compute the grid transform from fiducials found in an image
+
+        Returns None if too few fiducials can be matched to the reference.
+        See `solve` for the quality of the solution.
+        """
+        self.last_solution = self.solve(fiducials)
+        return self.last_solution.transform
+
+    def _match_by_position(self, fiducials: List[Fiducial]):
+        """Match fiducials to reference fiducials by their positions alone
+
+        The fiducials are first assigned to the reference fiducials by their
+        displacements from the centroid (see `fiducial_order`). A homography
+        is fit to the assigned corners with RANSAC, and projects the reference
+        fiducials into the image, where they are reassigned to the nearest
+        found fiducials within `POSITION_TOLERANCE`. If that matches every
+        fiducial which could be, as it does for a complete set of tags, the
+        match is done.
+
+        Otherwise, e.g. with missing and extra tags, hypotheses are searched
+        as in RANSAC: found fiducials are sampled at random, and each is
+        paired with every reference fiducial at once. The similarity transform
+        between the corners of the pair which brings the most reference
+        fiducials near found fiducials projects them into the image, and the
+        assignment is refined once with a homography fit to the matched
+        corners. The hypothesis matching the most fiducials wins, and the
+        search stops once a better match would very likely have been found
+        (see `POSITION_CONFIDENCE`), or after `MAX_POSITION_SAMPLES`. Missing
+        tags, extra tags and repeated tag IDs therefore don't affect the
+        match.
+
+        Returns a list of (reference index, fiducial) pairs.
+        """
+        # scipy.optimize is slow to import, and only needed without tag IDs
+        from scipy.optimize import linear_sum_assignment
+
+        if len(fiducials) == 0 or len(self.ref_corners) == 0:
+            return []
+        found = np.array([f.corners for f in fiducials], dtype=np.float64).reshape((-1, 4, 2))
+        tolerance = np.linalg.norm(found[:, 1] - found[:, 0], axis=1) * self.POSITION_TOLERANCE
+        ref_points = self.ref_corners.reshape((-1, 2))
+
+        def assign(projected):
+            distance = np.mean(np.linalg.norm(
+                projected.reshape(self.ref_corners.shape)[:, None] - found[None], axis=3), axis=2)
+            close = distance < tolerance[None]
+            # Pairs too far apart to match all cost the same, so that the
+            # assignment doesn't give up a match to pair two non-matches
+            rows, cols = linear_sum_assignment(np.where(close, distance, distance.size * tolerance.max()))
+            close = close[rows, cols]
+            return list(zip(rows[close], cols[close])), np.sum(distance[rows[close], cols[close]])
 
-    # Reduce the decoded maker struct to list of corner lists, and match the order to the 
-    # reference order based on their geometry
-    refqr, dstqr = sort_fiducials(reference.fiducials, [f.corners for f in fiducials])
+        def refine(pairs, method=0):
+            # Reassign with a homography fit to the corners of the pairs
+            if len(pairs) < 2:
+                return None
+            H, _ = cv2.findHomography(
+                self.ref_corners[[r for r, _ in pairs]].reshape((-1, 2)),
+                found[[c for _, c in pairs]].reshape((-1, 2)), method, self.RANSAC_THRESHOLD,
+                maxIters=self.POSITION_RANSAC_ITERATIONS)
+            if H is None:
+                return None
+            return assign(cv2.perspectiveTransform(ref_points[None], H)[0])
 
-    def flatten(l):
-        return [item for sublist in l for item in sublist]
+        most = min(len(found), len(self.ref_corners))
+        best, best_cost = [], np.inf
+        # A homography can be fit to a wrong pairing of two tags, so only a
+        # match of more is trusted without searching
+        trusted = 3
+        if most >= trusted:
+            pairs, cost = refine(list(zip(*fiducial_order(self.ref_corners, found))), cv2.RANSAC) or ([], np.inf)
+            if len(pairs) >= trusted:
+                best, best_cost = pairs, cost
 
-    # Get transform from grid to reference image coordinates
-    src_points = np.array([cp.grid for cp in reference.control_points])
-    dst_points = np.array([cp.image for cp in reference.control_points])
-    H0, _ = cv2.findHomography(src_points, dst_points)
+        # Corners as complex numbers, so that a similarity transform is a
+        # complex scale and offset
+        ref_z = self.ref_corners[..., 0] + 1j * self.ref_corners[..., 1]
+        found_z = found[..., 0] + 1j * found[..., 1]
+        ref_centers = np.mean(ref_z, axis=1)
+        ref_centered = ref_z - ref_centers[:, None]
+        for t, j in enumerate(self.rng.permutation(len(found))[:self.MAX_POSITION_SAMPLES]):
+            # Every fiducial which could be matched is; no hypothesis can do better
+            if len(best) == most:
+                break
+            # A better match accounts for more than len(best) of the found
+            # fiducials, so is missed only if none of them has been sampled
+            others = len(found) - len(best) - 1
+            missed = np.prod([max(others - s, 0) / (len(found) - s) for s in range(t)])
+            if len(best) >= trusted and missed < 1 - self.POSITION_CONFIDENCE:
+                break
+            # Least squares similarities taking each reference fiducial to fiducial j
+            center = np.mean(found_z[j])
+            scale = (np.sum((found_z[j] - center) * np.conj(ref_centered), axis=1)
+                     / np.sum(np.abs(ref_centered) ** 2, axis=1))
+            projected = scale[:, None, None] * ref_z[None] + (center - scale * ref_centers)[:, None, None]
+            # Refine the pairing which brings the most reference fiducials near found ones
+            distance = np.mean(np.abs(projected[:, :, None] - found_z[None, None]), axis=3)
+            i = np.argmax(np.sum(np.any(distance < tolerance, axis=2), axis=1))
+            pairs, cost = assign(np.stack([projected[i].real, projected[i].imag], axis=-1))
+            pairs, cost = refine(pairs) or (pairs, cost)
+            if len(pairs) > len(best) or (len(pairs) == len(best) and cost < best_cost):
+                best, best_cost = pairs, cost
+        return [(int(i), fiducials[j]) for i, j in best]
 
-    # Get transform from reference image to current image
-    src_points = np.array([flatten(refqr)])
-    dst_points = np.array([flatten(dstqr)])
-    H1, _ = cv2.findHomography(src_points, dst_points)
+    def _learn_labels(self, matched):
+        """Learn the tag ID of each reference fiducial from a complete set of
+        fiducials matched by position, if their IDs are distinct"""
+        labels = [f.label for _, f in matched]
+        if len(matched) != len(self.reference.fiducials) or len(set(labels)) != len(labels):
+            return
+        self.labels = {f.label: i for i, f in matched}
 
-    xform = np.dot(H1, H0)
-    
-    return xform, fiducials
+    def _match(self, fiducials: List[Fiducial]):
+        """Pair the corners of each fiducial with its reference corners
+
+        Returns (reference points, image points, number of reference
+        fiducials matched). When matching by ID, a tag ID found more than
+        once contributes each copy, and RANSAC keeps the one which fits.
+        """
+        if self.labels is not None:
+            indices = [self.labels.get(f.label) for f in fiducials]
+            matched = [(i, f) for i, f in zip(indices, fiducials) if i is not None]
+        else:
+            matched = self._match_by_position(fiducials)
+            if self.reference.labels is None:
+                self._learn_labels(matched)
+        if len(matched) == 0:
+            return None, None, 0
+        src = self.ref_corners[[i for i, _ in matched]].reshape((-1, 2))
+        dst = np.array([f.corners for _, f in matched], dtype=np.float64).reshape((-1, 2))
+        return src, dst, len(set(i for i, _ in matched))
+
+    def solve(self, fiducials: List[Fiducial]):
+        """Compute the grid transform and its quality from fiducials found
+        in an image
+
+        Returns a GridSolution, whose transform is None if no solution is found.
+        """
+        if self.H0 is None:
+            return NO_SOLUTION
+
+        with _match_timer.time():
+            src, dst, matched = self._match(fiducials)
+        needed = min(self.MIN_FIDUCIALS, len(self.reference.fiducials))
+        if matched < max(needed, 1):
+            logger.warning("Matched %d of %d fiducials (found %s), needed %d",
+                matched, len(self.reference.fiducials), [f.label for f in fiducials], needed)
+            return GridSolution(None, None, matched, 0)
+
+        # Get transform from reference image to current image
+        with _homography_timer.time():
+            H1, mask = cv2.findHomography(src, dst, cv2.RANSAC, self.RANSAC_THRESHOLD)
+        if H1 is None:
+            return GridSolution(None, None, matched, 0)
+        inliers = mask.ravel().astype(bool)
+        projected = cv2.perspectiveTransform(src[inliers][None], H1)[0]
+        error = float(np.sqrt(np.mean(np.sum(np.square(projected - dst[inliers]), axis=1))))
+
+        return GridSolution(np.dot(H1, self.H0), error, matched, int(np.count_nonzero(inliers)))
+
+def find_grid_transform(reference: GridReference, image, decimate=1):
+    """Provide transform to move from electrode grid coordinates to pixel 
+    coordinates in a new image. 
+
+    This builds a new GridLocator on each call; when locating the grid in many
+    images, create a `GridLocator` once and reuse it.
+
+    Arguments:
+    * reference: Control points and fiducials from a reference/calibration image
+        of the electrode board
+    * image: An image (numpy array) of the reference board with all fiducials visible
+    * decimate: Downscale factor used for tag detection (see `find_fiducials`)
+    """
+    return GridLocator(reference, decimate=decimate).find_grid_transform(image)
@@ -0,0 +1,80 @@
+"""Electrode layouts of the supported boards
+
+Each layout is a list of rows, giving the electrode number at each grid
+position, or None where there is no electrode.
+"""
+
+# TODO: Read this from config file or lookup in database based on QR code content
+
+ELECTRODE_LAYOUT_v3 = [
+  [ None, None, None, None, None, None,  None,  None, None, 113, 113],
+  [ None, None, None, None, None, 16,  14,  17, 110, 110, 113],
+  [13, 18, 12, 19, 111, 112, 115, 108, None, 113, 113],
+  [11, 20, 10, 21, 109, 114, 116, 106, None, None, None],
+  [ 9, 22,  8, 23, 107, 117, 105, 119, None, 104, 118],
+  [ 5, 26,  4, 27,   7,  24,   6,  25, 120, 102, 121],
+  [ 3, 28,  2, 29, 103, 101, 122, 100, None, 123, 125],
+  [ 1, 30,  0, 31,  99, 124,  98, 127, None, None, None],
+  [63, 32, 62, 33,  97, 126,  96,  65, None,  92,  67],
+  [61, 34, 60, 35,  95,  64,  94,  93,  66,  90,  69],
+  [59, 36, 58, 37,  91,  68,  89,  70, None,  88,  71],
+  [57, 38, 56, 39,  87,  72,  86,  73, None, None, None],
+  [53, 42, 52, 43,  55,  40,  54,  41,  74,  84,  75],
+  [51, 44, 50, 45,  78,  81,  85,  83,  76,  82,  77],
+  [46, None, None, None, None,  47, None, None, None, None,  80],
+  [49, None, None, None, None,  48, None, None, None, None,  79],
+]
+
+# The coordinates of electrodes to solicit user provided control points during
+# `measure` command
+CONTROL_ELECTRODES_v3 = [(0, 2), (0, 15), (5, 15), (10, 15), (8, 5)]
+
+ELECTRODE_LAYOUT_v4 =  [
+    [None, None, None, None, None, None, 28, 98, None, None, None, None, None, None],
+    [None, None, None, None, None, None, 27, 99, None, None, None, None, None, None],
+    [11, 14, 16, 18, 20, 23, 26, 100, 102, 105, 109, 111, 113, 114],
+    [12, 13, 15, 17, 19, 22, 25, 101, 104, 107, 110, 112, 115, 116],
+    [5, 6, 7, 4, 3, 21, 24, 103, 108, 126, 125, 122, 123, 124],
+    [0, 63, 62, 1, 2, 55, 46, 68, 106, 127, 64, 67, 66, 65],
+    [60, 61, 54, 49, 51, 48, 44, 69, 82, 81, 79, 77, 76, 75],
+    [53, 50, 47, 45, 42, 41, 43, 87, 86, 85, 84, 83, 80, 78],
+    [None, None, None, None, None, None, 40, 88, None, None, None, None, None, None],
+    [None, None, None, None, None, None, 39, 89, None, None, None, None, None, None],
+    [None, None, None, None, None, None, 38, 90, None, None, None, None, None, None],
+]
+CONTROL_ELECTRODES_v4 = [(0, 2), (0, 7), (7, 1), (7,10), (13, 2), (13, 7)]
+
+ELECTRODE_LAYOUT_v4_1 = [
+    [  1,  2,  3,  4,  5,  6,  7,  8,  9, 10],
+    [ 11, 12, 13, 14, 15, 16, 17, 18, 19, 20],
+    [ 21, 22, 23, 24, 25, 26, 27, 28, 29, 30],
+    [ 31, 32, 33, 34, 35, 36, 37, 38, 39, 40],
+    [ 41, 42, 43, 44, 45, 46, 47, 48, 49, 50],
+    [ 51, 52, 53, 54, 55, 56, 57, 58, 59, 60],
+    [ 61, 62, 63, 64, 65, 66, 67, 68, 69, 70],
+    [ 71, 72, 73, 74, 75, 76, 77, 78, 79, 80],
+    [ 81, 82, 83, 84, 85, 86, 87, 88, 89, 90],
+    [ None, None, None, None, 91, 92, None, None, None, None],
+    [ None, None, None, None, 93, 94, None, None, None, None],
+    [ None, None, None, None, 95, 96, None, None, None, None],
+    [ None, None, None, None, 97, 98, None, None, None, None]
+]
+CONTROL_ELECTRODES_v4_1 = [(0, 0), (0, 8), (9, 8), (9, 0)]
+
+ELECTRODE_LAYOUT_v5 = [
+    [ None,  7, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,120, None],
+    [ None,  1, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,126, None],
+    [ None,  0,  8,  9, 10, 11, 12, 13, 14, 15, 16,111,112,113,114,115,116,117,118,119,127, None],
+    [ None, 63, 55, 54, 53, 52, 51, 50, 49, 48, 47, 80, 79, 78, 77, 76, 75, 74, 73, 72, 64, None],
+    [ None, 62, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 65, None],
+    [ None, 56, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 71, None]
+]
+CONTROL_ELECTRODES_v5 = [(1, 0), (1, 5), (20, 0), (20, 5)]
+
+# Layouts by board version
+LAYOUTS = {
+    'v3': ELECTRODE_LAYOUT_v3,
+    'v4': ELECTRODE_LAYOUT_v4,
+    'v4.1': ELECTRODE_LAYOUT_v4_1,
+    'v5': ELECTRODE_LAYOUT_v5,
+}
@@ -0,0 +1,119 @@
+"""Load test for the ASGI server using a fake camera
+
+Starts `pdcam.asgi` in a subprocess, serving synthetic frames at 30 fps,
+then runs many concurrent long-polling `/latest` clients and `/video/`
+streaming clients against it and reports throughput and latency.
+
+    python -m pdcam.loadtest --pollers 200 --streams 4 --duration 10
+"""
+import argparse
+import asyncio
+import multiprocessing
+import numpy as np
+import time
+
+from pdcam.sources import SyntheticSource
+from pdcam.video import Video
+
+
+def serve(port):
+    import uvicorn
+    from pdcam.asgi import create_asgi_app
+
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, fps=30)
+    app = create_asgi_app(Video(None, [[]], source=source))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def read_response(reader):
+    """Read one HTTP response with a content-length body, returning (headers, body)"""
+    status = await reader.readline()
+    if not status:
+        raise ConnectionError("Connection closed")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        key, value = line.decode().split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return headers, body
+
+
+async def poller(port, deadline, latencies):
+    """Long-poll /latest for consecutive frames over one keep-alive connection"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    min_frame = 0
+    try:
+        while time.monotonic() < deadline:
+            request = "GET /latest?min_frame=%d HTTP/1.1\r\nHost: localhost\r\n\r\n" % min_frame
+            start = time.monotonic()
+            writer.write(request.encode())
+            headers, _ = await read_response(reader)
+            latencies.append(time.monotonic() - start)
+            min_frame = int(headers['x-frame-number']) + 1
+    finally:
+        writer.close()
+
+
+async def streamer(port, deadline):
+    """Read a /video/ stream, returning the number of frames received"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b"GET /video/ HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    frames = 0
+    tail = b''
+    try:
+        while time.monotonic() < deadline:
+            chunk = await reader.read(1 << 16)
+            if not chunk:
+                break
+            data = tail + chunk
+            frames += data.count(b'--frame\r\n')
+            tail = data[-9:]
+    finally:
+        writer.close()
+    return frames
+
+
+async def run_clients(port, pollers, streams, duration):
+    deadline = time.monotonic() + duration
+    latencies = []
+    tasks = [poller(port, deadline, latencies) for _ in range(pollers)]
+    tasks += [streamer(port, deadline) for _ in range(streams)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    stream_frames = [r for r in results[pollers:] if not isinstance(r, Exception)]
+    return latencies, stream_frames, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pollers', type=int, default=100, help="Number of long-polling /latest clients")
+    parser.add_argument('--streams', type=int, default=4, help="Number of /video/ clients")
+    parser.add_argument('--duration', type=float, default=10.0, help="Test duration in seconds")
+    parser.add_argument('--port', type=int, default=5123)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    try:
+        # Give the server time to start listening
+        time.sleep(2.0)
+        latencies, stream_frames, errors = asyncio.run(
+            run_clients(args.port, args.pollers, args.streams, args.duration))
+    finally:
+        server.terminate()
+
+    print("Pollers: %d, responses: %d (%.1f/s)" % (args.pollers, len(latencies), len(latencies) / args.duration))
+    if len(latencies) > 0:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print("  long-poll latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (p50, p95, p99))
+    for i, frames in enumerate(stream_frames):
+        print("Stream %d: %d frames (%.1f fps)" % (i, frames, frames / args.duration))
+    if len(errors) > 0:
+        print("%d clients failed: %s" % (len(errors), errors[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Lightweight pipeline metrics, exported in the Prometheus text format
+
+Timers are cheap enough to leave in the hot path: observing a value costs two
+`perf_counter` calls, a bisect and an uncontended lock. Metrics are collected
+in the module level `REGISTRY`, and `render` produces the text served by the
+`/metrics` route.
+
+Every pipeline stage records to the `pdcam_stage_seconds` histogram, with a
+`stage` label:
+
+* capture: Reading a frame from the source
+* enhance, detect, refine: Tag detection (see `pdcam.grid.find_fiducials`)
+* match, homography: Fitting the grid transform to the tags
+* motion, filter: Motion check and transform smoothing
+* locate: Everything done for one frame by the locator
+* markup, rectify, encode: Drawing markup on, warping to the board view,
+  and JPEG encoding a frame
+* sample: Computing per-electrode statistics
+"""
+import bisect
+import threading
+import time
+
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, plus their count and sum
+    """
+    type = 'histogram'
+
+    def __init__(self, name, labels=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager recording the time spent in its block, in seconds"""
+        return _Timer(self)
+
+    def snapshot(self):
+        """Return (cumulative bucket counts, count, sum)"""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        n = 0
+        for c in counts:
+            n += c
+            cumulative.append(n)
+        return cumulative, n, total
+
+    def samples(self):
+        cumulative, count, total = self.snapshot()
+        for le, n in zip(self.buckets + (float('inf'),), cumulative):
+            labels = dict(self.labels, le=_format_value(le))
+            yield self.name + "_bucket", labels, n
+        yield self.name + "_count", self.labels, count
+        yield self.name + "_sum", self.labels, total
+
+
+class Counter(object):
+    """A monotonically increasing count
+    """
+    type = 'counter'
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Registry(object):
+    """A collection of named metrics
+
+    Metrics are identified by name and labels; asking for the same metric
+    twice returns the same object, so modules can look up their metrics once
+    at import time.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = cls(name, labels, **kwargs)
+                self.metrics[key] = metric
+                self.help.setdefault(name, help)
+            elif not isinstance(metric, cls):
+                raise ValueError("Metric %s is already registered as a %s" % (name, metric.type))
+            return metric
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def render(self, extra=()):
+        """Render every metric in the Prometheus text exposition format
+
+        Arguments:
+        * extra: Additional (name, help, type, labels, value) samples, for
+            gauges which are read at scrape time rather than recorded
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+            helps = dict(self.help)
+
+        families = {}
+        for metric in metrics:
+            family = families.setdefault(metric.name, (metric.type, helps.get(metric.name, ""), []))
+            family[2].extend(metric.samples())
+        for name, help, type, labels, value in extra:
+            family = families.setdefault(name, (type, help, []))
+            family[2].append((name, labels, value))
+
+        lines = []
+        for name in sorted(families):
+            type, help, samples = families[name]
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            for sample_name, labels, value in samples:
+                lines.append("%s%s %s" % (sample_name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def stage_timer(stage):
+    """Get the `pdcam_stage_seconds` histogram for a pipeline stage"""
+    return REGISTRY.histogram('pdcam_stage_seconds', "Time spent in each pipeline stage", stage=stage)
+
+
+def render(extra=()):
+    return REGISTRY.render(extra)
@@ -1,36 +1,75 @@
 import cv2
+import functools
 import numpy as np
-from matplotlib.collections import PatchCollection
-from matplotlib.patches import Polygon
+
+MARGIN = 0.15
+
+def _layout_key(layout):
+    return tuple(tuple(row) for row in layout)
+
+@functools.lru_cache(maxsize=16)
+def _template_cells(layout_key):
+    """Grid coordinates of each electrode in a layout, and the corners of its
+    polygon in grid coordinates as an (N, 4, 2) array
+    """
+    coords = [
+        (x, y)
+        for y in range(len(layout_key))
+        for x in range(len(layout_key[0]))
+        if layout_key[y][x] is not None
+    ]
+    offsets = np.array([
+        (MARGIN, MARGIN),
+        (1 - MARGIN, MARGIN),
+        (1 - MARGIN, 1 - MARGIN),
+        (MARGIN, 1 - MARGIN),
+    ])
+    corners = np.array(coords, dtype=np.float64).reshape((-1, 1, 2)) + offsets
+    corners.setflags(write=False)
+    return coords, corners
+
+def _project_cells(layout_key, transform):
+    coords, corners = _template_cells(layout_key)
+    if len(coords) == 0:
+        return coords, np.empty((0, 4, 2))
+    # Project every corner of every electrode in one call
+    points = cv2.perspectiveTransform(corners.reshape((1, -1, 2)), transform)[0]
+    return coords, points.reshape((-1, 4, 2))
 
 def template_polygons(layout, transform):
-    MARGIN = 0.15
-    polygons = {}
-    for y in range(len(layout)):
-        for x in range(len(layout[0])):
-            if layout[y][x] is None:
-                continue
-
-            points = np.array([
-                (x+MARGIN, y+MARGIN), 
-                (x + 1 - MARGIN, y+MARGIN),
-                (x + 1 - MARGIN, y + 1 - MARGIN),
-                (x+MARGIN, y + 1 - MARGIN)
-            ])
-            points = cv2.perspectiveTransform(np.array([points]), transform)[0][:, 0:2]
-            polygons[(x, y)] = points
-    
-    return polygons
+    coords, points = _project_cells(_layout_key(layout), transform)
+    return dict(zip(coords, points))
+
+@functools.lru_cache(maxsize=16)
+def _template_polylines(layout_key, transform_bytes):
+    transform = np.frombuffer(transform_bytes, dtype=np.float64).reshape((3, 3))
+    _, points = _project_cells(layout_key, transform)
+    points = points.astype(np.int32)
+    points.setflags(write=False)
+    return points
+
+def template_polylines(layout, transform):
+    """Electrode polygons as an (N, 4, 2) int32 array, ready for `cv2.polylines`
+
+    Results are cached per layout and transform, so repeated calls while the
+    transform is unchanged cost only a lookup. The returned array is shared
+    and read-only.
+    """
+    transform = np.ascontiguousarray(transform, dtype=np.float64)
+    return _template_polylines(_layout_key(layout), transform.tobytes())
 
 def mark_template(img, layout, transform=None):
     if transform is None:
         transform = np.eye(3, 3)
-    polygons = template_polygons(layout, transform)
-
-    points = np.array(list(polygons.values()), dtype=np.int32)
+    points = template_polylines(layout, transform)
     cv2.polylines(img, points, True, (0, 0, 255), 3)
     
 def plot_template(ax, layout, highlights=None, transform=None):
+    # Imported here, so that the OpenCV drawing used by the server doesn't
+    # load matplotlib
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import Polygon
+
     if transform is None:
         transform = np.eye(3, 3)
     if highlights is None:
@@ -62,4 +101,60 @@ def mark_fiducial(img, polygon):
     cv2.line(img, (p[1][0], p[1][1]), (p[2][0], p[2][1]), (0, 0, 255), 2)
     cv2.line(img, (p[2][0], p[2][1]), (p[3][0], p[3][1]), (0, 0, 255), 2)
     cv2.line(img, (p[3][0], p[3][1]), (p[0][0], p[0][1]), (0, 0, 255), 2)
-    cv2.circle(img, (p[0][0], p[0][1]), 3, (0, 255, 0), 3)
\ No newline at end of file
+    cv2.circle(img, (p[0][0], p[0][1]), 3, (0, 255, 0), 3)
+
+class Overlay(object):
+    """Markup pre-rendered once, to be composited onto many frames
+
+    Only the bounding box of the drawn pixels is stored, along with a mask of
+    which pixels within it were drawn.
+    """
+    def __init__(self, image, mask, origin):
+        self.image = image
+        self.mask = mask
+        self.origin = origin
+
+    def apply(self, img):
+        """Draw the overlay onto `img` in place"""
+        if self.image is None:
+            return
+        x, y = self.origin
+        h, w = self.mask.shape
+        cv2.copyTo(self.image, self.mask, img[y:y+h, x:x+w])
+
+def render_overlay(shape, layout, transform, fiducials):
+    """Render fiducial outlines and the electrode template into an Overlay
+
+    Arguments:
+    * shape: Shape of the frames the overlay will be applied to
+    * layout: Electrode layout
+    * transform: Grid transform, or None to draw only the fiducials
+    * fiducials: List of fiducial corner lists
+    """
+    polylines = None
+    points = [np.array(fiducials, dtype=np.float64).reshape((-1, 2))]
+    if transform is not None:
+        polylines = template_polylines(layout, transform)
+        points.append(polylines.reshape((-1, 2)))
+    points = np.concatenate(points)
+    if len(points) == 0:
+        return Overlay(None, None, (0, 0))
+
+    # Only render the region covered by the markup, with room for line widths
+    pad = 8
+    x0 = int(np.clip(np.min(points[:, 0]) - pad, 0, shape[1]))
+    y0 = int(np.clip(np.min(points[:, 1]) - pad, 0, shape[0]))
+    x1 = int(np.clip(np.max(points[:, 0]) + pad + 1, 0, shape[1]))
+    y1 = int(np.clip(np.max(points[:, 1]) + pad + 1, 0, shape[0]))
+    if x1 <= x0 or y1 <= y0:
+        return Overlay(None, None, (0, 0))
+
+    canvas = np.zeros((y1 - y0, x1 - x0, shape[2]), dtype=np.uint8)
+    for corners in fiducials:
+        mark_fiducial(canvas, [(p[0] - x0, p[1] - y0) for p in corners])
+    if polylines is not None:
+        cv2.polylines(canvas, polylines - np.array([x0, y0], dtype=np.int32), True, (0, 0, 255), 3)
+
+    # Saturating sum of the channels, so any non-zero pixel is in the mask
+    mask = cv2.transform(canvas, np.ones((1, shape[2])))
+    return Overlay(canvas, mask, (x0, y0))
@@ -0,0 +1,360 @@
+"""Grid locating in a pool of worker processes
+
+A single locator thread handles one frame at a time, so it uses only one core.
+The apriltag detector is called through ctypes, which releases the GIL, but the
+Python-side tag matching and RANSAC around it still hold it, so several locator
+threads would partly serialize; each `apriltag.Detector` also keeps native
+state which isn't safe to share between threads. `ProcessGridLocate` is a
+drop-in replacement for `pdcam.video.AsyncGridLocate` which instead runs one
+`GridLocator`, with its own detector, in each of several worker processes.
+Frames are passed to workers through shared memory buffers, so only the buffer
+index and frame number are pickled. Several boards, e.g. one per camera, can
+share a single `LocatePool`.
+"""
+import multiprocessing
+import numpy as np
+import threading
+import time
+from multiprocessing import shared_memory
+
+from pdcam import metrics
+from pdcam.grid import NO_SOLUTION, Fiducial, GridLocator
+from pdcam.smoothing import HomographyFilter
+
+_locate_age = metrics.REGISTRY.histogram(
+    'pdcam_locate_age_seconds', "Age of a frame when its grid locate result is published")
+_locate_results = {
+    result: metrics.REGISTRY.counter('pdcam_locate_total', "Frames processed by the grid locator, by result", result=result)
+    for result in ('found', 'failed', 'stale', 'skipped')
+}
+
+
+def _worker_entry(references, shm_name, shape, nslots, tasks, results, track, refresh_frames, decimate):
+    # Spawned workers share the parent's resource tracker, so attaching
+    # doesn't cause the buffer to be unlinked when a worker exits
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = np.ndarray((nslots,) + shape, dtype=np.uint8, buffer=shm.buf)
+    # One locator per board, so that each keeps its own tracking state
+    locators = [
+        GridLocator(reference, track=track, refresh_frames=refresh_frames, decimate=decimate)
+        for reference in references
+    ]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, index, frame_number = task
+            try:
+                transform, fiducials = locators[index].find_grid_transform(buffers[slot])
+                solution = locators[index].last_solution
+            except Exception as ex:
+                print("Grid locate failed on frame %d: %s" % (frame_number, ex))
+                transform, fiducials, solution = None, [], NO_SOLUTION
+            results.put((slot, index, frame_number, solution, [(f.corners, f.label) for f in fiducials]))
+    finally:
+        del buffers
+        shm.close()
+
+
+class LocatePool(object):
+    """A pool of worker processes locating grids for one or more boards
+
+    Each board, identified by its reference, is located through a
+    `ProcessGridLocate` client from `client()`. The workers and shared memory
+    buffers are shared by all of the clients, so the CPU used for locating is
+    bounded by the number of workers however many cameras there are. When
+    several clients have a pending image, a free worker takes them in turn.
+
+    Arguments:
+    * references: GridReference of each board which will be located
+    * workers: Number of worker processes
+    * shape: Shape of the images which will be pushed
+    * track, refresh_frames, decimate: See GridLocator
+    """
+    def __init__(self, references, workers, shape, track=False, refresh_frames=10, decimate=1):
+        self.references = list(references)
+        self.clients = [None] * len(self.references)
+        self.next_client = 0
+
+        self.shape = tuple(shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=workers * int(np.prod(shape)))
+        self.buffers = np.ndarray((workers,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.free_slots = list(range(workers))
+        # Capture timestamps of frames in flight, by slot
+        self.slot_timestamps = {}
+        self.running = True
+        self.cv = threading.Condition()
+
+        # Workers are spawned rather than forked, since forking a process
+        # which is running other threads (and OpenCV) isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_worker_entry,
+                args=(self.references, self.shm.name, self.shape, workers, self.tasks, self.results,
+                      track, refresh_frames, decimate),
+                daemon=True)
+            for _ in range(workers)
+        ]
+        for w in self.workers:
+            w.start()
+
+        self.dispatch_thread = threading.Thread(target=self.dispatch_thread_entry, daemon=True)
+        self.dispatch_thread.start()
+        self.result_thread = threading.Thread(target=self.result_thread_entry, daemon=True)
+        self.result_thread.start()
+
+    def client(self, grid_reference, callback=None, timeout_frames=3, smooth=False):
+        """Create the ProcessGridLocate for one of the pool's references
+        """
+        for index, reference in enumerate(self.references):
+            if reference is grid_reference:
+                break
+        else:
+            raise ValueError("Reference is not one of the pool's references")
+        with self.cv:
+            if self.clients[index] is not None:
+                raise ValueError("Reference %d already has a client" % index)
+            client = ProcessGridLocate(
+                grid_reference, callback=callback, timeout_frames=timeout_frames, smooth=smooth, pool=self)
+            client.index = index
+            self.clients[index] = client
+        return client
+
+    def stop(self):
+        """Stop the worker processes and threads, waiting for any images in progress
+        """
+        with self.cv:
+            self.running = False
+            self.cv.notify_all()
+        self.dispatch_thread.join()
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join()
+        self.results.put(None)
+        self.result_thread.join()
+        for client in self.clients:
+            if client is not None:
+                client.drop_pending()
+        del self.buffers
+        self.shm.close()
+        self.shm.unlink()
+
+    def _has_pending(self):
+        return any(c is not None and c.pending_image is not None for c in self.clients)
+
+    def _next_pending(self):
+        """Get the next client with a pending image, in turn; must hold cv"""
+        n = len(self.clients)
+        for i in range(n):
+            index = (self.next_client + i) % n
+            client = self.clients[index]
+            if client is not None and client.pending_image is not None:
+                self.next_client = (index + 1) % n
+                return client
+        return None
+
+    def dispatch_thread_entry(self):
+        while True:
+            with self.cv:
+                self.cv.wait_for(lambda: not self.running or (len(self.free_slots) > 0 and self._has_pending()))
+                if not self.running:
+                    return
+                client = self._next_pending()
+                img = client.pending_image
+                frame_number, timestamp = client.pending_frame
+                release = client.pending_release
+                client.pending_image = None
+                client.pending_release = None
+                slot = self.free_slots.pop()
+                self.slot_timestamps[slot] = timestamp
+
+            # The only copy of the frame; the borrowed image is released as
+            # soon as it's in shared memory
+            try:
+                np.copyto(self.buffers[slot], img)
+            finally:
+                if release is not None:
+                    release()
+            client.detect_count += 1
+            self.tasks.put((slot, client.index, frame_number))
+
+    def result_thread_entry(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            slot, index, frame_number, solution, fiducials = result
+            with self.cv:
+                timestamp = self.slot_timestamps.pop(slot)
+                self.free_slots.append(slot)
+                self.cv.notify_all()
+                client = self.clients[index]
+            if client is not None:
+                client.on_result(frame_number, timestamp, solution, fiducials)
+
+
+class ProcessGridLocate(object):
+    """Locates the grid in images using a pool of worker processes
+
+    Has the same interface as `AsyncGridLocate`. Each pushed image is copied
+    into a free shared memory buffer as soon as a worker is idle, and the
+    borrowed image released. As with AsyncGridLocate, images pushed while
+    every worker is busy replace the pending image rather than queueing.
+
+    Results can complete out of order; a result is published only if it is
+    for a newer frame than the last one published, so the published transform
+    is always the newest completed one. Smoothing is applied in frame order in
+    this process. Motion gating isn't supported, since each worker sees only
+    some of the frames.
+
+    By default a LocatePool is created for just this locator, and stopped
+    with it. Locators sharing a pool with other boards are created with
+    `LocatePool.client`.
+
+    Arguments:
+    * grid_reference: Reference for the board to locate
+    * workers: Number of worker processes
+    * shape: Shape of the images which will be pushed
+    * callback, timeout_frames, track, refresh_frames, decimate, smooth,
+        retry_period, max_retry_period: See AsyncGridLocate
+    * pool: Existing LocatePool, in place of workers, shape, track,
+        refresh_frames and decimate
+    """
+    def __init__(self, grid_reference, workers=None, shape=None, callback=None, timeout_frames=3, track=False,
+                 refresh_frames=10, decimate=1, smooth=False, pool=None, retry_period=0.05, max_retry_period=0.5):
+        self.callback = callback
+        self.grid_reference = grid_reference
+        self.timeout_frames = timeout_frames
+        self.fail_count = 0
+        # Whether the latest detection found no transform. Unlike fail_count,
+        # this isn't reset by a transform predicted by the filter.
+        self.detect_failed = False
+        self.filter = None
+        if smooth and len(grid_reference.control_points) >= 4:
+            self.filter = HomographyFilter.from_reference(grid_reference)
+        self.detect_count = 0
+        self.skip_count = 0
+        self.stale_count = 0
+        self.latest_result = (None, [])
+        self.latest_frame = (0, None)
+        self.latest_solution = NO_SOLUTION
+        # Newest frame number for which any result has been received
+        self.latest_completed = 0
+        self.retry_period = retry_period
+        self.max_retry_period = max_retry_period
+        self.retry_delay = 0.0
+        self.next_retry_time = 0.0
+        self.lock = threading.Lock()
+
+        self.pending_image = None
+        self.pending_frame = (0, None)
+        self.pending_release = None
+
+        self.owns_pool = pool is None
+        if self.owns_pool:
+            pool = LocatePool([grid_reference], workers, shape, track, refresh_frames, decimate)
+            self.index = 0
+            pool.clients[0] = self
+        self.pool = pool
+
+    def push(self, image, frame_number=0, timestamp=None, release=None):
+        """Push a new image to be processed
+
+        See `AsyncGridLocate.push`. After a failed detection, images are
+        dropped until it's time to retry.
+        """
+        with self.lock:
+            backing_off = self.detect_failed and time.monotonic() < self.next_retry_time
+        if backing_off:
+            self.skip_count += 1
+            _locate_results['skipped'].inc()
+            if release is not None:
+                release()
+            return
+        with self.pool.cv:
+            dropped_release = self.pending_release
+            self.pending_image = image
+            self.pending_frame = (frame_number, timestamp)
+            self.pending_release = release
+            self.pool.cv.notify_all()
+        if dropped_release is not None:
+            dropped_release()
+
+    def drop_pending(self):
+        """Release the pending image, if any"""
+        with self.pool.cv:
+            release = self.pending_release
+            self.pending_image = None
+            self.pending_release = None
+        if release is not None:
+            release()
+
+    def stop(self):
+        """Stop locating, and release the pending image
+
+        If the pool belongs to this locator, it is stopped too, waiting for
+        any images in progress. Otherwise, the pool's results for this board
+        are ignored from now on.
+        """
+        if self.owns_pool:
+            self.pool.stop()
+        else:
+            with self.pool.cv:
+                self.pool.clients[self.index] = None
+            self.drop_pending()
+
+    def latest(self):
+        with self.lock:
+            transform, fiducials = self.latest_result
+
+        return transform, fiducials
+
+    def on_result(self, frame_number, timestamp, solution, fiducials):
+        """Handle a result from a worker; called on the pool's result thread
+        """
+        transform = solution.transform
+        if frame_number <= self.latest_completed:
+            # A newer frame has already been located by another worker
+            self.stale_count += 1
+            _locate_results['stale'].inc()
+            return
+        self.latest_completed = frame_number
+        _locate_results['found' if transform is not None else 'failed'].inc()
+
+        fiducials = [Fiducial(corners, label) for corners, label in fiducials]
+        t = timestamp if timestamp is not None else time.monotonic()
+        if self.filter is not None:
+            if transform is not None:
+                transform = self.filter.update(transform, t)
+            else:
+                transform = self.filter.predict(t)
+        if timestamp is not None:
+            _locate_age.observe(time.monotonic() - timestamp)
+
+        frame = (frame_number, timestamp)
+        with self.lock:
+            self.detect_failed = solution.transform is None
+            if not self.detect_failed:
+                self.retry_delay = 0.0
+            else:
+                self.retry_delay = min(max(self.retry_delay * 2, self.retry_period), self.max_retry_period)
+                self.next_retry_time = time.monotonic() + self.retry_delay
+            if transform is not None:
+                self.fail_count = 0
+                self.latest_result = (transform, fiducials)
+                self.latest_frame = frame
+                self.latest_solution = solution
+            else:
+                self.fail_count += 1
+                if self.fail_count > self.timeout_frames:
+                    self.latest_result = (transform, fiducials)
+                    self.latest_frame = frame
+                    self.latest_solution = solution
+
+        if self.callback is not None:
+            self.callback(transform, fiducials)
@@ -0,0 +1,308 @@
+"""Recording sessions: captured frames with the transform used for each
+
+A session is a single preallocated file, written and read through a memory
+map. It holds a fixed size header, an index with one fixed size record per
+frame, and a data region holding each frame as raw BGR pixels or JPEG bytes:
+
+    [header (4 kB)][index: max_frames records][data]
+
+The index records the frame number, capture time, data location, and the
+grid transform and fiducials which were current when the frame was recorded,
+so any frame can be found and read without scanning the file. The frame
+count in the header is updated after each frame's data and index record are
+written, so a session can be read while it is still being recorded. Unused
+preallocated space is truncated when the writer is closed.
+"""
+import collections
+import cv2
+import json
+import numpy as np
+import os
+
+from pdcam.grid import Fiducial
+from pdcam.sources import FrameSource, copy_frame
+
+MAGIC = b'PDCAMREC'
+VERSION = 1
+HEADER_SIZE = 4096
+# Fiducials stored per frame; any more are dropped
+MAX_FIDUCIALS = 16
+ENCODINGS = ('raw', 'jpeg')
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('encoding', '<u4'),
+    ('max_frames', '<u8'),
+    ('data_offset', '<u8'),
+    ('data_size', '<u8'),
+    ('count', '<u8'),
+    ('data_end', '<u8'),
+    ('metadata_size', '<u4'),
+])
+
+INDEX_DTYPE = np.dtype([
+    ('frame', '<i8'),
+    ('timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('transform', '<f8', (3, 3)),
+    ('transform_frame', '<i8'),
+    ('error', '<f4'),
+    ('num_fiducials', '<u4'),
+    ('labels', '<i4', (MAX_FIDUCIALS,)),
+    ('corners', '<f4', (MAX_FIDUCIALS, 4, 2)),
+])
+
+RecordedFrame = collections.namedtuple(
+    'RecordedFrame', ['frame', 'timestamp', 'image', 'transform', 'transform_frame', 'error', 'fiducials'])
+
+
+def _align(n, alignment=4096):
+    return (n + alignment - 1) // alignment * alignment
+
+
+class SessionWriter(object):
+    """Appends frames to a new session file
+
+    Arguments:
+    * path: File to create (overwritten if it exists)
+    * width, height: Frame size
+    * max_frames: Number of index records to preallocate
+    * encoding: 'raw' to store BGR pixels, or 'jpeg' to store JPEG bytes
+    * data_size: Bytes to preallocate for frame data. Defaults to room for
+        `max_frames` raw frames, or a quarter of that for JPEG.
+    * metadata: JSON serializable dict stored in the header, e.g. the
+        reference and layout
+    """
+    def __init__(self, path, width, height, max_frames, encoding='jpeg', data_size=None, metadata=None):
+        if encoding not in ENCODINGS:
+            raise ValueError("encoding must be one of %s" % ", ".join(ENCODINGS))
+        self.path = path
+        self.shape = (height, width, 3)
+        self.frame_bytes = width * height * 3
+        self.raw = encoding == 'raw'
+        if data_size is None:
+            data_size = max_frames * self.frame_bytes
+            if not self.raw:
+                data_size //= 4
+        metadata = json.dumps(metadata or {}).encode()
+        if HEADER_DTYPE.itemsize + len(metadata) > HEADER_SIZE:
+            raise ValueError("Session metadata is too large")
+        data_offset = _align(HEADER_SIZE + max_frames * INDEX_DTYPE.itemsize)
+
+        # Extending the file with truncate leaves it sparse, so preallocating
+        # costs no disk space until frames are written
+        with open(path, 'wb') as f:
+            f.truncate(data_offset + data_size)
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r+')
+        self.header = self.mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        self.index = self.mm[HEADER_SIZE:HEADER_SIZE + max_frames * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        self.data = self.mm[data_offset:]
+
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['width'] = width
+        self.header['height'] = height
+        self.header['encoding'] = ENCODINGS.index(encoding)
+        self.header['max_frames'] = max_frames
+        self.header['data_offset'] = data_offset
+        self.header['data_size'] = data_size
+        self.header['metadata_size'] = len(metadata)
+        self.mm[HEADER_DTYPE.itemsize:HEADER_DTYPE.itemsize + len(metadata)] = np.frombuffer(metadata, dtype=np.uint8)
+        self.count = 0
+        self.data_end = 0
+
+    def full(self, size=None):
+        """Whether there is no room for another frame of `size` bytes"""
+        if size is None:
+            size = self.frame_bytes
+        return self.count >= len(self.index) or self.data_end + size > len(self.data)
+
+    def append(self, frame_number, timestamp, image=None, jpeg=None, transform=None, transform_frame=0,
+               error=None, fiducials=()):
+        """Append a frame
+
+        Raw sessions take the BGR `image`, which is copied straight into the
+        mapped file; JPEG sessions take the encoded `jpeg` bytes. The transform
+        and fiducials are those in use when the frame was captured, found in
+        frame `transform_frame`.
+
+        Returns False, without writing anything, if the session is full.
+        """
+        if self.mm is None:
+            raise ValueError("Session is closed")
+        if self.raw:
+            size = self.frame_bytes
+        else:
+            jpeg = np.frombuffer(jpeg, dtype=np.uint8)
+            size = len(jpeg)
+        if self.full(size):
+            return False
+
+        offset = self.data_end
+        if self.raw:
+            np.copyto(self.data[offset:offset + size].reshape(self.shape), image)
+        else:
+            self.data[offset:offset + size] = jpeg
+
+        record = self.index[self.count]
+        record['frame'] = frame_number
+        record['timestamp'] = timestamp if timestamp is not None else np.nan
+        record['offset'] = offset
+        record['size'] = size
+        record['transform'] = transform if transform is not None else np.nan
+        record['transform_frame'] = transform_frame
+        record['error'] = error if error is not None else np.nan
+        fiducials = fiducials[:MAX_FIDUCIALS]
+        record['num_fiducials'] = len(fiducials)
+        for i, f in enumerate(fiducials):
+            record['labels'][i] = f.label if isinstance(f.label, (int, np.integer)) else -1
+            record['corners'][i] = f.corners
+
+        # Publish the frame to readers only once it is complete
+        self.count += 1
+        self.data_end += size
+        self.header['data_end'] = self.data_end
+        self.header['count'] = self.count
+        return True
+
+    def close(self):
+        """Flush the session, and truncate the unused preallocated space"""
+        if self.mm is None:
+            return
+        self.mm.flush()
+        end = int(self.header['data_offset']) + self.data_end
+        del self.header, self.index, self.data
+        self.mm = None
+        os.truncate(self.path, end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SessionReader(object):
+    """Random access to the frames of a session file
+
+    Frames are read through a memory map, so opening a session and reading a
+    frame costs only the pages of that frame. Raw frames are returned as
+    read-only views of the file, without copying.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = np.memmap(path, dtype=np.uint8, mode='r')
+        self.header = self.mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if self.header['magic'] != MAGIC:
+            raise ValueError("%s is not a recording session" % path)
+        if self.header['version'] != VERSION:
+            raise ValueError("Unsupported session version %d" % self.header['version'])
+        self.width = int(self.header['width'])
+        self.height = int(self.header['height'])
+        self.encoding = ENCODINGS[self.header['encoding']]
+        max_frames = int(self.header['max_frames'])
+        self.index = self.mm[HEADER_SIZE:HEADER_SIZE + max_frames * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        self.data = self.mm[int(self.header['data_offset']):]
+        metadata_size = int(self.header['metadata_size'])
+        self.metadata = json.loads(
+            self.mm[HEADER_DTYPE.itemsize:HEADER_DTYPE.itemsize + metadata_size].tobytes().decode())
+
+    def __len__(self):
+        # Re-read each time, since the session may still be being recorded
+        return int(self.header['count'])
+
+    def records(self):
+        """Index records of all frames recorded so far (see `INDEX_DTYPE`)"""
+        return self.index[:len(self)]
+
+    def find(self, frame_number):
+        """Get the position of a frame number in the session, or None if it
+        wasn't recorded"""
+        frames = self.index['frame'][:len(self)]
+        i = int(np.searchsorted(frames, frame_number))
+        if i < len(frames) and frames[i] == frame_number:
+            return i
+        return None
+
+    def data_bytes(self, i):
+        """The stored pixels or JPEG bytes of the `i`th frame, as a view"""
+        record = self.index[i]
+        offset = int(record['offset'])
+        return self.data[offset:offset + int(record['size'])]
+
+    def image(self, i):
+        """The BGR image of the `i`th frame"""
+        if not 0 <= i < len(self):
+            raise IndexError("Frame %d out of range" % i)
+        data = self.data_bytes(i)
+        if self.encoding == 'raw':
+            return data.reshape((self.height, self.width, 3))
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    def read(self, i):
+        """Read the `i`th frame as a RecordedFrame"""
+        image = self.image(i)
+        record = self.index[i]
+        transform = record['transform']
+        n = int(record['num_fiducials'])
+        fiducials = [Fiducial(c.tolist(), int(l)) for l, c in zip(record['labels'][:n], record['corners'][:n])]
+        return RecordedFrame(
+            int(record['frame']),
+            float(record['timestamp']),
+            image,
+            None if np.isnan(transform).any() else np.array(transform),
+            int(record['transform_frame']),
+            None if np.isnan(record['error']) else float(record['error']),
+            fiducials,
+        )
+
+    def close(self):
+        del self.header, self.index, self.data
+        self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SessionSource(FrameSource):
+    """Replays the frames of a recorded session
+
+    Arguments:
+    * path: Session file
+    * fps: Frame rate to replay at, or None to replay as fast as possible
+    * loop: Restart from the beginning at the end of the session
+    """
+    def __init__(self, width, height, path, fps=30, loop=True):
+        super().__init__(width, height, fps)
+        self.path = path
+        self.loop = loop
+        self.reader = None
+        self.index = 0
+
+    def open(self):
+        self.reader = SessionReader(self.path)
+        if len(self.reader) == 0:
+            raise ValueError("No frames recorded in %s" % self.path)
+        self.index = 0
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def read(self, out):
+        if self.index >= len(self.reader):
+            if not self.loop:
+                return False
+            self.index = 0
+        copy_frame(self.reader.image(self.index), out, self.flip)
+        self.index += 1
+        self.throttle()
+        return True
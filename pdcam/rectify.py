@@ -0,0 +1,77 @@
+"""Rectified, top-down views of the electrode board
+"""
+import cv2
+import numpy as np
+import threading
+
+
+class BoardRectifier(object):
+    """Warps camera frames into electrode grid coordinates with cached remap tables
+
+    The output image is a fixed size, with each electrode grid cell covering
+    `pixels_per_electrode` pixels square. The remap tables for the current
+    transform are built once, and only rebuilt when the transform moves the
+    board corners by more than `tolerance` pixels, so that warping each frame
+    is a single `cv2.remap` with fixed-point maps.
+
+    Arguments:
+    * layout: Electrode layout, which sets the grid size
+    * pixels_per_electrode: Output pixels per grid cell
+    * margin: Border around the grid, in grid cells
+    * tolerance: Transform change, in image pixels, which triggers rebuilding the maps
+    """
+    def __init__(self, layout, pixels_per_electrode=32, margin=0.5, tolerance=0.25):
+        self.ppe = pixels_per_electrode
+        self.margin = margin
+        self.tolerance = tolerance
+        rows = len(layout)
+        cols = len(layout[0]) if rows > 0 else 0
+        self.size = (int(round((cols + 2 * margin) * self.ppe)), int(round((rows + 2 * margin) * self.ppe)))
+        # Output pixel to grid coordinates, sampling at pixel centers
+        s = 1.0 / self.ppe
+        self.output_to_grid = np.array([
+            [s, 0, 0.5 * s - margin],
+            [0, s, 0.5 * s - margin],
+            [0, 0, 1],
+        ])
+        w, h = self.size
+        self.corners = np.array([[[0, 0], [w, 0], [w, h], [0, h]]], dtype=np.float64)
+        self.lock = threading.Lock()
+        # (projected corners, map1, map2) for the transform the maps were built for
+        self.cache = None
+        self.rebuild_count = 0
+
+    def _build(self, transform):
+        H = np.dot(transform, self.output_to_grid)
+        w, h = self.size
+        grid = np.mgrid[0:h, 0:w].astype(np.float32)
+        points = np.dstack([grid[1], grid[0]]).reshape((1, -1, 2))
+        src = cv2.perspectiveTransform(points, H).reshape((h, w, 2))
+        return cv2.convertMaps(src, None, cv2.CV_16SC2)
+
+    def maps(self, transform):
+        """Get the remap tables for a grid transform, rebuilding them only if
+        it has moved"""
+        corners = cv2.perspectiveTransform(self.corners, np.dot(transform, self.output_to_grid))
+        with self.lock:
+            if self.cache is not None and np.max(np.abs(self.cache[0] - corners)) <= self.tolerance:
+                return self.cache[1], self.cache[2]
+        map1, map2 = self._build(transform)
+        with self.lock:
+            self.cache = (corners, map1, map2)
+            self.rebuild_count += 1
+        return map1, map2
+
+    def rectify(self, image, transform, out=None):
+        """Warp `image` into grid coordinates
+
+        Returns a blank image if `transform` is None.
+        """
+        w, h = self.size
+        if out is None:
+            out = np.empty((h, w) + image.shape[2:], dtype=image.dtype)
+        if transform is None:
+            out[:] = 0
+            return out
+        map1, map2 = self.maps(transform)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=out, borderMode=cv2.BORDER_CONSTANT)
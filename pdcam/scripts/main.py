@@ -1,81 +1,16 @@
 import click
 import cv2
 import json
-import matplotlib.pyplot as plt
-from pyzbar.pyzbar import decode
+import time
 
 from pdcam.grid import find_fiducials, find_grid_transform, GridReference
+from pdcam.layouts import (
+    ELECTRODE_LAYOUT_v3, ELECTRODE_LAYOUT_v4, ELECTRODE_LAYOUT_v4_1, ELECTRODE_LAYOUT_v5,
+    CONTROL_ELECTRODES_v3, CONTROL_ELECTRODES_v4, CONTROL_ELECTRODES_v4_1, CONTROL_ELECTRODES_v5,
+)
 from pdcam.plotting import mark_fiducial, plot_template
 
 
-# TODO: Read this from config file or lookup in database based on QR code content
-
-ELECTRODE_LAYOUT_v3 = [
-  [ None, None, None, None, None, None,  None,  None, None, 113, 113],
-  [ None, None, None, None, None, 16,  14,  17, 110, 110, 113],
-  [13, 18, 12, 19, 111, 112, 115, 108, None, 113, 113],
-  [11, 20, 10, 21, 109, 114, 116, 106, None, None, None],
-  [ 9, 22,  8, 23, 107, 117, 105, 119, None, 104, 118],
-  [ 5, 26,  4, 27,   7,  24,   6,  25, 120, 102, 121],
-  [ 3, 28,  2, 29, 103, 101, 122, 100, None, 123, 125],
-  [ 1, 30,  0, 31,  99, 124,  98, 127, None, None, None],
-  [63, 32, 62, 33,  97, 126,  96,  65, None,  92,  67],
-  [61, 34, 60, 35,  95,  64,  94,  93,  66,  90,  69],
-  [59, 36, 58, 37,  91,  68,  89,  70, None,  88,  71],
-  [57, 38, 56, 39,  87,  72,  86,  73, None, None, None],
-  [53, 42, 52, 43,  55,  40,  54,  41,  74,  84,  75],
-  [51, 44, 50, 45,  78,  81,  85,  83,  76,  82,  77],
-  [46, None, None, None, None,  47, None, None, None, None,  80],
-  [49, None, None, None, None,  48, None, None, None, None,  79],
-]
-
-# The coordinates of electrodes to solicit user provided control points during
-# `measure` command
-CONTROL_ELECTRODES_v3 = [(0, 2), (0, 15), (5, 15), (10, 15), (8, 5)]
-
-ELECTRODE_LAYOUT_v4 =  [
-    [None, None, None, None, None, None, 28, 98, None, None, None, None, None, None],
-    [None, None, None, None, None, None, 27, 99, None, None, None, None, None, None],
-    [11, 14, 16, 18, 20, 23, 26, 100, 102, 105, 109, 111, 113, 114],
-    [12, 13, 15, 17, 19, 22, 25, 101, 104, 107, 110, 112, 115, 116],
-    [5, 6, 7, 4, 3, 21, 24, 103, 108, 126, 125, 122, 123, 124],
-    [0, 63, 62, 1, 2, 55, 46, 68, 106, 127, 64, 67, 66, 65],
-    [60, 61, 54, 49, 51, 48, 44, 69, 82, 81, 79, 77, 76, 75],
-    [53, 50, 47, 45, 42, 41, 43, 87, 86, 85, 84, 83, 80, 78],
-    [None, None, None, None, None, None, 40, 88, None, None, None, None, None, None],
-    [None, None, None, None, None, None, 39, 89, None, None, None, None, None, None],
-    [None, None, None, None, None, None, 38, 90, None, None, None, None, None, None],
-]
-CONTROL_ELECTRODES_v4 = [(0, 2), (0, 7), (7, 1), (7,10), (13, 2), (13, 7)]
-
-ELECTRODE_LAYOUT_v4_1 = [
-    [  1,  2,  3,  4,  5,  6,  7,  8,  9, 10],
-    [ 11, 12, 13, 14, 15, 16, 17, 18, 19, 20],
-    [ 21, 22, 23, 24, 25, 26, 27, 28, 29, 30],
-    [ 31, 32, 33, 34, 35, 36, 37, 38, 39, 40],
-    [ 41, 42, 43, 44, 45, 46, 47, 48, 49, 50],
-    [ 51, 52, 53, 54, 55, 56, 57, 58, 59, 60],
-    [ 61, 62, 63, 64, 65, 66, 67, 68, 69, 70],
-    [ 71, 72, 73, 74, 75, 76, 77, 78, 79, 80],
-    [ 81, 82, 83, 84, 85, 86, 87, 88, 89, 90],
-    [ None, None, None, None, 91, 92, None, None, None, None],
-    [ None, None, None, None, 93, 94, None, None, None, None],
-    [ None, None, None, None, 95, 96, None, None, None, None],
-    [ None, None, None, None, 97, 98, None, None, None, None]
-]
-CONTROL_ELECTRODES_v4_1 = [(0, 0), (0, 8), (9, 8), (9, 0)]
-
-ELECTRODE_LAYOUT_v5 = [
-    [ None,  7, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,120, None],
-    [ None,  1, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,126, None],
-    [ None,  0,  8,  9, 10, 11, 12, 13, 14, 15, 16,111,112,113,114,115,116,117,118,119,127, None],
-    [ None, 63, 55, 54, 53, 52, 51, 50, 49, 48, 47, 80, 79, 78, 77, 76, 75, 74, 73, 72, 64, None],
-    [ None, 62, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 65, None],
-    [ None, 56, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 71, None]
-]
-CONTROL_ELECTRODES_v5 = [(1, 0), (1, 5), (20, 0), (20, 5)]
-
-
 @click.group()
 def main():
     pass
@@ -84,25 +19,156 @@ def main():
 @click.option('--reference', required=False)
 @click.option('--v4', is_flag=True, default=False)
 @click.option('--flip', is_flag=True, default=False)
-def server(reference, v4, flip):
-    from pdcam.server import create_app
+@click.option('--asgi', is_flag=True, default=False, help="Serve with the asyncio server (requires uvicorn)")
+@click.option('--port', default=5000)
+@click.option('--source', default='picamera', help="Frame source: picamera, opencv:<device>, replay:<path>, session:<path> or synthetic[:<images>]")
+@click.option('--workers', default=0, help="Number of grid locating worker processes (0 locates on a thread)")
+@click.option('--cameras', required=False, help="JSON camera config file, to serve several cameras (see pdcam.cameras)")
+@click.option('--boards', required=False, help="Labelled reference file or directory, to identify the board in view (see pdcam.boards)")
+@click.option('--record', required=False, help="Record frames and transforms to a session file (see pdcam.recording)")
+@click.option('--record-frames', default=9000, help="Maximum number of frames to record")
+@click.option('--record-raw', is_flag=True, default=False, help="Record raw frames rather than JPEG")
+def server(reference, v4, flip, asgi, port, source, workers, cameras, boards, record, record_frames, record_raw):
+    from pdcam.boards import BoardRegistry
+    from pdcam.cameras import CameraConfig, CameraGroup, load_camera_configs
+    from pdcam.server import create_group_app
+    from pdcam.sources import source_from_spec
+    from pdcam.video import Video
 
-    electrode_layout = ELECTRODE_LAYOUT_v3
-    if v4:
-        electrode_layout = ELECTRODE_LAYOUT_v4
+    if cameras is not None:
+        configs = load_camera_configs(cameras)
+    else:
+        electrode_layout = ELECTRODE_LAYOUT_v3
+        if v4:
+            electrode_layout = ELECTRODE_LAYOUT_v4
+
+        if reference is not None:
+            with open(reference) as f:
+                reference = GridReference.from_dict(json.loads(f.read()))
+        source = source_from_spec(source, Video.WIDTH, Video.HEIGHT)
+        registry = None
+        if boards is not None:
+            registry = BoardRegistry.from_path(boards)
+            if len(registry) == 0:
+                raise click.ClickException("No labelled board references found in %s" % boards)
+        configs = [CameraConfig('0', reference, electrode_layout, flip, source, registry)]
+    if record is not None and len(configs) > 1:
+        raise click.ClickException("--record can only be used with a single camera")
+    group = CameraGroup(configs, workers)
+    if record is not None:
+        group.default.start_recording(record, record_frames, 'raw' if record_raw else 'jpeg')
+    try:
+        if asgi:
+            import uvicorn
+            from pdcam.asgi import create_asgi_app
+            app = create_asgi_app(group)
+            uvicorn.run(app, host="0.0.0.0", port=port)
+        else:
+            app = create_group_app(group)
+            app.run(host="0.0.0.0", port=port)
+    finally:
+        # Closes any recording session, truncating its unused space
+        group.stop()
+
+@main.command()
+@click.option('--reference', required=False)
+@click.option('--source', default='synthetic', help="Frame source: picamera, opencv:<device>, replay:<path>, session:<path> or synthetic[:<images>]")
+@click.option('--duration', default=10.0)
+@click.option('--clients', default=1, help="Number of simulated MJPEG clients")
+@click.option('--markup', is_flag=True, default=False)
+@click.option('--workers', default=0, help="Number of grid locating worker processes (0 locates on a thread)")
+def benchmark(reference, source, duration, clients, markup, workers):
+    """Measure end-to-end capture, locate and encode performance"""
+    from pdcam.benchmark import print_results, run_benchmark
+    from pdcam.sources import source_from_spec
+    from pdcam.video import Video
 
     if reference is not None:
         with open(reference) as f:
             reference = GridReference.from_dict(json.loads(f.read()))
     else:
         reference = GridReference([], [])
-    app = create_app(reference, electrode_layout, flip)
-    app.run(host="0.0.0.0")
+    video = Video(reference, ELECTRODE_LAYOUT_v4, source=source_from_spec(source, Video.WIDTH, Video.HEIGHT),
+                  locate_workers=workers)
+    results = run_benchmark(video, duration, clients, markup)
+    video.stop()
+    print_results(results)
+
+@main.command()
+@click.option('--baseline', default=None, help="Baseline file (default: benchmarks/<machine>.json)")
+@click.option('--save', is_flag=True, default=False, help="Save the results as the new baseline")
+@click.option('--tolerance', default=0.25, help="Allowed slowdown relative to the baseline, as a fraction")
+@click.option('--tests', default='tests', help="Path of the benchmark tests")
+def perfcheck(baseline, save, tolerance, tests):
+    """Run the benchmark suite, and compare it to a saved baseline
+
+    Exits with an error if any benchmark is slower than the baseline by more
+    than the tolerance. Run from the repository root.
+    """
+    import os
+    import platform
+    import subprocess
+    import sys
+    import tempfile
+    from pdcam.benchmark import compare_benchmarks, summarize_benchmarks
+
+    if baseline is None:
+        baseline = os.path.join('benchmarks', '%s.json' % platform.machine())
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report_path = os.path.join(tmpdir, 'report.json')
+        result = subprocess.run([
+            sys.executable, '-m', 'pytest', tests, '-q', '--benchmark-only', '--benchmark-json', report_path])
+        if result.returncode != 0:
+            raise click.ClickException("Benchmark tests failed")
+        with open(report_path) as f:
+            current = summarize_benchmarks(json.loads(f.read()))
+
+    if save:
+        os.makedirs(os.path.dirname(baseline) or '.', exist_ok=True)
+        with open(baseline, 'w') as f:
+            f.write(json.dumps(current, indent=2))
+        print("Saved baseline to %s" % baseline)
+        return
+
+    if not os.path.exists(baseline):
+        raise click.ClickException("No baseline at %s; create one with --save" % baseline)
+    with open(baseline) as f:
+        rows, regressions = compare_benchmarks(json.loads(f.read()), current, tolerance)
+
+    for name, old, new, ratio in rows:
+        print("%-50s %10.3f ms %10.3f ms %6.2fx" % (name, old * 1000, new * 1000, ratio))
+    if len(regressions) > 0:
+        raise click.ClickException("%d benchmarks regressed by more than %d%%" % (len(regressions), tolerance * 100))
+
+@main.command()
+@click.option('--reference', required=True)
+@click.option('--workers', default=None, type=int, help="Number of worker processes (default: one per CPU)")
+@click.option('--chunk-size', default=32, help="Number of consecutive frames given to a worker at a time")
+@click.option('--track', is_flag=True, default=False, help="Search for tags near their position in the previous frame")
+@click.option('--decimate', default=1, help="Downscale factor for tag detection")
+@click.argument('input')
+@click.argument('output')
+def batch(reference, workers, chunk_size, track, decimate, input, output):
+    """Locate the grid in every frame of an image directory or video file
+
+    Writes transforms, fiducial corners and per-frame timings to OUTPUT, a
+    NumPy .npz file (see pdcam.batch for the format).
+    """
+    from pdcam.batch import run_batch
+
+    with open(reference) as f:
+        refdata = json.loads(f.read())
+    start = time.monotonic()
+    n = run_batch(refdata, input, output, workers, chunk_size, track, decimate)
+    print("Processed %d frames in %.1fs" % (n, time.monotonic() - start))
 
 @main.command()
 @click.option('--reference')
 @click.argument('imagefile')
 def overlay(reference, imagefile):
+    import matplotlib.pyplot as plt
+
     img = cv2.cvtColor(cv2.imread(imagefile), cv2.COLOR_BGR2RGB)
 
     with open(reference) as f:
@@ -132,6 +198,8 @@ def overlay(reference, imagefile):
 @click.option('--v4_1', is_flag=True, default=False)
 @click.option('--v5', is_flag=True, default=False)
 def measure(imagefile, outfile, v4, v4_1, v5):
+    import matplotlib.pyplot as plt
+
     img = cv2.cvtColor(cv2.imread(imagefile), cv2.COLOR_BGR2RGB)
 
     fiducials = find_fiducials(img)
@@ -139,15 +207,19 @@ def measure(imagefile, outfile, v4, v4_1, v5):
         print(f)
         mark_fiducial(img, f.corners)
     
+    layout_name = 'v3'
     electrode_layout = ELECTRODE_LAYOUT_v3
     control_electrodes = CONTROL_ELECTRODES_v3
     if v4:
+        layout_name = 'v4'
         electrode_layout = ELECTRODE_LAYOUT_v4
         control_electrodes = CONTROL_ELECTRODES_v4
     elif v4_1:
+        layout_name = 'v4.1'
         electrode_layout = ELECTRODE_LAYOUT_v4_1
         control_electrodes = CONTROL_ELECTRODES_v4_1
     elif v5: 
+        layout_name = 'v5'
         electrode_layout = ELECTRODE_LAYOUT_v5
         control_electrodes = CONTROL_ELECTRODES_v5
 
@@ -200,6 +272,8 @@ def measure(imagefile, outfile, v4, v4_1, v5):
 
     data = {
         'fiducials': [map_fiducial(q) for q in fiducials],
+        'labels': [q.label for q in fiducials],
+        'layout': layout_name,
         'electrodes': [ {"grid": n, "image": p} for n,p in zip(alignment_electrodes, alignment_points) ]
     }
 
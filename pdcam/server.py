@@ -1,47 +1,45 @@
-from flask import Flask, Response, render_template, request
+from flask import Blueprint, Flask, Response, render_template, request
 from flask_cors import CORS, cross_origin
 import json
 import os
 
-from .video import Video
+from .cameras import CameraConfig, CameraGroup
+from .electrodes import stats_to_bytes, stats_to_dict
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .video import StreamVariant
 
 
-def create_app(grid_reference, grid_layout, flip):
-    camera = Video(grid_reference, grid_layout, flip)
-    # create and configure the app
-    app = Flask(__name__, instance_relative_config=True)
-    # Enable cross origin requests on all routes
-    CORS(app)
-
-
-    # ensure the instance folder exists
-    try:
-        os.makedirs(app.instance_path)
-    except OSError:
-        pass
+def create_app(grid_reference, grid_layout, flip, source=None, locate_workers=None):
+    group = CameraGroup([CameraConfig('0', grid_reference, grid_layout, flip, source)], locate_workers)
+    return create_group_app(group)
 
-    # a simple page that says hello
-    @app.route('/')
-    def index():
-        return render_template("index.html")
+def camera_blueprint(name, camera, render_metrics):
+    """Routes serving one camera, a `pdcam.video.Video`"""
+    bp = Blueprint(name, __name__)
 
-    @app.route('/video/')
+    @bp.route('/video/')
     def video():
-        markup = bool(request.args.get('markup', False))
+        try:
+            variant = StreamVariant.from_args(request.args.get, camera.MJPEG_QUALITY)
+        except ValueError as ex:
+            return Response(str(ex), status=400)
         return Response(
-            camera.mjpeg_frame_generator(markup), 
+            camera.mjpeg_frame_generator(name=request.remote_addr, **variant._asdict()), 
             mimetype = "multipart/x-mixed-replace; boundary=frame")
     
-    @app.route('/latest')
+    @bp.route('/latest')
     @cross_origin(allow_headers=['Content-Type', 'X-Min-Frame-Number'], expose_headers='X-Frame-Number')
     def latest():
-        markup = bool(request.args.get('markup', False))
+        try:
+            variant = StreamVariant.from_args(request.args.get, camera.JPEG_QUALITY)
+        except ValueError as ex:
+            return Response(str(ex), status=400)
         min_frame = request.headers.get('X-Min-Frame-Number', None)
         if min_frame is None:
             min_frame = request.args.get('min_frame', None)
         if min_frame is not None:
             min_frame = int(min_frame)
-        jpeg, frame_num = camera.latest_jpeg(min_frame_num=min_frame, markup=markup)
+        jpeg, frame_num = camera.latest_jpeg(min_frame_num=min_frame, **variant._asdict())
         return Response(
             jpeg,
             mimetype="image/jpeg",
@@ -50,19 +48,80 @@ def create_app(grid_reference, grid_layout, flip):
             }
         )
 
-    @app.route('/transform')
+    @bp.route('/transform')
     def transform():
-        transform, fiducials = camera.latest_transform()
-        if transform is not None:
-            transform = transform.tolist()
-
-        data = {
-            'transform': transform,
-            'qr_codes': fiducials,
-            'image_width': camera.WIDTH,
-            'image_height': camera.HEIGHT,
-        }
-        return Response(json.dumps(data), content_type="application/json")
+        return Response(json.dumps(camera.transform_data()), content_type="application/json")
+
+    @bp.route('/transform/events')
+    def transform_events():
+        """Server-sent events stream, with an event each time the transform changes"""
+        return Response(
+            camera.transform_events(request.headers.get('Last-Event-ID')),
+            mimetype="text/event-stream",
+            headers={'Cache-Control': 'no-cache'})
+
+    @bp.route('/electrodes')
+    @cross_origin(allow_headers=['Content-Type', 'X-Min-Frame-Number'], expose_headers='X-Frame-Number')
+    def electrodes():
+        """Color statistics of each electrode in the latest frame
+
+        `?format=binary` returns little-endian float32 rows of
+        (id, r, g, b, intensity, variance, change) instead of JSON.
+        """
+        min_frame = request.headers.get('X-Min-Frame-Number', request.args.get('min_frame', 0))
+        ids, stats, frame_num = camera.electrode_stats(int(min_frame))
+        headers = {'X-Frame-Number': str(frame_num)}
+        if request.args.get('format') == 'binary':
+            body = stats_to_bytes(ids, stats) if stats is not None else b''
+            return Response(body, content_type="application/octet-stream", headers=headers)
+        data = stats_to_dict(ids, stats) if stats is not None else None
+        return Response(json.dumps({'frame': frame_num, 'electrodes': data}), content_type="application/json", headers=headers)
+
+    @bp.route('/streams')
+    def streams():
+        """Per-client statistics for active /video streams, including dropped frames"""
+        return Response(json.dumps(camera.stream_stats()), content_type="application/json")
+
+    @bp.route('/metrics')
+    def metrics():
+        """Pipeline stage timings and counters, in the Prometheus text format"""
+        return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+    return bp
+
+def create_group_app(group):
+    """Create an app serving each camera of a `pdcam.cameras.CameraGroup`
+
+    Each camera's routes are served under `/cam/<id>/`, and the first
+    camera's are also served at the top level. The top level `/metrics`
+    includes all cameras.
+    """
+    # create and configure the app
+    app = Flask(__name__, instance_relative_config=True)
+    # Enable cross origin requests on all routes
+    CORS(app)
+
+
+    # ensure the instance folder exists
+    try:
+        os.makedirs(app.instance_path)
+    except OSError:
+        pass
+
+    # a simple page that says hello
+    @app.route('/')
+    def index():
+        return render_template("index.html")
+
+    @app.route('/cameras')
+    def cameras():
+        return Response(json.dumps(group.info()), content_type="application/json")
+
+    app.register_blueprint(camera_blueprint('camera', group.default, group.render_metrics))
+    for camera_id, camera in group.cameras.items():
+        app.register_blueprint(
+            camera_blueprint('camera_' + camera_id, camera, camera.render_metrics),
+            url_prefix='/cam/' + camera_id)
 
     return app
 
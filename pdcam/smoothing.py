@@ -0,0 +1,136 @@
+"""Temporal filtering of grid transforms
+"""
+import cv2
+import numpy as np
+
+
+class HomographyFilter(object):
+    """Kalman filter smoothing a sequence of grid transforms
+
+    Rather than filtering the homography coefficients directly, which have very
+    different scales, the filter tracks the image positions of a few grid
+    points (normally the corners of the electrode grid) with a constant
+    velocity model, and the smoothed homography is recomputed from them. All
+    coordinates share the same motion model, so a single 2x2 covariance is
+    kept for every coordinate.
+
+    Arguments:
+    * grid_points: Four grid coordinates to track, which must not be collinear
+    * measurement_noise: Standard deviation of transform noise, in pixels
+    * process_noise: Acceleration noise, in pixels/s^2
+    * max_predict: Longest time, in seconds, to extrapolate without a measurement
+    * reset_distance: Measurements further than this (in pixels) from the
+        prediction are taken as the board having moved, and reset the filter
+    """
+    def __init__(self, grid_points, measurement_noise=0.5, process_noise=5.0, max_predict=1.0, reset_distance=20.0):
+        self.grid_points = np.array([grid_points], dtype=np.float64)
+        self.r = measurement_noise ** 2
+        self.q = process_noise ** 2
+        self.max_predict = max_predict
+        self.reset_distance = reset_distance
+        self.reset()
+
+    @staticmethod
+    def from_reference(reference, **kwargs):
+        """Create a filter tracking the corners of a reference's control points"""
+        grid = np.array([cp.grid for cp in reference.control_points], dtype=np.float64)
+        x0, y0 = np.min(grid, axis=0)
+        x1, y1 = np.max(grid, axis=0)
+        return HomographyFilter([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], **kwargs)
+
+    def reset(self):
+        # Position and velocity of each tracked coordinate
+        self.x = None
+        self.v = None
+        self.P = None
+        self.last_time = None
+        self.last_update = None
+
+    def _project(self, H):
+        return cv2.perspectiveTransform(self.grid_points, H)[0].reshape(-1)
+
+    def _homography(self, positions):
+        src = self.grid_points[0].astype(np.float32)
+        dst = positions.reshape((-1, 2)).astype(np.float32)
+        return cv2.getPerspectiveTransform(src, dst)
+
+    def _predict(self, t):
+        dt = t - self.last_time
+        if dt <= 0:
+            return
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = self.q * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        self.x = self.x + self.v * dt
+        self.P = F @ self.P @ F.T + Q
+        self.last_time = t
+
+    def update(self, H, t):
+        """Add a measured transform at time `t` (seconds), and return the smoothed transform
+        """
+        z = self._project(H)
+        if self.x is None:
+            self.x = z
+            self.v = np.zeros_like(z)
+            self.P = np.diag([self.r, self.q])
+            self.last_time = t
+            self.last_update = t
+            return H
+
+        self._predict(t)
+        innovation = z - self.x
+        if np.max(np.abs(innovation)) > self.reset_distance:
+            self.reset()
+            return self.update(H, t)
+
+        S = self.P[0, 0] + self.r
+        K = self.P[:, 0] / S
+        self.x = self.x + K[0] * innovation
+        self.v = self.v + K[1] * innovation
+        self.P = self.P - np.outer(K, self.P[0, :])
+        self.last_update = t
+        return self._homography(self.x)
+
+    def predict(self, t):
+        """Predict the transform at time `t` without a measurement
+
+        Returns None if there is no state, or the last measurement is older
+        than `max_predict`.
+        """
+        if self.x is None or t - self.last_update > self.max_predict:
+            return None
+        self._predict(t)
+        return self._homography(self.x)
+
+
+class MotionDetector(object):
+    """Cheap check for whether the scene has changed since a reference image
+
+    Images are compared at low resolution by their mean absolute difference in
+    grayscale level.
+
+    Arguments:
+    * threshold: Mean absolute difference, in gray levels, above which the
+        scene is considered to have moved
+    * scale: Downscale factor for the comparison
+    """
+    def __init__(self, threshold=2.0, scale=8):
+        self.threshold = threshold
+        self.scale = scale
+        self.reference = None
+        self.current = None
+
+    def moved(self, image):
+        """Compare an image to the reference image
+
+        Returns True if there is no reference yet.
+        """
+        small = cv2.resize(image, None, fx=1.0 / self.scale, fy=1.0 / self.scale, interpolation=cv2.INTER_AREA)
+        self.current = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.reference is None:
+            return True
+        return cv2.absdiff(self.current, self.reference).mean() > self.threshold
+
+    def set_reference(self):
+        """Make the image last passed to `moved` the new reference
+        """
+        self.reference = self.current
@@ -0,0 +1,274 @@
+"""Frame sources for `pdcam.video.Video`
+
+A frame source captures BGR frames of a fixed size into buffers provided by the
+caller. Besides the Raspberry Pi camera, sources are provided for OpenCV
+capture devices, replay of recorded images or video, and synthetic frames,
+so that the capture pipeline can be run and benchmarked off the Pi.
+"""
+import cv2
+import glob
+import numpy as np
+import os
+import time
+
+
+class FrameSource(object):
+    """Base class for frame sources
+
+    Sources are used as context managers; `read` must only be called while the
+    source is open. If `flip` is set, frames are rotated 180 degrees as they
+    are captured.
+
+    Arguments:
+    * width, height: Size of the frames to produce
+    * fps: If provided, `read` is throttled to this frame rate
+    """
+    def __init__(self, width, height, fps=None):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.flip = False
+        self.next_time = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, out):
+        """Capture a frame into `out`, a (height, width, 3) uint8 array
+
+        Returns False when the source has no more frames.
+        """
+        raise NotImplementedError
+
+    def throttle(self):
+        """Sleep until the next frame is due, when the source has a frame rate
+        """
+        if self.fps is None:
+            return
+        now = time.monotonic()
+        if self.next_time is None or now - self.next_time > 1.0:
+            # Start over rather than trying to catch up after a long stall
+            self.next_time = now
+        self.next_time += 1.0 / self.fps
+        time.sleep(max(0.0, self.next_time - now))
+
+
+def copy_frame(frame, out, flip=False):
+    """Copy `frame` into `out`, resizing and flipping if necessary"""
+    if frame.shape != out.shape:
+        cv2.resize(frame, (out.shape[1], out.shape[0]), dst=out)
+        if flip:
+            cv2.flip(out, -1, dst=out)
+    elif flip:
+        cv2.flip(frame, -1, dst=out)
+    else:
+        np.copyto(out, frame)
+
+
+class PiCameraSource(FrameSource):
+    """Raspberry Pi camera, via the picamera (MMAL) API
+    """
+    def __init__(self, width, height, fps=30):
+        super().__init__(width, height)
+        self.framerate = fps
+        self.camera = None
+
+    def open(self):
+        # Imported here so that other sources can be used off the Pi
+        from picamera import PiCamera
+
+        self.camera = PiCamera()
+        self.camera.resolution = (self.width, self.height)
+        self.camera.framerate = self.framerate
+        self.camera.hflip = self.flip
+        self.camera.vflip = self.flip
+        self.camera.start_preview()
+
+    def close(self):
+        self.camera.close()
+        self.camera = None
+
+    def read(self, out):
+        # The camera writes directly into the (contiguous) buffer
+        self.camera.capture(out.reshape(-1), 'bgr', use_video_port=True)
+        return True
+
+
+class OpenCVSource(FrameSource):
+    """Any device or stream URL supported by `cv2.VideoCapture`
+    """
+    def __init__(self, width, height, device=0):
+        super().__init__(width, height)
+        self.device = device
+        self.capture = None
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.device)
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+
+    def close(self):
+        self.capture.release()
+        self.capture = None
+
+    def read(self, out):
+        flag, frame = self.capture.read()
+        if not flag:
+            return False
+        copy_frame(frame, out, self.flip)
+        return True
+
+
+class ReplaySource(FrameSource):
+    """Replays a directory of images, or a video file, at a fixed frame rate
+
+    Arguments:
+    * path: A directory of images (read in sorted filename order) or a video file
+    * fps: Frame rate to replay at, or None to replay as fast as possible
+    * loop: Restart from the beginning at the end of the recording
+    """
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, width, height, path, fps=30, loop=True):
+        super().__init__(width, height, fps)
+        self.path = path
+        self.loop = loop
+        self.images = None
+        self.capture = None
+        self.index = 0
+
+    def open(self):
+        if os.path.isdir(self.path):
+            files = sorted(glob.glob(os.path.join(self.path, '*')))
+            self.images = [f for f in files if os.path.splitext(f)[1].lower() in self.IMAGE_EXTENSIONS]
+            if len(self.images) == 0:
+                raise ValueError("No images found in %s" % self.path)
+        else:
+            self.capture = cv2.VideoCapture(self.path)
+            if not self.capture.isOpened():
+                raise ValueError("Unable to open video %s" % self.path)
+        self.index = 0
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def _next_frame(self):
+        if self.images is not None:
+            if self.index >= len(self.images):
+                if not self.loop:
+                    return None
+                self.index = 0
+            frame = cv2.imread(self.images[self.index])
+            self.index += 1
+            return frame
+
+        flag, frame = self.capture.read()
+        if not flag and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            flag, frame = self.capture.read()
+        return frame if flag else None
+
+    def read(self, out):
+        frame = self._next_frame()
+        if frame is None:
+            return False
+        copy_frame(frame, out, self.flip)
+        self.throttle()
+        return True
+
+
+class SyntheticSource(FrameSource):
+    """Generates frames by warping still images with random homographies
+
+    Each frame is one of the source images, perturbed by a small random
+    rotation, translation and perspective change, so that the grid has to be
+    located anew in every frame.
+
+    Arguments:
+    * images: Paths of the images to warp. A plain gradient is used if empty.
+    * fps: Frame rate to generate at, or None to generate as fast as possible
+    * max_shift: Maximum translation, in pixels
+    * max_angle: Maximum rotation, in degrees
+    * seed: Random seed
+    """
+    def __init__(self, width, height, images=(), fps=30, max_shift=10.0, max_angle=2.0, seed=0):
+        super().__init__(width, height, fps)
+        self.image_paths = list(images)
+        self.max_shift = max_shift
+        self.max_angle = max_angle
+        self.rng = np.random.default_rng(seed)
+        self.images = []
+        self.index = 0
+        # The homography used to generate the most recent frame
+        self.homography = np.eye(3)
+
+    def open(self):
+        self.images = []
+        for path in self.image_paths:
+            image = cv2.imread(path)
+            if image is None:
+                raise ValueError("Unable to read image %s" % path)
+            self.images.append(cv2.resize(image, (self.width, self.height)))
+        if len(self.images) == 0:
+            y, x = np.mgrid[0:self.height, 0:self.width]
+            gradient = np.dstack([x * 255 // self.width, y * 255 // self.height, np.full_like(x, 128)])
+            self.images.append(gradient.astype(np.uint8))
+
+    def random_homography(self):
+        center = (self.width / 2, self.height / 2)
+        angle = self.rng.uniform(-self.max_angle, self.max_angle)
+        H = np.vstack([cv2.getRotationMatrix2D(center, angle, 1.0), [0, 0, 1]])
+        H[0:2, 2] += self.rng.uniform(-self.max_shift, self.max_shift, 2)
+        H[2, 0:2] = self.rng.uniform(-1e-5, 1e-5, 2)
+        return H
+
+    def read(self, out):
+        image = self.images[self.index % len(self.images)]
+        self.index += 1
+        self.homography = self.random_homography()
+        H = self.homography
+        if self.flip:
+            # Fold the flip into the warp rather than flipping afterwards
+            H = np.dot(np.array([[-1, 0, self.width - 1], [0, -1, self.height - 1], [0, 0, 1]]), H)
+        cv2.warpPerspective(image, H, (self.width, self.height), dst=out, borderMode=cv2.BORDER_REPLICATE)
+        self.throttle()
+        return True
+
+
+def source_from_spec(spec, width, height):
+    """Create a frame source from a command line description
+
+    * `picamera`: The Raspberry Pi camera
+    * `opencv:<device>`: A cv2.VideoCapture device index or URL
+    * `replay:<path>`: A directory of images or a video file
+    * `synthetic[:<image>,<image>,...]`: Randomly warped copies of images
+    * `session:<path>`: Frames of a recorded session (see `pdcam.recording`)
+    """
+    kind, _, arg = spec.partition(':')
+    if kind == 'picamera':
+        return PiCameraSource(width, height)
+    elif kind == 'opencv':
+        device = int(arg) if arg.isdigit() else (arg or 0)
+        return OpenCVSource(width, height, device)
+    elif kind == 'replay':
+        return ReplaySource(width, height, arg)
+    elif kind == 'synthetic':
+        images = [p for p in arg.split(',') if p]
+        return SyntheticSource(width, height, images)
+    elif kind == 'session':
+        from pdcam.recording import SessionSource
+        return SessionSource(width, height, arg)
+    else:
+        raise ValueError("Unknown frame source '%s'" % spec)
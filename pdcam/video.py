@@ -1,35 +1,138 @@
+import collections
 import cv2
+import itertools
+import json
 import numpy as np
 import threading
 import time
 
-from picamera import PiCamera
+from pdcam import metrics
+from pdcam.boards import BoardLocator
+from pdcam.electrodes import ElectrodeSampler
+from pdcam.frames import FrameRing
+from pdcam.grid import NO_SOLUTION, GridLocator
+from pdcam.plotting import render_overlay, template_polylines
+from pdcam.recording import SessionWriter
+from pdcam.rectify import BoardRectifier
+from pdcam.smoothing import HomographyFilter, MotionDetector
+from pdcam.sources import PiCameraSource
 
-from pdcam.grid import find_grid_transform
-from pdcam.plotting import mark_fiducial, mark_template
+_capture_timer = metrics.stage_timer('capture')
+_motion_timer = metrics.stage_timer('motion')
+_filter_timer = metrics.stage_timer('filter')
+_locate_timer = metrics.stage_timer('locate')
+_markup_timer = metrics.stage_timer('markup')
+_encode_timer = metrics.stage_timer('encode')
+_rectify_timer = metrics.stage_timer('rectify')
+_sample_timer = metrics.stage_timer('sample')
+_locate_age = metrics.REGISTRY.histogram(
+    'pdcam_locate_age_seconds', "Age of a frame when its grid locate result is published")
+_frame_age = metrics.REGISTRY.histogram(
+    'pdcam_frame_age_seconds', "Age of a frame when its JPEG encoding is published")
+_frames_captured = metrics.REGISTRY.counter('pdcam_frames_captured_total', "Frames captured")
+_record_timer = metrics.stage_timer('record')
+_locate_results = {
+    result: metrics.REGISTRY.counter('pdcam_locate_total', "Frames processed by the grid locator, by result", result=result)
+    for result in ('found', 'failed', 'skipped')
+}
 
 class AsyncGridLocate(object):
-    def __init__(self, grid_reference, callback=None, timeout_frames=3):
+    """Locates the grid in images on a background thread
+
+    Optionally, published transforms are smoothed over time with a
+    HomographyFilter, which also predicts through brief dropouts, and a
+    MotionDetector is used to skip detection while the image hasn't changed
+    since the last successful detection.
+
+    Arguments:
+    * grid_reference: Reference for the board to locate
+    * callback: Called with (transform, fiducials) after each image is processed
+    * timeout_frames: Number of consecutive failures before publishing None
+    * track, refresh_frames, decimate: GridLocator options
+    * smooth: Enable temporal filtering of the transform
+    * locator: Locator to use in place of a GridLocator for `grid_reference`,
+        e.g. a `pdcam.boards.BoardLocator`. The filter is reset whenever the
+        locator's `reference` changes.
+    * motion_threshold: If provided, skip detection when the image differs
+        from the last detected image by less than this mean gray level
+    * max_skip_time: Longest time, in seconds, to go without running detection
+    * retry_period, max_retry_period: After a failed detection, detection is
+        retried after `retry_period` seconds, doubling with each consecutive
+        failure up to `max_retry_period`, so that the detector doesn't run
+        flat out while no board is in view
+    """
+    def __init__(self, grid_reference, callback=None, timeout_frames=3, track=False, refresh_frames=10, decimate=1,
+                 smooth=False, motion_threshold=None, max_skip_time=2.0, locator=None, retry_period=0.05,
+                 max_retry_period=0.5):
         self.callback = callback
         self.grid_reference = grid_reference
+        if locator is None:
+            locator = GridLocator(grid_reference, track=track, refresh_frames=refresh_frames, decimate=decimate)
+        self.locator = locator
         self.timeout_frames = timeout_frames
         self.fail_count = 0
+        self.smooth = smooth
+        self.filter = None
+        self.filter_reference = None
+        self._update_filter()
+        self.motion = None
+        if motion_threshold is not None:
+            self.motion = MotionDetector(motion_threshold)
+        self.max_skip_time = max_skip_time
+        self.last_detection = None
+        self.last_detection_time = 0.0
+        self.retry_period = retry_period
+        self.max_retry_period = max_retry_period
+        self.retry_delay = 0.0
+        self.next_retry_time = 0.0
+        # (fiducials, solution) of the last failed detection
+        self.last_failure = ([], NO_SOLUTION)
+        self.detect_count = 0
+        self.skip_count = 0
         self.pending_image = None
+        self.pending_frame = (0, None)
+        self.pending_release = None
         self.latest_result = (None, [])
+        # (frame number, capture time) of the image latest_result was found in
+        self.latest_frame = (0, None)
+        # GridSolution of the latest_result detection, with its quality
+        self.latest_solution = NO_SOLUTION
+        self.running = True
         self.cv = threading.Condition()
         self.thread = threading.Thread(target=self.thread_entry)
         self.thread.daemon = True
         self.thread.start()
 
-    def push(self, image):
+    def push(self, image, frame_number=0, timestamp=None, release=None):
         """Push a new image to be processed
 
         Images aren't queued. If you push a new image before processing has
         begun on the previous image, the previous image will be dropped.
+
+        The frame number and capture timestamp (from `time.monotonic`) are
+        recorded with the result as `latest_frame`. If provided, `release` is
+        called once the image is no longer needed, so that the image can be
+        borrowed rather than copied.
         """
         with self.cv:
+            dropped_release = self.pending_release
             self.pending_image = image
+            self.pending_frame = (frame_number, timestamp)
+            self.pending_release = release
             self.cv.notify()
+        if dropped_release is not None:
+            dropped_release()
+
+    def stop(self):
+        """Stop the processing thread, waiting for any image in progress
+        """
+        with self.cv:
+            self.running = False
+            self.cv.notify()
+        self.thread.join()
+        if self.pending_release is not None:
+            self.pending_release()
+            self.pending_release = None
 
     def latest(self):
         with self.cv:
@@ -37,80 +140,614 @@ class AsyncGridLocate(object):
 
         return transform, fiducials
 
+    def _update_filter(self):
+        """Create the filter for the locator's reference, if it has changed"""
+        reference = self.locator.reference
+        if not self.smooth or reference is self.filter_reference:
+            return
+        self.filter_reference = reference
+        self.filter = None
+        if reference is not None and len(reference.control_points) >= 4:
+            self.filter = HomographyFilter.from_reference(reference)
+
+    def process(self, img, t):
+        """Locate the grid in an image captured at time `t`
+
+        Returns (transform, fiducials, GridSolution). The transform may differ
+        from the solution's if it is smoothed.
+        """
+        moved = True
+        if self.motion is not None:
+            with _motion_timer.time():
+                moved = self.motion.moved(img)
+        if not moved and self.last_detection is not None and t - self.last_detection_time < self.max_skip_time:
+            # Nothing has changed since the last detection, so reuse it. It's
+            # already been filtered, and isn't a new measurement for the filter.
+            self.skip_count += 1
+            _locate_results['skipped'].inc()
+            return self.last_detection
+        elif self.last_detection is None and t < self.next_retry_time:
+            # Backing off after a failed detection
+            self.skip_count += 1
+            _locate_results['skipped'].inc()
+            transform = None
+            fiducials, solution = self.last_failure
+        else:
+            self.detect_count += 1
+            transform, fiducials = self.locator.find_grid_transform(img)
+            solution = self.locator.last_solution
+            _locate_results['found' if transform is not None else 'failed'].inc()
+            if transform is not None:
+                self.last_detection = (transform, fiducials, solution)
+                self.last_detection_time = t
+                self.retry_delay = 0.0
+                if self.motion is not None:
+                    self.motion.set_reference()
+            else:
+                self.last_detection = None
+                self.last_failure = (fiducials, solution)
+                self.retry_delay = min(max(self.retry_delay * 2, self.retry_period), self.max_retry_period)
+                self.next_retry_time = t + self.retry_delay
+
+        self._update_filter()
+        if self.filter is not None:
+            with _filter_timer.time():
+                if transform is not None:
+                    transform = self.filter.update(transform, t)
+                    self.last_detection = (transform, fiducials, solution)
+                else:
+                    transform = self.filter.predict(t)
+
+        return transform, fiducials, solution
+
     def thread_entry(self):
         while True:
             with self.cv:
-                self.cv.wait_for(lambda: self.pending_image is not None)
+                self.cv.wait_for(lambda: self.pending_image is not None or not self.running)
+                if not self.running:
+                    return
                 img = self.pending_image
+                frame = self.pending_frame
+                release = self.pending_release
                 self.pending_image = None
+                self.pending_release = None
 
             # Now we've got the image, and cleared pending image,
             # we can release the lock and do the processing
-            transform, fiducials = find_grid_transform(self.grid_reference, img)
+            t = frame[1] if frame[1] is not None else time.monotonic()
+            try:
+                with _locate_timer.time():
+                    transform, fiducials, solution = self.process(img, t)
+            finally:
+                if release is not None:
+                    release()
+            if frame[1] is not None:
+                _locate_age.observe(time.monotonic() - frame[1])
 
             with self.cv:
                 if transform is not None:
                     self.fail_count = 0
                     self.latest_result = (transform, fiducials)
+                    self.latest_frame = frame
+                    self.latest_solution = solution
                 else:
                     self.fail_count += 1
                     if self.fail_count > self.timeout_frames:
                         self.latest_result = (transform, fiducials)
+                        self.latest_frame = frame
+                        self.latest_solution = solution
 
             if self.callback is not None:
                 self.callback(transform, fiducials)
 
 
+def format_transform_event(version, data):
+    """Format a transform update as a server-sent event"""
+    return ("id: %d\nevent: transform\ndata: %s\n\n" % (version, json.dumps(data))).encode()
+
+
+class StreamVariant(collections.namedtuple('StreamVariant', ['markup', 'quality', 'scale', 'crop', 'view'])):
+    """Encoding options for a JPEG stream
+
+    * markup: Draw the fiducials and electrode grid on the frame
+    * quality: JPEG quality, 1-100
+    * scale: Downscale factor, in (0, 1]
+    * crop: None for the full frame, or 'grid' to crop to the electrode grid
+        (the full frame is sent while the grid isn't located)
+    * view: 'camera' for camera frames, or 'board' for a fixed size top-down
+        view warped into electrode grid coordinates (blank while the grid
+        isn't located). Cropping doesn't apply to the board view.
+    """
+    CROP_OPTIONS = (None, 'grid')
+    VIEW_OPTIONS = ('camera', 'board')
+
+    @staticmethod
+    def create(markup=False, quality=85, scale=1.0, crop=None, view='camera'):
+        # Values are clamped and rounded, so that arbitrary requests don't
+        # create an unbounded number of variants
+        quality = int(min(max(int(quality), 1), 100))
+        scale = round(min(max(float(scale), 0.05), 1.0), 2)
+        if crop not in StreamVariant.CROP_OPTIONS:
+            raise ValueError("Unknown crop '%s'" % crop)
+        if view not in StreamVariant.VIEW_OPTIONS:
+            raise ValueError("Unknown view '%s'" % view)
+        return StreamVariant(bool(markup), quality, scale, crop, view)
+
+    @staticmethod
+    def from_args(get, default_quality):
+        """Create a variant from query parameters
+
+        Arguments:
+        * get: Function returning the string value of a parameter, or None
+        * default_quality: Quality to use if not given
+        """
+        return StreamVariant.create(
+            markup=bool(get('markup')),
+            quality=get('quality') or default_quality,
+            scale=get('scale') or 1.0,
+            crop=get('crop') or None,
+            view=get('view') or 'camera')
+
+
+class StreamClient(object):
+    """A bounded queue of encoded frames for one streaming client
+
+    When the client falls behind, the oldest queued frames are dropped so that
+    it always receives the most recent frames without holding up anyone else.
+    The client is closed when the video stops.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, name, variant, max_queue):
+        self.id = next(self._ids)
+        self.name = name
+        self.variant = variant
+        self.queue = collections.deque(maxlen=max_queue)
+        self.cv = threading.Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame_num, jpeg):
+        with self.cv:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((frame_num, jpeg))
+            self.cv.notify()
+
+    def close(self):
+        """Wake the client, with no more frames to come"""
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+    def get(self):
+        """Block until a frame is available and return (frame_num, jpeg)
+
+        Returns None once the client is closed.
+        """
+        with self.cv:
+            self.cv.wait_for(lambda: len(self.queue) > 0 or self.closed)
+            if self.closed:
+                return None
+            self.sent += 1
+            return self.queue.popleft()
+
+    def stats(self):
+        with self.cv:
+            return {
+                'id': self.id,
+                'name': self.name,
+                'markup': self.variant.markup,
+                'quality': self.variant.quality,
+                'scale': self.variant.scale,
+                'crop': self.variant.crop,
+                'view': self.variant.view,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'queued': len(self.queue),
+            }
+
+
+class VariantCache(object):
+    """Encoding state of one StreamVariant, shared by all of its clients
+
+    * lock: Serializes encoding of the variant
+    * buffers: Markup and resize buffers, by name, reused between frames
+    * latest: (frame_number, jpeg bytes) of the most recent encoding
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.latest = None
+
+
+class FrameBroadcaster(object):
+    """Encodes each new frame once and publishes it to all subscribed clients
+
+    One broadcaster serves all clients of a single StreamVariant; clients
+    subscribe through `Video.subscribe`, which drops the broadcaster once its
+    last client has left. Its thread runs only while there are subscribers,
+    and encodes from a borrowed frame without holding any lock, so encoding
+    never blocks the capture thread or other clients.
+    """
+    def __init__(self, video, variant):
+        self.video = video
+        self.variant = variant
+        self.clients = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.append(client)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.thread_entry)
+                self.thread.daemon = True
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        """Remove a client, and return the number of clients left"""
+        with self.lock:
+            self.clients.remove(client)
+            return len(self.clients)
+
+    def stats(self):
+        with self.lock:
+            clients = list(self.clients)
+        return [c.stats() for c in clients]
+
+    def thread_entry(self):
+        video = self.video
+        last_fn = 0
+        while True:
+            with self.lock:
+                if len(self.clients) == 0:
+                    self.thread = None
+                    return
+
+            frame = video.borrow_frame(last_fn + 1)
+            if frame is None:
+                # The video has stopped, so end every client's stream
+                with self.lock:
+                    self.thread = None
+                    clients = list(self.clients)
+                for c in clients:
+                    c.close()
+                return
+            with frame:
+                last_fn, jpeg = video.encoded_frame(frame, self.variant)
+
+            if jpeg is None:
+                continue
+
+            with self.lock:
+                clients = list(self.clients)
+            for c in clients:
+                c.put(last_fn, jpeg)
+
+
+class SessionRecorder(object):
+    """Records the frames of a Video, with the transform in use for each, to
+    a session file (see `pdcam.recording`)
+
+    Like a FrameBroadcaster, the recorder thread writes from a borrowed frame
+    without holding any lock, so recording never blocks capture. Raw frames
+    are copied once, from the frame buffer straight into the mapped file.
+    JPEG frames are taken from the Video's encode cache, so a frame already
+    encoded for a client at the same quality isn't encoded again. Frames
+    captured while the previous one is being written are skipped, and
+    counted in `skipped`.
+    """
+    def __init__(self, video, writer, variant):
+        self.video = video
+        self.writer = writer
+        self.variant = variant
+        self.recorded = 0
+        self.skipped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.thread_entry)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop recording, and close the session file"""
+        video = self.video
+        with video.frame_cv:
+            self.stopped = True
+            video.frame_cv.notify_all()
+        self.thread.join()
+
+    def record(self, frame):
+        video = self.video
+        if video.grid_finder is not None:
+            transform, fiducials = video.grid_finder.latest()
+            transform_frame = video.grid_finder.latest_frame[0]
+            error = video.grid_finder.latest_solution.error
+        else:
+            transform, fiducials, transform_frame, error = None, [], 0, None
+        # Convert from the monotonic clock to wall clock time
+        timestamp = time.time() - (time.monotonic() - frame.timestamp)
+        jpeg = None
+        if not self.writer.raw:
+            frame_num, jpeg = video.encoded_frame(frame, self.variant)
+            if frame_num != frame.number or jpeg is None:
+                # Superseded by a newer frame before it could be encoded
+                return True
+        with _record_timer.time():
+            return self.writer.append(
+                frame.number, timestamp, image=frame.image, jpeg=jpeg, transform=transform,
+                transform_frame=transform_frame, error=error, fiducials=fiducials)
+
+    def thread_entry(self):
+        video = self.video
+        last_fn = 0
+        try:
+            while True:
+                with video.frame_cv:
+                    video.frame_cv.wait_for(
+                        lambda: video.frame_number > last_fn or not video.running or self.stopped)
+                    if self.stopped or not video.running:
+                        return
+                    frame = video.frames.borrow_latest()
+                with frame:
+                    if last_fn > 0:
+                        self.skipped += frame.number - last_fn - 1
+                    last_fn = frame.number
+                    if not self.record(frame):
+                        print("Recording session %s is full" % self.writer.path)
+                        return
+                self.recorded += 1
+        finally:
+            self.writer.close()
+
+
 class Video(object):
     """Video capture process
 
-    Launches background threads to continuously capture frames from raspberry PI
-    camera (MMAL API) and process them to locate QR codes.
+    Launches background threads to continuously capture frames from a frame
+    source (by default the raspberry PI camera, via the MMAL API) and process
+    them to locate QR codes.
+
+    With `locate_workers` > 0 (default `LOCATE_WORKERS`), grid locating runs
+    in a pool of worker processes (see `pdcam.pool.ProcessGridLocate`).
+
+    Several Videos in one process (see `pdcam.cameras.CameraGroup`) can share
+    a `locate_pool`, which must have been created with `grid_reference` as
+    one of its references, and an `encode_slots` semaphore, which bounds the
+    number of frames being rendered and encoded at once across all of them.
+
+    With a `boards` registry (see `pdcam.boards`), the board in view is
+    identified from its tag IDs, and the electrode layout switched to match
+    it, so `grid_reference` and `grid_layout` only apply until a board is
+    identified. Identification runs on the locator thread, so it can't be
+    combined with locate workers.
     """
 
     WIDTH = 1024
     HEIGHT = 768
     NBUFFER = 3
-    PROCESS_PERIOD = 0.5
-    def __init__(self, grid_reference, grid_layout, flip=False):
+    # Every frame is handed to the locator. The motion check skips detection
+    # on frames where nothing has changed, and tracking tags near their last
+    # position makes the remaining detections several times cheaper than a
+    # full image scan. Frames arriving while the locator is busy are dropped,
+    # and while no board is found, detection backs off to twice a second.
+    PROCESS_PERIOD = 0.0
+    SMOOTH_TRANSFORM = True
+    MOTION_THRESHOLD = 2.0
+    TRACK_FIDUCIALS = True
+    TRACK_REFRESH_FRAMES = 10
+    # Detect tags at half resolution; corners are refined at full resolution
+    DECIMATE = 2
+    JPEG_QUALITY = 85
+    MJPEG_QUALITY = 95
+    # Resolution of the rectified board view
+    BOARD_PIXELS_PER_ELECTRODE = 32
+    # Movement of the grid corners, in pixels, for a new transform to be
+    # pushed to transform subscribers
+    TRANSFORM_CHANGE_THRESHOLD = 1.0
+    # Number of worker processes for grid locating. With 0, locating runs on
+    # a single thread in this process.
+    LOCATE_WORKERS = 0
+    # Number of StreamVariants whose encoding state (a JPEG, and full frame
+    # buffers) is kept once they're no longer being streamed. Variants come
+    # from request parameters, so without a limit, clients asking for many
+    # scales or qualities would grow memory without bound.
+    MAX_CACHED_VARIANTS = 8
+    def __init__(self, grid_reference, grid_layout, flip=False, source=None, locate_workers=None,
+                 locate_pool=None, encode_slots=None, boards=None):
+        if source is None:
+            source = PiCameraSource(self.WIDTH, self.HEIGHT)
+        self.source = source
+        # Flipping is done by the source as the frame is captured, so that
+        # readers get a contiguous image and don't need to copy it
+        self.source.flip = flip
         self.frame_number = 0
         self.grid_layout = grid_layout
-        self.frames = [np.empty((self.WIDTH * self.HEIGHT * 3,), dtype=np.uint8) for _ in range(self.NBUFFER)]
-        self.frame_locks = [threading.Lock() for _ in range(self.NBUFFER)]
+        self.frames = FrameRing((self.HEIGHT, self.WIDTH, 3), self.NBUFFER)
         self.lock = threading.Lock()
         self.frame_cv = threading.Condition(self.lock)
-        self.active_buffer = 0
         self.last_process_time = 0.0
         self.flip = flip
+        # VariantCache of each recently encoded StreamVariant, least recently
+        # used first, and FrameBroadcaster of each streamed variant
+        self.variant_caches = collections.OrderedDict()
+        self.broadcasters = {}
+        self.variant_lock = threading.Lock()
+        self.encode_slots = encode_slots
+        self.rectifier = BoardRectifier(grid_layout, self.BOARD_PIXELS_PER_ELECTRODE)
+        self.sampler = ElectrodeSampler(grid_layout)
+        # (frame_number, ids, stats) of the most recent electrode sample
+        self.electrode_cache = None
+        self.electrode_lock = threading.Lock()
+        # (key, Overlay) for the most recently rendered markup
+        self.overlay = None
+        self.overlay_lock = threading.Lock()
+        self.frame_listeners = []
+        # Transform updates pushed to subscribers: a version number which
+        # increases with each material change, and the data for it
+        self.transform_cv = threading.Condition()
+        self.transform_version = 0
+        self.transform_update = None
+        self.transform_corners = None
+        self.transform_labels = None
+        self.transform_listeners = []
+        self.recorder = None
+        self.running = True
 
-        if grid_reference is not None:
-            self.grid_finder = AsyncGridLocate(grid_reference)
+        if locate_workers is None:
+            locate_workers = self.LOCATE_WORKERS
+        if grid_reference is not None and len(grid_reference.fiducials) == 0:
+            # Nothing to locate
+            grid_reference = None
+        self.boards = boards
+        # Board identified by the locator, when using a registry
+        self.board = None
+        if boards is not None:
+            self.grid_finder = AsyncGridLocate(
+                grid_reference,
+                smooth=self.SMOOTH_TRANSFORM,
+                motion_threshold=self.MOTION_THRESHOLD,
+                locator=BoardLocator(
+                    boards, track=self.TRACK_FIDUCIALS, refresh_frames=self.TRACK_REFRESH_FRAMES,
+                    decimate=self.DECIMATE))
+        elif grid_reference is not None and locate_pool is not None:
+            self.grid_finder = locate_pool.client(grid_reference, smooth=self.SMOOTH_TRANSFORM)
+        elif grid_reference is not None and locate_workers > 0:
+            # Imported here so the multiprocessing machinery is only loaded when used
+            from pdcam.pool import ProcessGridLocate
+            self.grid_finder = ProcessGridLocate(
+                grid_reference,
+                locate_workers,
+                (self.HEIGHT, self.WIDTH, 3),
+                track=self.TRACK_FIDUCIALS,
+                refresh_frames=self.TRACK_REFRESH_FRAMES,
+                decimate=self.DECIMATE,
+                smooth=self.SMOOTH_TRANSFORM)
+        elif grid_reference is not None:
+            self.grid_finder = AsyncGridLocate(
+                grid_reference,
+                track=self.TRACK_FIDUCIALS,
+                refresh_frames=self.TRACK_REFRESH_FRAMES,
+                decimate=self.DECIMATE,
+                smooth=self.SMOOTH_TRANSFORM,
+                motion_threshold=self.MOTION_THRESHOLD)
         else:
             self.grid_finder = None
+        if self.grid_finder is not None:
+            self.grid_finder.callback = self.on_locate
         self.capture_thread = threading.Thread(target=self.capture_thread_entry)
         self.capture_thread.daemon = True
         self.capture_thread.start()
 
+    def stop(self):
+        """Stop capturing and locating, and wait for the background threads to exit
+        """
+        with self.lock:
+            self.running = False
+            self.frame_cv.notify_all()
+            frame_num = self.frame_number
+            listeners = list(self.frame_listeners)
+        for listener in listeners:
+            listener(frame_num)
+        with self.transform_cv:
+            self.transform_cv.notify_all()
+        self.stop_recording()
+        self.capture_thread.join()
+        if self.grid_finder is not None:
+            self.grid_finder.stop()
+
+    def add_frame_listener(self, callback):
+        """Register a function to be called with the frame number of each new frame
+
+        Callbacks run on the capture thread, so they must return quickly. They
+        are also called once, with the unchanged frame number, when capture
+        is stopped, so that waiters can check `running`.
+        """
+        with self.lock:
+            self.frame_listeners.append(callback)
+
+    def remove_frame_listener(self, callback):
+        with self.lock:
+            self.frame_listeners.remove(callback)
+
+    def publish_frame(self, slot, timestamp):
+        """Make a captured frame the latest frame, and notify waiting readers
+        """
+        with self.lock:
+            self.frame_number += 1
+            frame_num = self.frame_number
+            self.frames.publish(slot, frame_num, timestamp)
+            listeners = list(self.frame_listeners)
+            self.frame_cv.notify_all()
+        for listener in listeners:
+            listener(frame_num)
+
     def capture_thread_entry(self):
         print("Running capture thread")
-        with PiCamera() as camera:
-            camera.resolution = (self.WIDTH, self.HEIGHT)
-            camera.framerate = 30
-            camera.start_preview()
+        with self.source:
+            while self.running:
+                slot = self.frames.acquire_write()
+                with _capture_timer.time():
+                    ok = self.source.read(slot.image)
+                if not ok:
+                    self.frames.abandon(slot)
+                    print("Frame source ended")
+                    return
+                cur_time = time.monotonic()
+                self.publish_frame(slot, cur_time)
+                _frames_captured.inc()
+                if self.grid_finder is not None and cur_time - self.last_process_time >= self.PROCESS_PERIOD:
+                    self.last_process_time = cur_time
+                    # The locator borrows the frame rather than copying it,
+                    # and releases it when done
+                    frame = self.frames.borrow_latest()
+                    self.grid_finder.push(frame.image, frame.number, frame.timestamp, frame.release)
 
-            while True:
-                next_buffer = (self.active_buffer + 1) % self.NBUFFER
-                with self.frame_locks[next_buffer]:
-                    camera.capture(self.frames[next_buffer], 'bgr', use_video_port=True)
-                    self.frames[next_buffer] = self.frames[next_buffer].reshape((self.HEIGHT, self.WIDTH, 3))
-                    cur_time = time.monotonic()
-                    if cur_time - self.last_process_time > self.PROCESS_PERIOD:
-                        self.last_process_time = cur_time
-                        self.grid_finder.push(self.get_buffer(next_buffer).copy())
-                with self.lock:
-                    self.active_buffer = next_buffer
-                    self.frame_number += 1
-                    self.frame_cv.notify_all()
+    def start_recording(self, path, max_frames, encoding='jpeg', quality=None, data_size=None, metadata=None):
+        """Start recording frames to a new session file (see `pdcam.recording`)
+
+        Every frame captured from now until `stop_recording` is recorded,
+        unless the recorder falls behind, along with the grid transform and
+        fiducials current when it was captured. Recording stops by itself
+        when the session's preallocated space is used up.
+
+        Arguments:
+        * path: Session file to create
+        * max_frames: Maximum number of frames to record
+        * encoding: 'raw' (BGR pixels) or 'jpeg'
+        * quality: JPEG quality (default `JPEG_QUALITY`)
+        * data_size, metadata: See `pdcam.recording.SessionWriter`
+        """
+        self.stop_recording()
+        if quality is None:
+            quality = self.JPEG_QUALITY
+        session_metadata = {'flip': self.flip}
+        session_metadata.update(metadata or {})
+        writer = SessionWriter(path, self.WIDTH, self.HEIGHT, max_frames, encoding, data_size, session_metadata)
+        self.recorder = SessionRecorder(self, writer, StreamVariant.create(quality=quality))
+        return self.recorder
+
+    def stop_recording(self):
+        """Stop recording, if recording, and close the session file"""
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.stop()
+            self.recorder = None
+
+    def borrow_frame(self, min_frame_num=0):
+        """Borrow the latest frame, waiting until it is at least `min_frame_num`
+
+        Returns a FrameRef, which must be released (or used as a context
+        manager). Its image is shared, and must not be modified. Returns None
+        if capture is stopped.
+        """
+        with self.frame_cv:
+            self.frame_cv.wait_for(lambda: self.frame_number >= max(min_frame_num, 1) or not self.running)
+            if not self.running:
+                return None
+            return self.frames.borrow_latest()
 
     def latest_transform(self):
         """Get the latest transform solution
@@ -118,12 +755,165 @@ class Video(object):
         Transform is a 3x3 numpy array representing a homography.
         It may be None, if no transform is found.
         """
+        if self.grid_finder is None:
+            return None, []
         transform, qrinfo = self.grid_finder.latest()
 
         # Convert from the decoded QR objects into list of lists of corners
         qr_corners = [[tuple(p) for p in qr.corners] for qr in qrinfo]
         return transform, qr_corners
 
+    def transform_data(self):
+        """Get the latest transform as a JSON serializable dict
+
+        Includes the number and capture time (in seconds since the epoch) of
+        the frame the transform was found in, and the RMS reprojection error
+        (in pixels) and number of fiducials matched of its detection.
+        """
+        if self.grid_finder is not None:
+            transform, fiducials = self.latest_transform()
+            frame_num, timestamp = self.grid_finder.latest_frame
+            solution = self.grid_finder.latest_solution
+        else:
+            transform, fiducials = None, []
+            frame_num, timestamp = 0, None
+            solution = NO_SOLUTION
+        if timestamp is not None:
+            # Convert from the monotonic clock to wall clock time
+            timestamp = time.time() - (time.monotonic() - timestamp)
+
+        return {
+            'transform': transform.tolist() if transform is not None else None,
+            'qr_codes': fiducials,
+            'image_width': self.WIDTH,
+            'image_height': self.HEIGHT,
+            'frame': frame_num,
+            'timestamp': timestamp,
+            'board': self.board.name if self.board is not None else None,
+            'error': solution.error,
+            'fiducials_matched': solution.matched,
+        }
+
+    def set_layout(self, layout):
+        """Switch to a different electrode layout, e.g. when another board is
+        identified
+
+        The rectified view and electrode statistics are rebuilt for the new
+        layout.
+        """
+        rectifier = BoardRectifier(layout, self.BOARD_PIXELS_PER_ELECTRODE)
+        sampler = ElectrodeSampler(layout)
+        with self.electrode_lock:
+            self.grid_layout = layout
+            self.rectifier = rectifier
+            self.sampler = sampler
+            self.electrode_cache = None
+
+    def _grid_corners(self, transform):
+        rows = len(self.grid_layout)
+        cols = len(self.grid_layout[0]) if rows > 0 else 0
+        corners = np.array([[[0, 0], [cols, 0], [cols, rows], [0, rows]]], dtype=np.float64)
+        return cv2.perspectiveTransform(corners, transform)
+
+    def on_locate(self, transform, fiducials):
+        """Called by the grid locator after each image is processed
+
+        Publishes a new transform version if the published result has changed
+        materially: the grid has been found or lost, the set of fiducials has
+        changed, or the grid corners have moved by more than
+        `TRANSFORM_CHANGE_THRESHOLD` pixels.
+        """
+        if self.boards is not None:
+            board = self.grid_finder.locator.board
+            if board is not None and board is not self.board:
+                self.board = board
+                self.set_layout(board.layout)
+        transform, fiducials = self.grid_finder.latest()
+        corners = self._grid_corners(transform) if transform is not None else None
+        labels = sorted(str(f.label) for f in fiducials)
+        with self.transform_cv:
+            previous = self.transform_corners
+            if self.transform_update is not None:
+                if corners is None and previous is None:
+                    changed = labels != self.transform_labels
+                elif corners is None or previous is None:
+                    changed = True
+                else:
+                    changed = labels != self.transform_labels or \
+                        np.max(np.abs(corners - previous)) > self.TRANSFORM_CHANGE_THRESHOLD
+                if not changed:
+                    return
+            self.transform_corners = corners
+            self.transform_labels = labels
+            self.transform_version += 1
+            self.transform_update = self.transform_data()
+            version = self.transform_version
+            listeners = list(self.transform_listeners)
+            self.transform_cv.notify_all()
+        for listener in listeners:
+            listener(version)
+
+    def add_transform_listener(self, callback):
+        """Register a function to be called with the version number of each
+        transform update (see `on_locate`)
+
+        Callbacks run on the locator thread, so they must return quickly.
+        """
+        with self.transform_cv:
+            self.transform_listeners.append(callback)
+
+    def remove_transform_listener(self, callback):
+        with self.transform_cv:
+            self.transform_listeners.remove(callback)
+
+    def wait_transform(self, after_version=0, timeout=None):
+        """Wait for a transform update newer than `after_version`
+
+        Returns (version, data), or (after_version, None) on timeout or if
+        capture is stopped.
+        """
+        with self.transform_cv:
+            self.transform_cv.wait_for(
+                lambda: self.transform_version > after_version or not self.running, timeout)
+            if self.transform_version <= after_version or not self.running:
+                return after_version, None
+            return self.transform_version, self.transform_update
+
+    def resume_version(self, last_event_id):
+        """Get the transform version to resume an event stream from
+
+        `last_event_id` is a client's `Last-Event-ID` header, as str or bytes,
+        or None. A malformed id, or one newer than the current version (as
+        after a server restart, when versions start again from 0), resumes
+        from 0, so that the client is sent the current transform.
+        """
+        try:
+            version = int(last_event_id)
+        except (TypeError, ValueError):
+            return 0
+        with self.transform_cv:
+            if version < 0 or version > self.transform_version:
+                return 0
+        return version
+
+    def transform_events(self, last_version=0, keepalive=15.0):
+        """Generate a server-sent events stream of transform updates
+
+        Each update is sent as an event with the version as its id, so that
+        clients reconnecting with `Last-Event-ID` don't receive an update
+        they've already seen. `last_version` may be the client's raw
+        `Last-Event-ID` (see `resume_version`). A comment is sent every
+        `keepalive` seconds without an update.
+        """
+        version = self.resume_version(last_version)
+        while self.running:
+            new_version, data = self.wait_transform(version, keepalive)
+            if data is None:
+                yield b': keepalive\n\n'
+                continue
+            version = new_version
+            yield format_transform_event(version, data)
+
     def latest_normalized_transform(self):
         """Get the latest transform solution normalized by image size
 
@@ -140,72 +930,291 @@ class Video(object):
         scale[2, 2] = 1.
         return np.dot(transform, scale)
 
-    def markup(self, image):
+    def markup(self, image, out=None):
+        """Return a copy of `image` with the fiducials and electrode grid drawn on
+
+        The markup is rendered into an Overlay only when the integer pixel
+        positions of the fiducials or electrodes change, and otherwise just
+        composited onto the copy. If provided, the copy is made into `out`.
+        """
         # Make a copy so we don't modify the original np array
-        image = image.copy()
+        if out is None:
+            image = image.copy()
+        else:
+            np.copyto(out, image)
+            image = out
+        if self.grid_finder is None:
+            return image
         transform, fiducials = self.grid_finder.latest()
-        for f in fiducials:
-            mark_fiducial(image, f.corners)
+        fiducials = [f.corners for f in fiducials]
 
+        key = np.array(fiducials, dtype=np.int32).tobytes()
         if transform is not None:
-            mark_template(image, self.grid_layout, transform)
+            key += template_polylines(self.grid_layout, transform).tobytes()
+        with self.overlay_lock:
+            if self.overlay is None or self.overlay[0] != key:
+                self.overlay = (key, render_overlay(image.shape, self.grid_layout, transform, fiducials))
+            overlay = self.overlay[1]
 
+        overlay.apply(image)
         return image
 
-    def get_buffer(self, index):
-        image = self.frames[index]
-        if self.flip:
-            image = np.flip(image, axis=(0,1))
+    # Margin around the electrode grid when cropping, as a fraction of its size
+    CROP_MARGIN = 0.1
+
+    def crop_region(self):
+        """Get the (x, y, w, h) image region covering the electrode grid, or
+        None if the grid isn't located
+        """
+        if self.grid_finder is None:
+            return None
+        transform, _ = self.grid_finder.latest()
+        if transform is None:
+            return None
+        points = template_polylines(self.grid_layout, transform).reshape((-1, 2))
+        if len(points) == 0:
+            return None
+        x, y, w, h = cv2.boundingRect(points)
+        pad = int(max(w, h) * self.CROP_MARGIN)
+        x0, y0 = max(x - pad, 0), max(y - pad, 0)
+        x1, y1 = min(x + w + pad, self.WIDTH), min(y + h + pad, self.HEIGHT)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    @staticmethod
+    def _buffer(buffers, name, shape):
+        """Get a reusable image buffer from a variant's buffers; must hold its encode lock"""
+        buf = buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.uint8)
+            buffers[name] = buf
+        return buf
+
+    def render_variant(self, image, variant, buffers=None):
+        """Apply a variant's markup, crop and scaling to a frame
+
+        The result may be `image` itself or a view of it, or one of `buffers`
+        (a VariantCache's buffers), which is reused for the next frame of the
+        variant, so it must be used before the variant's encode lock is
+        released. New buffers are allocated if `buffers` isn't provided.
+        """
+        if buffers is None:
+            buffers = {}
+        if variant.markup:
+            with _markup_timer.time():
+                image = self.markup(image, self._buffer(buffers, 'markup', image.shape))
+        if variant.view == 'board':
+            transform = self.grid_finder.latest()[0] if self.grid_finder is not None else None
+            w, h = self.rectifier.size
+            with _rectify_timer.time():
+                image = self.rectifier.rectify(
+                    image, transform, self._buffer(buffers, 'board', (h, w) + image.shape[2:]))
+        elif variant.crop == 'grid':
+            region = self.crop_region()
+            if region is not None:
+                x, y, w, h = region
+                image = image[y:y+h, x:x+w]
+        if variant.scale != 1.0:
+            h, w = image.shape[:2]
+            size = (max(1, int(round(w * variant.scale))), max(1, int(round(h * variant.scale))))
+            out = self._buffer(buffers, 'scaled', (size[1], size[0], image.shape[2]))
+            image = cv2.resize(image, size, dst=out, interpolation=cv2.INTER_AREA)
         return image
 
-    def latest_jpeg(self, min_frame_num=0, markup=False):
+    def encoded_frame(self, frame, variant):
+        """Get the JPEG encoding of a borrowed frame, encoding it only if no
+        other client already has
+
+        Returns (frame_num, jpeg bytes). If a newer frame has already been
+        encoded, that one is returned instead.
+        """
+        cache = self.variant_cache(variant)
+
+        # Serialize encoding of each variant, so clients waiting on the same
+        # frame pick up the first one's result instead of encoding it again
+        with cache.lock:
+            cached = cache.latest
+            if cached is not None and cached[0] >= frame.number:
+                return cached
+
+            if self.encode_slots is not None:
+                self.encode_slots.acquire()
+            try:
+                image = self.render_variant(frame.image, variant, cache.buffers)
+                with _encode_timer.time():
+                    (flag, encoded_image) = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, variant.quality])
+            finally:
+                if self.encode_slots is not None:
+                    self.encode_slots.release()
+            if not flag:
+                print("Error encoding image %d" % frame.number)
+                return frame.number, None
+
+            result = (frame.number, encoded_image.tobytes())
+            cache.latest = result
+        metrics.REGISTRY.counter(
+            'pdcam_jpeg_encodes_total', "JPEG encodes, by variant", **variant._asdict()).inc()
+        if frame.timestamp is not None:
+            _frame_age.observe(time.monotonic() - frame.timestamp)
+        return result
+
+    def latest_jpeg(self, min_frame_num=0, markup=False, quality=None, scale=1.0, crop=None, view='camera'):
         """Get the latest capture as a JPEG
 
         min_frame_num can be used for sequential calls to prevent receiving the
-        same frame twice.
+        same frame twice. See StreamVariant for the encoding options.
         """
         if min_frame_num is None:
             min_frame_num = 0
-        # Hold the global lock just long enough to read self.active_buffer and get the frame lock
-        self.frame_cv.acquire()
-        self.frame_cv.wait_for(lambda: self.frame_number >= min_frame_num)
-        frame_num = self.frame_number
-        with self.frame_locks[self.active_buffer]:
-            self.frame_cv.release()
-            if markup:
-                image = self.markup(self.get_buffer(self.active_buffer))
-            else:
-                image = self.get_buffer(self.active_buffer)
-            (flag, encoded_image) = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            if not flag:
-                print("Error encoding jpeg")
+        if quality is None:
+            quality = self.JPEG_QUALITY
+        variant = StreamVariant.create(markup, quality, scale, crop, view)
+        frame = self.borrow_frame(min_frame_num)
+        if frame is None:
+            return None, self.frame_number
+        with frame:
+            frame_num, jpeg = self.encoded_frame(frame, variant)
+
+        return jpeg, frame_num
 
-        return bytearray(encoded_image), frame_num
+    def electrode_stats(self, min_frame_num=0):
+        """Get per-electrode statistics of the latest frame (see
+        `ElectrodeSampler.sample`)
+
+        Returns (ids, stats, frame_num), where ids are the electrode IDs of
+        the stats' rows, from the same layout as the stats even if the layout
+        is switched meanwhile. Stats are None if the grid isn't located.
+        Each frame is sampled at most once, however many clients ask for it.
+        """
+        frame = self.borrow_frame(min_frame_num or 0)
+        if frame is None:
+            with self.electrode_lock:
+                return self.sampler.ids, None, self.frame_number
+        with frame:
+            with self.electrode_lock:
+                cached = self.electrode_cache
+                if cached is not None and cached[0] >= frame.number:
+                    return cached[1], cached[2], cached[0]
+                sampler = self.sampler
+                transform = self.grid_finder.latest()[0] if self.grid_finder is not None else None
+                with _sample_timer.time():
+                    stats = sampler.sample(frame.image, transform)
+                self.electrode_cache = (frame.number, sampler.ids, stats)
+        return sampler.ids, stats, frame.number
 
-    def mjpeg_frame_generator(self, markup=False):
+    def variant_cache(self, variant):
+        """Get the VariantCache of a variant, creating it if needed
+
+        Only `MAX_CACHED_VARIANTS` caches are kept for variants which aren't
+        being streamed; the least recently used are dropped. A cache dropped
+        while in use is simply discarded when its encode finishes.
+        """
+        with self.variant_lock:
+            cache = self.variant_caches.get(variant)
+            if cache is None:
+                cache = self.variant_caches[variant] = VariantCache()
+            self.variant_caches.move_to_end(variant)
+            excess = len(self.variant_caches) - self.MAX_CACHED_VARIANTS
+            for v in list(self.variant_caches):
+                if excess <= 0:
+                    break
+                if v not in self.broadcasters:
+                    del self.variant_caches[v]
+                    excess -= 1
+        return cache
+
+    def subscribe(self, variant, client):
+        """Subscribe a StreamClient to the broadcast of a variant
+
+        Returns the FrameBroadcaster, from which the client must be removed
+        with `unsubscribe`.
+        """
+        with self.variant_lock:
+            broadcaster = self.broadcasters.get(variant)
+            if broadcaster is None:
+                broadcaster = self.broadcasters[variant] = FrameBroadcaster(self, variant)
+            broadcaster.add_client(client)
+        return broadcaster
+
+    def unsubscribe(self, broadcaster, client):
+        """Remove a client from its broadcaster
+
+        When the last client leaves, the broadcaster and the variant's
+        encoding state are dropped.
+        """
+        with self.variant_lock:
+            if broadcaster.unsubscribe(client) == 0 and self.broadcasters.get(broadcaster.variant) is broadcaster:
+                del self.broadcasters[broadcaster.variant]
+                self.variant_caches.pop(broadcaster.variant, None)
+
+    def stream_stats(self):
+        """Get per-client statistics for all active MJPEG streams
+        """
+        with self.variant_lock:
+            broadcasters = list(self.broadcasters.values())
+        return [stats for b in broadcasters for stats in b.stats()]
+
+    def metric_samples(self, labels={}):
+        """Gauges of the state of this Video's streams and locator, as
+        `pdcam.metrics.Registry.render` extra samples with `labels`
+        """
+        streams = self.stream_stats()
+        extra = [
+            ('pdcam_frame_number', "Number of the latest captured frame", 'gauge', labels, self.frame_number),
+            ('pdcam_stream_clients', "Connected MJPEG stream clients", 'gauge', labels, len(streams)),
+            ('pdcam_stream_dropped_frames', "Frames dropped for slow MJPEG clients", 'gauge', labels,
+                sum(s['dropped'] for s in streams)),
+        ]
+        recorder = self.recorder
+        if recorder is not None:
+            extra.append(('pdcam_recorded_frames', "Frames written to the current recording session", 'gauge',
+                labels, recorder.recorded))
+            extra.append(('pdcam_recording_skipped_frames', "Frames skipped by the current recording session",
+                'gauge', labels, recorder.skipped))
+        if self.grid_finder is not None:
+            transform, _ = self.grid_finder.latest()
+            extra.append(('pdcam_grid_located', "Whether the grid is currently located", 'gauge', labels,
+                int(transform is not None)))
+            error = self.grid_finder.latest_solution.error
+            if error is not None:
+                extra.append(('pdcam_grid_reprojection_error_pixels',
+                    "RMS reprojection error of the fiducial corners in the latest grid detection", 'gauge', labels,
+                    error))
+        return extra
+
+    def render_metrics(self):
+        """Render pipeline metrics in the Prometheus text format
+
+        Includes the stage timers from `pdcam.metrics.REGISTRY`, plus the
+        state of this Video's streams and locator, read at the time of the call.
+        """
+        return metrics.render(self.metric_samples())
+
+    def mjpeg_frame_generator(self, markup=False, quality=None, name="", scale=1.0, crop=None, view='camera'):
         """Return a generator which will yield JPEG encoded frames as they become available
         Bytes are preceded by a `--frame` separator, and a content header,
         is included so it can be returned as part of a HTTP multi-part response.
+
+        Frames are encoded once per variant by a FrameBroadcaster; if the client
+        doesn't keep up, stale frames are dropped. The generator ends when the
+        video is stopped.
         """
-        last_fn = 0
-        while True:
-            data = None
-            with self.frame_cv:
-                if self.frame_number > last_fn:
-                    last_fn = self.frame_number
-                    if markup:
-                        image = self.markup(self.get_buffer(self.active_buffer))
-                    else:
-                        image = self.get_buffer(self.active_buffer)
-                    # encode the frame in JPEG format
-                    (flag, encoded_image) = cv2.imencode(".jpg", image)
-
-                    if not flag:
-                        print("Error encoding image %d" % self.frame_number)
-                        continue
-
-                    data = b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n'
-                else:
-                    self.frame_cv.wait()
-            if data is not None:
-                yield data
\ No newline at end of file
+        if quality is None:
+            quality = self.MJPEG_QUALITY
+        variant = StreamVariant.create(markup, quality, scale, crop, view)
+        client = StreamClient(name, variant, max_queue=2)
+        broadcaster = self.subscribe(variant, client)
+        try:
+            while True:
+                item = client.get()
+                if item is None:
+                    return
+                _, jpeg = item
+                # Yield the shared encoded bytes as-is, rather than copying them
+                # into a new multipart chunk for each client
+                yield b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n'
+                yield jpeg
+                yield b'\r\n'
+        finally:
+            self.unsubscribe(broadcaster, client)
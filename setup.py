@@ -17,8 +17,12 @@ setup(
         'flask-cors',
         'matplotlib',
         'numpy',
+        'scipy',
     ],
     extras_require={
+        'asgi': [
+            'uvicorn',
+        ],
         'testing': [
             'pytest',
             'pytest_benchmark',
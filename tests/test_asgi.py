@@ -0,0 +1,144 @@
+import asyncio
+import cv2
+import json
+import numpy as np
+import pytest
+from pdcam.asgi import create_asgi_app
+from pdcam.grid import GridReference
+from pdcam.sources import SyntheticSource
+from pdcam.video import Video
+
+
+@pytest.fixture
+def video():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(reference, [[1, 2], [3, 4]], source=source)
+    yield video
+    video.stop()
+
+async def request(app, path, query=b'', headers=(), on_body=None):
+    """Call the app, and return (status, headers, body messages)
+
+    The client disconnects once `on_body`, called with each body message,
+    returns True.
+    """
+    messages = []
+    disconnect = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request'}
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+        if message['type'] == 'http.response.body' and on_body is not None and on_body(message):
+            disconnect.set()
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': list(headers),
+             'client': ('127.0.0.1', 1234)}
+    await asyncio.wait_for(app(scope, receive, send), 30)
+    return messages[0]['status'], dict(messages[0]['headers']), messages[1:]
+
+def is_jpeg(message):
+    return message['body'].startswith(b'\xff\xd8')
+
+def test_latest(video):
+    app = create_asgi_app(video)
+    status, headers, bodies = asyncio.run(request(app, '/latest', b'min_frame=2'))
+    assert status == 200
+    assert int(headers[b'x-frame-number']) >= 2
+    image = cv2.imdecode(np.frombuffer(bodies[0]['body'], dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image.shape == (Video.HEIGHT, Video.WIDTH, 3)
+
+    status, _, _ = asyncio.run(request(app, '/latest', b'crop=bogus'))
+    assert status == 400
+
+@pytest.mark.parametrize('path', ['/latest', '/electrodes'])
+def test_bad_min_frame(video, path):
+    app = create_asgi_app(video)
+    status, _, bodies = asyncio.run(request(app, path, b'min_frame=bogus'))
+    assert status == 400
+    status, _, _ = asyncio.run(request(app, path, headers=[(b'x-min-frame-number', b'1.5')]))
+    assert status == 400
+
+def test_long_poll_ends_on_stop(video):
+    app = create_asgi_app(video)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # Wait for frames which will never be captured
+        polls = [asyncio.ensure_future(request(app, path, b'min_frame=1000000'))
+                 for path in ('/latest', '/electrodes')]
+        await asyncio.sleep(0.2)
+        assert not any(poll.done() for poll in polls)
+        await loop.run_in_executor(None, video.stop)
+        return await asyncio.gather(*polls)
+
+    (latest_status, _, _), (electrodes_status, _, bodies) = asyncio.run(run())
+    assert latest_status == 503
+    assert electrodes_status == 200
+    assert json.loads(bodies[0]['body'])['electrodes'] is None
+
+def test_transform(video):
+    video.wait_transform(0, timeout=10)
+    app = create_asgi_app(video)
+    status, _, bodies = asyncio.run(request(app, '/transform'))
+    assert status == 200
+    assert json.loads(bodies[0]['body'])['transform'] is not None
+
+def test_electrodes(video):
+    video.wait_transform(0, timeout=10)
+    app = create_asgi_app(video)
+    status, _, bodies = asyncio.run(request(app, '/electrodes', b'min_frame=2'))
+    assert status == 200
+    data = json.loads(bodies[0]['body'])
+    assert data['frame'] >= 2
+    assert data['electrodes']['ids'] == [1, 2, 3, 4]
+
+def test_video_stream(video):
+    app = create_asgi_app(video)
+    jpegs = []
+    clients = []
+
+    def on_body(message):
+        if is_jpeg(message):
+            jpegs.append(message['body'])
+            clients.append(video.stream_stats())
+        return len(jpegs) == 3
+
+    status, headers, bodies = asyncio.run(request(app, '/video', b'quality=60', on_body=on_body))
+    assert status == 200
+    assert headers[b'content-type'].startswith(b'multipart/x-mixed-replace')
+    assert bodies[0]['body'].startswith(b'--frame')
+    # The stream is a broadcaster client, so it's listed in the stream stats
+    assert clients[0][0]['name'] == '127.0.0.1'
+    assert clients[0][0]['quality'] == 60
+    # and unsubscribed once the client disconnects
+    assert video.stream_stats() == []
+
+def test_video_stream_ends_on_stop(video):
+    app = create_asgi_app(video)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        stopping = []
+
+        def on_body(message):
+            if is_jpeg(message) and not stopping:
+                stopping.append(loop.run_in_executor(None, video.stop))
+            return False
+
+        result = await request(app, '/video', on_body=on_body)
+        await stopping[0]
+        return result
+
+    status, _, bodies = asyncio.run(run())
+    assert status == 200
+    assert bodies[-1]['more_body'] is False
@@ -0,0 +1,46 @@
+import cv2
+import json
+import numpy as np
+import shutil
+from pdcam.batch import run_batch
+
+
+def load_refdata():
+    with open('tests/data/tags_ref.json') as f:
+        return json.loads(f.read())
+
+def test_batch_directory(tmp_path):
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    for i in range(6):
+        shutil.copy('tests/data/tags%d.jpg' % (i % 2 + 1), str(frames / ('%03d.jpg' % i)))
+    output = str(tmp_path / 'out.npz')
+
+    assert run_batch(load_refdata(), str(frames), output, workers=2, chunk_size=4, progress=False) == 6
+
+    data = np.load(output)
+    assert list(data['frame']) == list(range(6))
+    assert list(data['name']) == ['%03d.jpg' % i for i in range(6)]
+    assert data['found'].all()
+    assert data['transform'].shape == (6, 3, 3)
+    assert np.allclose(data['transform'][0], data['transform'][2])
+    assert (data['error'] < 1.0).all()
+    assert (data['matched'] == 3).all()
+    assert data['fiducial_corners'].shape == (18, 4, 2)
+    assert sorted(set(data['fiducial_label'])) == [0, 1, 2]
+
+def test_batch_video(tmp_path):
+    video = str(tmp_path / 'video.avi')
+    image = cv2.imread('tests/data/tags1.jpg')
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 10, (image.shape[1], image.shape[0]))
+    for _ in range(5):
+        writer.write(image)
+    writer.release()
+    output = str(tmp_path / 'out.npz')
+
+    assert run_batch(load_refdata(), video, output, workers=2, chunk_size=2, progress=False) == 5
+
+    data = np.load(output)
+    assert list(data['frame']) == list(range(5))
+    assert data['found'].all()
+    assert 'name' not in data
@@ -0,0 +1,90 @@
+"""Benchmarks of each stage of the pipeline
+
+Run just the benchmarks with `pytest tests/ --benchmark-only`, and compare
+against a saved baseline with `pdcam perfcheck` (see README).
+"""
+import cv2
+import itertools
+import json
+import pytest
+from pdcam.grid import GridLocator, GridReference, enhance, find_fiducials
+from pdcam.layouts import LAYOUTS
+from pdcam.plotting import mark_template, template_polygons
+from pdcam.sources import SyntheticSource
+from pdcam.video import StreamVariant, Video
+
+
+IMAGE = 'tests/data/tags1.jpg'
+
+def load_reference():
+    with open('tests/data/tags_ref.json') as f:
+        return GridReference.from_dict(json.loads(f.read()))
+
+def board_transform():
+    transform, _ = GridLocator(load_reference()).find_grid_transform(cv2.imread(IMAGE))
+    return transform
+
+class FakeFrame(object):
+    """Stands in for a FrameRef, with a new frame number each time so the
+    encode cache never hits"""
+    numbers = itertools.count(1)
+
+    def __init__(self, image):
+        self.image = image
+        self.number = next(self.numbers)
+        self.timestamp = None
+
+def test_benchmark_enhance(benchmark):
+    image = cv2.imread(IMAGE)
+    benchmark(enhance, image)
+
+@pytest.mark.parametrize('decimate', [1, 2])
+def test_benchmark_find_fiducials(benchmark, decimate):
+    image = cv2.imread(IMAGE)
+    detector = GridLocator(load_reference()).detector
+    fiducials = benchmark(find_fiducials, image, detector, decimate)
+    assert len(fiducials) == 3
+
+@pytest.mark.parametrize('version', sorted(LAYOUTS))
+def test_benchmark_template_polygons(benchmark, version):
+    transform = board_transform()
+    benchmark(template_polygons, LAYOUTS[version], transform)
+
+@pytest.mark.parametrize('version', sorted(LAYOUTS))
+def test_benchmark_mark_template(benchmark, version):
+    image = cv2.imread(IMAGE)
+    transform = board_transform()
+    benchmark(mark_template, image, LAYOUTS[version], transform)
+
+@pytest.mark.parametrize('quality', [50, 85, 95])
+def test_benchmark_encode(benchmark, quality):
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, [IMAGE], fps=5)
+    video = Video(None, [[]], source=source)
+    try:
+        image = cv2.resize(cv2.imread(IMAGE), (Video.WIDTH, Video.HEIGHT))
+        variant = StreamVariant.create(quality=quality)
+        _, jpeg = benchmark(lambda: video.encoded_frame(FakeFrame(image), variant))
+        assert jpeg is not None
+    finally:
+        video.stop()
+
+def test_benchmark_video_throughput(benchmark):
+    """Time to deliver 10 marked up frames to an MJPEG client, with the grid
+    being located in every captured frame"""
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, [IMAGE], fps=None)
+    video = Video(load_reference(), LAYOUTS['v4'], source=source)
+    generator = video.mjpeg_frame_generator(markup=True, name="benchmark")
+
+    def receive(n):
+        frames = 0
+        while frames < n:
+            if next(generator).startswith(b'--frame'):
+                frames += 1
+
+    try:
+        receive(1)
+        benchmark.pedantic(receive, args=(10,), rounds=3, iterations=1)
+        benchmark.extra_info['located'] = video.grid_finder.detect_count
+    finally:
+        generator.close()
+        video.stop()
@@ -0,0 +1,74 @@
+import cv2
+import json
+import numpy as np
+import pytest
+import time
+from pdcam.boards import BoardLocator, BoardRegistry
+from pdcam.grid import GridLocator, GridReference
+from pdcam.layouts import LAYOUTS
+from pdcam.sources import SyntheticSource
+from pdcam.video import Video
+
+
+def write_reference(path, labels, layout, **extra):
+    with open('tests/data/tags_ref.json') as f:
+        data = json.loads(f.read())
+    if labels is not None:
+        data['labels'] = labels
+    data['layout'] = layout
+    data.update(extra)
+    path.write_text(json.dumps(data))
+
+@pytest.fixture
+def registry(tmp_path):
+    write_reference(tmp_path / 'a.json', [0, 1, 2], 'v4')
+    write_reference(tmp_path / 'b.json', [10, 11, 12], 'v5', name='board-b')
+    # Not indexable without labels
+    write_reference(tmp_path / 'unlabelled.json', None, 'v3')
+    return BoardRegistry.from_path(str(tmp_path))
+
+def test_identify(registry):
+    assert sorted(registry.boards) == ['a', 'board-b']
+    assert registry.identify([2, 1, 0]).name == 'a'
+    assert registry.identify([10, 12]).name == 'board-b'
+    assert registry.identify([0, 1, 10]).name == 'a'
+    assert registry.identify([0, 10]) is None
+    assert registry.identify([99]) is None
+    assert registry.boards['board-b'].layout is LAYOUTS['v5']
+
+def test_duplicate_tag(registry):
+    reference = GridReference([[[0, 0], [1, 0], [1, 1], [0, 1]]], [], [11])
+    with pytest.raises(ValueError):
+        registry.add_reference('c', reference, LAYOUTS['v3'])
+
+def test_board_locator(registry):
+    image = cv2.imread('tests/data/tags1.jpg')
+    locator = BoardLocator(registry)
+    transform, fiducials = locator.find_grid_transform(image)
+    assert locator.board.name == 'a'
+    assert len(fiducials) == 3
+
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    expected, _ = GridLocator(reference).find_grid_transform(image)
+    np.testing.assert_allclose(transform, expected, rtol=1e-6, atol=1e-6)
+
+    # Tags of no registered board are ignored
+    only_b = BoardRegistry()
+    only_b.add(registry.boards['board-b'])
+    transform, fiducials = BoardLocator(only_b).find_grid_transform(image)
+    assert transform is None
+    assert fiducials == []
+
+def test_video_identifies_board(registry):
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(None, LAYOUTS['v3'], source=source, boards=registry)
+    try:
+        deadline = time.monotonic() + 10
+        while video.transform_data()['board'] is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert video.transform_data()['board'] == 'a'
+        assert video.grid_layout is LAYOUTS['v4']
+        assert video.sampler.layout is LAYOUTS['v4']
+    finally:
+        video.stop()
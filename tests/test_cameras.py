@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import pytest
+import time
+from pdcam.asgi import create_asgi_app
+from pdcam.cameras import CameraConfig, CameraGroup, load_camera_configs
+from pdcam.grid import GridReference
+from pdcam.server import create_group_app
+from pdcam.sources import SyntheticSource
+from pdcam.video import Video
+
+
+def load_reference():
+    with open('tests/data/tags_ref.json') as f:
+        return GridReference.from_dict(json.loads(f.read()))
+
+def make_configs():
+    return [
+        CameraConfig(camera_id, load_reference(), [[1, 2], [3, 4]], False,
+                     SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30, seed=seed))
+        for seed, camera_id in enumerate(['left', 'right'])
+    ]
+
+def wait_located(group, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(c['located'] for c in group.info()):
+            return True
+        time.sleep(0.1)
+    return False
+
+def test_load_camera_configs(tmp_path):
+    path = tmp_path / 'cameras.json'
+    path.write_text(json.dumps([
+        {'id': 'a', 'reference': os.path.abspath('tests/data/tags_ref.json'), 'layout': 'v4', 'source': 'synthetic'},
+        {'id': 'b', 'flip': True, 'source': 'synthetic'},
+    ]))
+    configs = load_camera_configs(str(path))
+    assert [c.id for c in configs] == ['a', 'b']
+    assert len(configs[0].reference.fiducials) == 3
+    assert configs[1].reference is None
+    assert configs[1].flip
+
+    path.write_text(json.dumps([{'id': 'a/b'}]))
+    with pytest.raises(ValueError):
+        load_camera_configs(str(path))
+
+def test_camera_routes():
+    group = CameraGroup(make_configs())
+    try:
+        client = create_group_app(group).test_client()
+        assert wait_located(group)
+        assert [c['id'] for c in client.get('/cameras').get_json()] == ['left', 'right']
+        for path in ['/transform', '/cam/left/transform', '/cam/right/transform']:
+            response = client.get(path)
+            assert response.status_code == 200
+            assert response.get_json()['transform'] is not None
+        response = client.get('/cam/right/latest?min_frame=1')
+        assert response.content_type == 'image/jpeg'
+        assert client.get('/cam/missing/transform').status_code == 404
+
+        # A malformed Last-Event-ID resumes from the start, rather than failing
+        response = client.get('/transform/events', headers={'Last-Event-ID': 'bogus'})
+        assert response.status_code == 200
+        assert next(response.response).startswith(b'id: ')
+        response.close()
+
+        text = client.get('/metrics').get_data(as_text=True)
+        assert 'pdcam_frame_number{camera="left"}' in text
+        assert 'pdcam_frame_number{camera="right"}' in text
+    finally:
+        group.stop()
+
+def test_shared_locate_pool():
+    group = CameraGroup(make_configs(), locate_workers=1, encode_slots=1)
+    try:
+        # A single worker locates both boards
+        assert len(group.locate_pool.workers) == 1
+        assert wait_located(group)
+        for camera in group.cameras.values():
+            assert camera.grid_finder.pool is group.locate_pool
+            assert len(camera.latest_transform()[1]) == 3
+    finally:
+        group.stop()
+
+def test_asgi_camera_routes():
+    group = CameraGroup(make_configs())
+    app = create_asgi_app(group)
+
+    async def get(path):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+        await app(scope, receive, send)
+        return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+    try:
+        assert wait_located(group)
+        status, body = asyncio.run(get('/cam/right/transform'))
+        assert status == 200
+        assert json.loads(body)['transform'] is not None
+        status, _ = asyncio.run(get('/cam/missing/transform'))
+        assert status == 404
+    finally:
+        group.stop()
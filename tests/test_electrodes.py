@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+from pdcam.electrodes import ElectrodeSampler, stats_to_bytes, stats_to_dict
+from pdcam.plotting import template_polylines
+
+
+LAYOUT = [
+    [None, 7, 8],
+    [9, 10, 10],
+]
+TRANSFORM = np.array([[40.0, 2.0, 100.0], [-1.5, 41.0, 80.0], [1e-5, -2e-5, 1.0]])
+
+def test_electrode_stats():
+    image = np.full((300, 400, 3), 50, dtype=np.uint8)
+    # Fill electrode 8 (the second polygon) with a color
+    polygons = template_polylines(LAYOUT, TRANSFORM)
+    cv2.fillPoly(image, [polygons[1]], (30, 60, 200))
+
+    sampler = ElectrodeSampler(LAYOUT)
+    assert sampler.ids == [7, 8, 9, 10]
+    stats = sampler.sample(image, TRANSFORM)
+    assert np.allclose(stats['mean'][1], (200, 60, 30), atol=1)
+    assert np.allclose(stats['mean'][0], 50)
+    assert np.all(stats['variance'][[0, 2, 3]] < 1e-3)
+    assert np.all(np.isnan(stats['change']))
+    # Electrode 10 covers two cells
+    assert abs(stats['pixels'][3] - 2 * stats['pixels'][2]) < 0.1 * stats['pixels'][2]
+
+    image[:] = 50
+    stats = sampler.sample(image, TRANSFORM)
+    assert abs(stats['change'][1] - 48.4) < 1
+    assert np.allclose(stats['change'][[0, 2, 3]], 0)
+
+    data = stats_to_dict(sampler.ids, stats)
+    assert data['ids'] == [7, 8, 9, 10]
+    assert len(stats_to_bytes(sampler.ids, stats)) == 4 * 7 * 4
+
+def test_no_transform():
+    assert ElectrodeSampler(LAYOUT).sample(np.zeros((10, 10, 3), dtype=np.uint8), None) is None
@@ -1,13 +1,202 @@
 import cv2
 import json
-from pdcam.grid import GridReference, find_grid_transform
+import numpy as np
+import pytest
+from pdcam.grid import Fiducial, GridLocator, GridReference, find_grid_transform, sort_fiducials
 import pytest_benchmark
 
 
+def load_reference(path='tests/data/cal.json'):
+    with open(path) as f:
+        refdata = json.loads(f.read())
+    return GridReference.from_dict(refdata)
+
+def grid_error(transform, expected):
+    """Max pixel distance between electrode grid points projected by each transform"""
+    points = np.array([[[x, y] for x in range(15) for y in range(9)]], dtype=np.float64)
+    a = cv2.perspectiveTransform(points, transform)
+    b = cv2.perspectiveTransform(points, expected)
+    return np.max(np.linalg.norm(a - b, axis=2))
+
 def test_benchmark(benchmark):
     image = cv2.imread('tests/data/qr1.jpg')
-    with open('tests/data/cal.json') as f:
-        refdata = json.loads(f.read())
-    reference = GridReference.from_dict(refdata)
+    reference = load_reference()
     benchmark(find_grid_transform, reference, image)
-    
\ No newline at end of file
+
+@pytest.mark.parametrize('decimate', [1, 2, 4])
+@pytest.mark.parametrize('name', ['tags1', 'tags2'])
+def test_benchmark_locator(benchmark, name, decimate):
+    # Images with tags, so that detection and corner refinement are included
+    image = cv2.imread('tests/data/%s.jpg' % name)
+    locator = GridLocator(load_reference('tests/data/tags_ref.json'), decimate=decimate)
+    transform, _ = benchmark(locator.find_grid_transform, image)
+    assert transform is not None
+
+@pytest.mark.parametrize('decimate', [1, 2, 3])
+@pytest.mark.parametrize('name', ['tags1', 'tags2'])
+def test_transform_accuracy(name, decimate):
+    with open('tests/data/tags_expected.json') as f:
+        expected = json.loads(f.read())[name]
+    locator = GridLocator(load_reference('tests/data/tags_ref.json'), decimate=decimate)
+    transform, fiducials = locator.find_grid_transform(cv2.imread('tests/data/%s.jpg' % name))
+    assert len(fiducials) == 3
+    assert grid_error(transform, np.dot(expected, locator.H0)) < 0.5
+
+def test_tracking_matches_full_scan():
+    reference = load_reference('tests/data/tags_ref.json')
+    image = cv2.imread('tests/data/tags1.jpg')
+    full_transform, _ = GridLocator(reference).find_grid_transform(image)
+
+    locator = GridLocator(reference, track=True, refresh_frames=5)
+    for _ in range(3):
+        transform, fiducials = locator.find_grid_transform(image)
+        assert len(fiducials) == 3
+        assert grid_error(transform, full_transform) < 0.1
+    assert locator.tracked_count == 2
+
+def test_missing_and_extra_fiducials():
+    reference = load_reference('tests/data/tags_ref.json')
+    locator = GridLocator(reference)
+    image = cv2.imread('tests/data/tags1.jpg')
+    full_transform, fiducials = locator.find_grid_transform(image)
+    assert locator.last_solution.matched == 3
+    assert locator.last_solution.inliers == 12
+    assert locator.last_solution.error < 0.5
+
+    # The reference has no labels, so they're learned from the complete set
+    assert locator.labels == {0: 0, 1: 1, 2: 2}
+
+    # A missing tag still gives a usable transform
+    solution = locator.solve(fiducials[:2])
+    assert solution.matched == 2
+    assert grid_error(solution.transform, full_transform) < 10
+
+    # A spurious copy of a tag, and a tag not on the board, are rejected
+    spurious = [Fiducial([[10, 10], [30, 10], [30, 30], [10, 30]], fiducials[0].label),
+                Fiducial([[50, 50], [70, 50], [70, 70], [50, 70]], 99)]
+    solution = locator.solve(fiducials + spurious)
+    assert solution.matched == 3
+    assert solution.inliers == 12
+    assert grid_error(solution.transform, full_transform) < 0.1
+
+    # One tag isn't enough
+    assert locator.solve(fiducials[:1]).transform is None
+
+def test_unlabelled_reference_subset():
+    reference = load_reference('tests/data/tags_ref.json')
+    image = cv2.imread('tests/data/tags1.jpg')
+    full_transform, fiducials = GridLocator(reference).find_grid_transform(image)
+
+    # Two tags are matched by position, but IDs aren't learned from them
+    locator = GridLocator(reference)
+    solution = locator.solve(fiducials[1:])
+    assert solution.matched == 2
+    assert grid_error(solution.transform, full_transform) < 10
+    assert locator.labels is None
+
+def test_unlabelled_reference_extra_tag():
+    reference = load_reference('tests/data/tags_ref.json')
+    image = cv2.imread('tests/data/tags1.jpg')
+    full_transform, fiducials = GridLocator(reference).find_grid_transform(image)
+
+    # An unknown tag in the first image doesn't stop the board being located,
+    # and the board's tag IDs are still learned
+    locator = GridLocator(reference)
+    extra = Fiducial([[50, 50], [70, 50], [70, 70], [50, 70]], 42)
+    solution = locator.solve(fiducials + [extra])
+    assert solution.matched == 3
+    assert grid_error(solution.transform, full_transform) < 0.1
+    assert locator.labels == {0: 0, 1: 1, 2: 2}
+
+def test_repeated_tag_ids():
+    image = cv2.imread('tests/data/tags1.jpg')
+    reference = load_reference('tests/data/tags_ref.json')
+    full_transform, fiducials = GridLocator(reference).find_grid_transform(image)
+    same_id = [Fiducial(f.corners, 0) for f in fiducials]
+    extra = Fiducial([[50, 50], [70, 50], [70, 70], [50, 70]], 0)
+
+    # Unlabelled, and labelled with a repeated ID: both match by position
+    labelled = GridReference(reference.fiducials, reference.control_points, [0, 0, 0])
+    for ref in [reference, labelled]:
+        locator = GridLocator(ref)
+        for _ in range(2):
+            solution = locator.solve(same_id + [extra])
+            assert solution.matched == 3
+            assert grid_error(solution.transform, full_transform) < 0.1
+        assert locator.labels is None
+
+def random_fiducials(n, seed=0):
+    """Generate n square fiducials on a grid, and a rotated, shuffled copy of them"""
+    rng = np.random.default_rng(seed)
+    cells = rng.choice(100, n, replace=False)
+    origins = np.array([(c % 10, c // 10) for c in cells], dtype=np.float64) * 60.0
+    square = np.array([[0, 0], [30, 0], [30, 30], [0, 30]], dtype=np.float64)
+    reference = origins[:, None, :] + square[None, :, :]
+
+    angle = rng.uniform(-np.pi, np.pi)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    found = np.dot(reference, rotation.T) + rng.normal(0, 0.5, reference.shape) + 200
+    order = rng.permutation(n)
+    return reference, found, order
+
+def spurious_fiducial(reference, found):
+    """A fiducial in an empty cell of a `random_fiducials` grid, placed as its found fiducials are"""
+    n = len(reference)
+    A, _, _, _ = np.linalg.lstsq(np.c_[reference.reshape((-1, 2)), np.ones(4 * n)], found.reshape((-1, 2)), rcond=None)
+    used = set(map(tuple, np.round(reference[:, 0] / 60.0).astype(int).tolist()))
+    cell = next((x, y) for y in range(10) for x in range(10) if (x, y) not in used)
+    square = np.array([[0, 0], [30, 0], [30, 30], [0, 30]], dtype=np.float64) + np.array(cell) * 60.0
+    return Fiducial(np.dot(np.c_[square, np.ones(4)], A).tolist(), 0)
+
+@pytest.mark.parametrize('n', [3, 8, 20])
+def test_sort_fiducials(n):
+    for seed in range(10):
+        reference, found, order = random_fiducials(n, seed)
+        _, matched = sort_fiducials(reference.tolist(), found[order].tolist())
+        assert np.allclose(matched, found)
+
+@pytest.mark.parametrize('labelled', [True, False])
+def test_match_fiducials(labelled):
+    reference, found, order = random_fiducials(8)
+    labels = [int(l) for l in np.arange(8) + 10]
+    ref = GridReference(reference.tolist(), [], labels if labelled else None)
+    fiducials = [Fiducial(found[i].tolist(), labels[i]) for i in order]
+    src, dst, matched = GridLocator(ref)._match(fiducials)
+    assert matched == 8
+    # Each fiducial's corners are paired with its own reference corners
+    for s, d in zip(src.reshape((8, 4, 2)), dst.reshape((8, 4, 2))):
+        k = np.argmin(np.sum(np.abs(reference - s), axis=(1, 2)))
+        assert np.allclose(d, found[k])
+
+@pytest.mark.parametrize('n', [3, 8, 20])
+def test_match_by_position_missing_and_spurious(n):
+    for seed in range(10):
+        reference, found, order = random_fiducials(n, seed)
+        # One tag is missing, and one which isn't on the board lies between the others
+        fiducials = [Fiducial(found[i].tolist(), 0) for i in order[1:]] + [spurious_fiducial(reference, found)]
+        matched = GridLocator(GridReference(reference.tolist(), []))._match_by_position(fiducials)
+        assert len(matched) == n - 1
+        for i, f in matched:
+            assert np.allclose(f.corners, found[i])
+
+@pytest.mark.parametrize('tags', ['all', 'missing', 'missing_and_spurious'])
+@pytest.mark.parametrize('labelled', [True, False])
+@pytest.mark.parametrize('n', [3, 8, 20])
+def test_benchmark_match(benchmark, n, labelled, tags):
+    reference, found, order = random_fiducials(n)
+    labels = [int(l) for l in np.arange(n) + 10]
+    fiducials = [Fiducial(found[i].tolist(), labels[i]) for i in order]
+    expected = n
+    if tags != 'all':
+        fiducials = fiducials[1:]
+        expected = n - 1
+    if tags == 'missing_and_spurious':
+        fiducials.append(spurious_fiducial(reference, found))
+    locator = GridLocator(GridReference(reference.tolist(), [], labels if labelled else None))
+    if labelled:
+        _, _, matched = benchmark(locator._match, fiducials)
+    else:
+        # The matcher the locator uses until tag IDs are learned, or when
+        # they're repeated
+        matched = len(benchmark(locator._match_by_position, fiducials))
+    assert matched == expected
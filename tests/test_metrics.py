@@ -0,0 +1,21 @@
+from pdcam.metrics import Registry
+
+
+def test_histogram_render():
+    registry = Registry()
+    h = registry.histogram('test_seconds', "Test timings", buckets=(0.01, 0.1), stage='a')
+    assert registry.histogram('test_seconds', stage='a') is h
+    h.observe(0.005)
+    h.observe(0.05)
+    h.observe(5.0)
+    registry.counter('test_total', "Test count").inc(3)
+
+    text = registry.render([('test_gauge', "A gauge", 'gauge', {}, 2)])
+    lines = text.splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{le="0.01",stage="a"} 1' in lines
+    assert 'test_seconds_bucket{le="0.1",stage="a"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf",stage="a"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+    assert 'test_total 3' in lines
+    assert 'test_gauge 2' in lines
@@ -0,0 +1,38 @@
+import numpy as np
+from pdcam.plotting import mark_fiducial, mark_template, render_overlay, template_polygons, template_polylines
+
+
+LAYOUT = [
+    [None, 1, 2],
+    [3, 4, None],
+]
+TRANSFORM = np.array([[36.0, 1.0, 260.0], [0.5, 36.0, 200.0], [1e-5, 2e-5, 1.0]])
+
+def test_template_polygons():
+    polygons = template_polygons(LAYOUT, TRANSFORM)
+    assert sorted(polygons.keys()) == [(0, 1), (1, 0), (1, 1), (2, 0)]
+    # Top-left corner of electrode (1, 0), inset by the margin
+    x, y, w = np.dot(TRANSFORM, [1.15, 0.15, 1.0])
+    assert np.allclose(polygons[(1, 0)][0], (x / w, y / w))
+
+def test_template_polylines_cached():
+    points = template_polylines(LAYOUT, TRANSFORM)
+    assert points.shape == (4, 4, 2)
+    assert points.dtype == np.int32
+    assert template_polylines(LAYOUT, TRANSFORM.copy()) is points
+    polygons = template_polygons(LAYOUT, TRANSFORM)
+    assert np.array_equal(points, np.array(list(polygons.values())).astype(np.int32))
+
+def test_overlay_matches_drawing():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    fiducials = [[(20.3, 30.7), (60.1, 31.2), (59.8, 70.4), (19.6, 69.9)]]
+
+    expected = image.copy()
+    mark_fiducial(expected, fiducials[0])
+    mark_template(expected, LAYOUT, TRANSFORM)
+
+    overlay = render_overlay(image.shape, LAYOUT, TRANSFORM, fiducials)
+    actual = image.copy()
+    overlay.apply(actual)
+    assert np.array_equal(actual, expected)
@@ -0,0 +1,103 @@
+import cv2
+import json
+import numpy as np
+import os
+import pytest
+import time
+from pdcam.grid import Fiducial, GridReference
+from pdcam.recording import SessionReader, SessionSource, SessionWriter
+from pdcam.sources import SyntheticSource
+from pdcam.video import Video
+
+
+def make_image(i, shape=(48, 64, 3)):
+    return np.full(shape, i, dtype=np.uint8)
+
+def test_raw_session(tmp_path):
+    path = str(tmp_path / 'raw.session')
+    transform = np.arange(9, dtype=float).reshape(3, 3)
+    fiducials = [Fiducial([[0, 0], [1, 0], [1, 1], [0, 1]], 7)]
+    with SessionWriter(path, 64, 48, 3, encoding='raw', metadata={'board': 'a'}) as writer:
+        assert writer.append(10, 100.0, image=make_image(1), transform=transform, transform_frame=9,
+                             error=0.5, fiducials=fiducials)
+        assert writer.append(12, 100.1, image=make_image(2))
+        assert writer.append(15, 100.2, image=make_image(3))
+        # Full
+        assert not writer.append(16, 100.3, image=make_image(4))
+
+    with SessionReader(path) as reader:
+        assert len(reader) == 3
+        assert reader.metadata == {'board': 'a'}
+        assert reader.find(12) == 1
+        assert reader.find(11) is None
+        frame = reader.read(0)
+        assert frame.frame == 10
+        np.testing.assert_array_equal(frame.image, make_image(1))
+        np.testing.assert_array_equal(frame.transform, transform)
+        assert frame.transform_frame == 9
+        assert frame.error == 0.5
+        assert frame.fiducials[0].label == 7
+        assert frame.fiducials[0].corners == [[0, 0], [1, 0], [1, 1], [0, 1]]
+        frame = reader.read(reader.find(15))
+        np.testing.assert_array_equal(frame.image, make_image(3))
+        assert frame.transform is None
+        assert frame.error is None
+        assert frame.fiducials == []
+        # Raw frames are views of the file
+        assert not frame.image.flags.writeable
+
+def test_jpeg_session(tmp_path):
+    path = str(tmp_path / 'jpeg.session')
+    image = cv2.imread('tests/data/tags1.jpg')
+    h, w = image.shape[:2]
+    _, jpeg = cv2.imencode('.jpg', image)
+    writer = SessionWriter(path, w, h, 100, data_size=len(jpeg) * 2 + 10)
+    for i in range(3):
+        writer.append(i + 1, time.time(), jpeg=jpeg.tobytes())
+    writer.close()
+    # Unused preallocated data space is released
+    assert os.path.getsize(path) < 100 * w * h
+
+    with SessionReader(path) as reader:
+        assert len(reader) == 2
+        assert reader.read(1).image.shape == image.shape
+
+    source = SessionSource(w, h, path, fps=None)
+    out = np.empty_like(image)
+    with source:
+        for _ in range(3):
+            assert source.read(out)
+
+def test_not_a_session(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'\0' * 8192)
+    with pytest.raises(ValueError):
+        SessionReader(str(path))
+
+def test_video_recording(tmp_path):
+    path = str(tmp_path / 'video.session')
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(reference, [[1, 2], [3, 4]], source=source)
+    try:
+        recorder = video.start_recording(path, 1000)
+        deadline = time.monotonic() + 30
+        while video.transform_data()['transform'] is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        video.stop_recording()
+        assert video.recorder is None
+    finally:
+        video.stop()
+
+    with SessionReader(path) as reader:
+        assert len(reader) == recorder.recorded > 0
+        assert reader.metadata == {'flip': False}
+        frames = reader.records()['frame']
+        assert np.all(np.diff(frames) > 0)
+        frame = reader.read(len(reader) - 1)
+        assert frame.image.shape == (Video.HEIGHT, Video.WIDTH, 3)
+        assert frame.transform is not None
+        assert 0 < frame.transform_frame <= frame.frame
+        assert len(frame.fiducials) == 3
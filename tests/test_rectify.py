@@ -0,0 +1,35 @@
+import cv2
+import numpy as np
+from pdcam.rectify import BoardRectifier
+
+
+LAYOUT = [[1, 2, 3], [4, 5, 6]]
+TRANSFORM = np.array([[40.0, 2.0, 100.0], [-1.5, 41.0, 80.0], [1e-5, -2e-5, 1.0]])
+
+def test_rectify_matches_warp():
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (300, 400, 3), dtype=np.uint8), (9, 9), 3)
+    rectifier = BoardRectifier(LAYOUT, pixels_per_electrode=20)
+    assert rectifier.size == (80, 60)
+
+    out = rectifier.rectify(image, TRANSFORM)
+    H = np.dot(TRANSFORM, rectifier.output_to_grid)
+    expected = cv2.warpPerspective(image, H, rectifier.size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    assert np.max(np.abs(out.astype(int) - expected)) <= 1
+
+def test_maps_rebuilt_only_on_change():
+    rectifier = BoardRectifier(LAYOUT)
+    rectifier.maps(TRANSFORM)
+    nudge = np.array([[1, 0, 0.01], [0, 1, 0], [0, 0, 1]])
+    rectifier.maps(np.dot(nudge, TRANSFORM))
+    assert rectifier.rebuild_count == 1
+
+    move = np.array([[1, 0, 2.0], [0, 1, 0], [0, 0, 1]])
+    rectifier.maps(np.dot(move, TRANSFORM))
+    assert rectifier.rebuild_count == 2
+
+def test_blank_without_transform():
+    rectifier = BoardRectifier(LAYOUT, pixels_per_electrode=10)
+    out = rectifier.rectify(np.full((100, 100, 3), 255, dtype=np.uint8), None)
+    assert out.shape == (30, 40, 3)
+    assert not out.any()
@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+from pdcam.smoothing import HomographyFilter, MotionDetector
+
+
+GRID_CORNERS = [(0, 0), (14, 0), (14, 8), (0, 8)]
+
+def grid_transform(dx=0.0):
+    return np.array([[36.0, 0.0, 260.0 + dx], [0.0, 36.0, 200.0], [0.0, 0.0, 1.0]])
+
+def project(H):
+    return cv2.perspectiveTransform(np.array([GRID_CORNERS], dtype=np.float64), H)[0]
+
+def test_filter_reduces_jitter():
+    rng = np.random.default_rng(0)
+    f = HomographyFilter(GRID_CORNERS, measurement_noise=1.0)
+    truth = project(grid_transform())
+    raw_error = []
+    smooth_error = []
+    for i in range(60):
+        noisy = grid_transform()
+        noisy[0:2, 2] += rng.normal(0, 1.0, 2)
+        smoothed = f.update(noisy, i / 30.0)
+        if i >= 30:
+            raw_error.append(np.abs(project(noisy) - truth).max())
+            smooth_error.append(np.abs(project(smoothed) - truth).max())
+    assert np.mean(smooth_error) < 0.6 * np.mean(raw_error)
+
+def test_filter_predicts_through_dropouts():
+    f = HomographyFilter(GRID_CORNERS, max_predict=0.5)
+    # Board moving at 30 px/s
+    for i in range(30):
+        f.update(grid_transform(i), i / 30.0)
+    predicted = f.predict(1.1)
+    assert abs(project(predicted)[0, 0] - project(grid_transform(33))[0, 0]) < 1.0
+    assert f.predict(1.6) is None
+
+def test_motion_detector():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (768, 1024, 3), dtype=np.uint8)
+    detector = MotionDetector()
+    assert detector.moved(image)
+    detector.set_reference()
+    noisy = np.clip(image + rng.normal(0, 3, image.shape), 0, 255).astype(np.uint8)
+    assert not detector.moved(noisy)
+    assert detector.moved(np.roll(image, 8, axis=1))
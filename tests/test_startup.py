@@ -0,0 +1,39 @@
+"""Import time of the CLI and servers
+
+Each import runs in a fresh interpreter, so nothing is cached from the test
+process. Run with `pytest tests/test_startup.py --benchmark-only`, or as part
+of `pdcam perfcheck`.
+"""
+import pytest
+import subprocess
+import sys
+
+ENTRY_MODULES = ['pdcam.scripts.main', 'pdcam.server', 'pdcam.asgi']
+# Only needed by the interactive plotting commands, or for matching
+# fiducials of unlabelled references
+HEAVY_MODULES = ['matplotlib', 'scipy', 'pyzbar']
+
+
+def import_times(module):
+    """Run `python -X importtime` on a module, and return the cumulative
+    import time of each module it loads, in microseconds"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        check=True, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+@pytest.mark.parametrize('module', ENTRY_MODULES)
+def test_no_heavy_imports(module):
+    loaded = set(name.split('.')[0] for name in import_times(module))
+    assert loaded.isdisjoint(HEAVY_MODULES)
+
+@pytest.mark.parametrize('module', ENTRY_MODULES)
+def test_benchmark_startup(benchmark, module):
+    times = benchmark.pedantic(import_times, args=(module,), rounds=3, iterations=1)
+    benchmark.extra_info['import_us'] = times[module]
@@ -0,0 +1,295 @@
+import cv2
+import json
+import numpy as np
+import pytest
+import threading
+import time
+from pdcam import metrics
+from pdcam.frames import FrameRing
+from pdcam.grid import GridReference
+from pdcam.pool import ProcessGridLocate
+from pdcam.sources import SyntheticSource
+from pdcam.video import AsyncGridLocate, StreamClient, StreamVariant, Video
+
+
+@pytest.fixture
+def video():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(reference, [[1, 2], [3, 4]], source=source)
+    yield video
+    video.stop()
+
+def test_latest_jpeg(video):
+    jpeg, frame_num = video.latest_jpeg(min_frame_num=2)
+    assert frame_num >= 2
+    image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image.shape == (Video.HEIGHT, Video.WIDTH, 3)
+
+    # A second request for the same frame is served from the encode cache
+    jpeg2, frame_num2 = video.latest_jpeg(min_frame_num=frame_num)
+    assert frame_num2 > frame_num or jpeg2 is jpeg
+
+def test_stream_variants(video):
+    def decode(jpeg):
+        return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    jpeg, _ = video.latest_jpeg(min_frame_num=2, scale=0.5)
+    assert decode(jpeg).shape == (Video.HEIGHT // 2, Video.WIDTH // 2, 3)
+
+    # Wait for the grid to be located, then crop to it
+    deadline = time.monotonic() + 10
+    while video.crop_region() is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    x, y, w, h = video.crop_region()
+    assert w < Video.WIDTH and h < Video.HEIGHT
+    jpeg, _ = video.latest_jpeg(markup=True, crop='grid', quality=70)
+    image = decode(jpeg)
+    assert image.shape[0] < Video.HEIGHT and image.shape[1] < Video.WIDTH
+
+    jpeg, _ = video.latest_jpeg(view='board')
+    w, h = video.rectifier.size
+    assert decode(jpeg).shape == (h, w, 3)
+
+    with pytest.raises(ValueError):
+        video.latest_jpeg(crop='bogus')
+
+def test_electrode_stats(video):
+    deadline = time.monotonic() + 10
+    ids, stats, frame_num = video.electrode_stats(2)
+    while stats is None and time.monotonic() < deadline:
+        ids, stats, frame_num = video.electrode_stats(frame_num + 1)
+    assert ids == [1, 2, 3, 4]
+    assert len(stats['intensity']) == 4
+    assert np.all(stats['pixels'] > 0)
+
+    # Rows are labelled by the layout they were sampled with
+    video.set_layout([[5, 6, 7]])
+    ids, stats, _ = video.electrode_stats(frame_num + 1)
+    assert ids == [5, 6, 7]
+    assert stats is None or len(stats['intensity']) == 3
+
+def test_transform_events(video):
+    version, data = video.wait_transform(0, timeout=10)
+    assert version >= 1
+    assert data['transform'] is not None
+    assert data['frame'] >= 1
+    assert abs(data['timestamp'] - time.time()) < 10
+
+    # Updates are only published when the transform changes
+    events = video.transform_events(version, keepalive=0.1)
+    event = next(events)
+    assert event.startswith(b'id: ') or event == b': keepalive\n\n'
+    events.close()
+
+def test_resume_version(video):
+    version, _ = video.wait_transform(0, timeout=10)
+    assert video.resume_version(str(version)) == version
+    assert video.resume_version(b'%d' % version) == version
+    # Ids from before a restart, and malformed ids, resume from the start
+    assert video.resume_version(str(version + 1000)) == 0
+    for bad in (None, '', 'abc', b'\xff', '-3'):
+        assert video.resume_version(bad) == 0
+
+    events = video.transform_events('bogus', keepalive=0.1)
+    assert next(events).startswith(b'id: ')
+    events.close()
+
+def test_mjpeg_stream(video):
+    generator = video.mjpeg_frame_generator()
+    assert next(generator).startswith(b'--frame')
+    assert next(generator).startswith(b'\xff\xd8')
+    assert len(video.stream_stats()) == 1
+    generator.close()
+    assert len(video.stream_stats()) == 0
+
+def test_stream_client_drops_oldest():
+    client = StreamClient("", StreamVariant.create(), max_queue=2)
+    for n in range(1, 6):
+        client.put(n, b'%d' % n)
+    assert client.dropped == 3
+    assert client.get() == (4, b'4')
+    assert client.get() == (5, b'5')
+    client.close()
+    assert client.get() is None
+
+def test_broadcaster_clients(video):
+    # A variant no other test uses, so its encode count is this test's alone
+    variant = StreamVariant.create(quality=42)
+    encodes = metrics.REGISTRY.counter(
+        'pdcam_jpeg_encodes_total', "JPEG encodes, by variant", **variant._asdict())
+    before = encodes.value
+    slow = StreamClient('slow', variant, max_queue=2)
+    fast = StreamClient('fast', variant, max_queue=2)
+    broadcaster = video.subscribe(variant, slow)
+    assert video.subscribe(variant, fast) is broadcaster
+    received = []
+    while len(received) < 10:
+        frame_num, jpeg = fast.get()
+        received.append(frame_num)
+    video.unsubscribe(broadcaster, fast)
+    video.unsubscribe(broadcaster, slow)
+
+    # The fast client got every frame sent to it, in order
+    assert fast.dropped == 0
+    assert received == sorted(set(received))
+    # The slow client never read, so it holds the newest frames, and the
+    # older ones were dropped
+    offered = slow.dropped + len(slow.queue)
+    assert len(slow.queue) == 2
+    assert slow.dropped >= 8
+    assert slow.queue[-1][0] >= received[-1]
+    # Each frame was encoded once for both clients; the broadcaster may have
+    # encoded one more before noticing they had gone
+    assert offered <= encodes.value - before <= offered + 1
+
+def test_variant_caches_are_bounded(video):
+    scales = [0.1 + 0.05 * i for i in range(Video.MAX_CACHED_VARIANTS + 4)]
+    generator = video.mjpeg_frame_generator(scale=0.5)
+    next(generator)
+    streamed = StreamVariant.create(quality=Video.MJPEG_QUALITY, scale=0.5)
+
+    for scale in scales:
+        video.latest_jpeg(min_frame_num=2, scale=scale)
+    assert len(video.variant_caches) == Video.MAX_CACHED_VARIANTS
+    # The least recently used are dropped, but not the streamed variant
+    assert streamed in video.variant_caches
+    assert StreamVariant.create(scale=scales[-1]) in video.variant_caches
+    assert StreamVariant.create(scale=scales[0]) not in video.variant_caches
+
+    # When the last client of a stream leaves, its broadcaster goes too
+    generator.close()
+    assert video.broadcasters == {}
+    assert len(video.variant_caches) <= Video.MAX_CACHED_VARIANTS
+
+def test_mjpeg_stream_ends_on_stop():
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(None, [[1, 2], [3, 4]], source=source)
+    generator = video.mjpeg_frame_generator()
+    assert next(generator).startswith(b'--frame')
+    remaining = []
+    reader = threading.Thread(target=lambda: remaining.extend(generator))
+    reader.start()
+    video.stop()
+    reader.join(timeout=10)
+    assert not reader.is_alive()
+
+def test_metrics(video):
+    video.latest_jpeg(min_frame_num=2)
+    text = video.render_metrics()
+    assert 'pdcam_stage_seconds_count{stage="encode"}' in text
+    assert 'pdcam_stage_seconds_count{stage="capture"}' in text
+    assert 'pdcam_stream_clients 0' in text
+
+def test_locate_worker_pool():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(reference, [[1, 2], [3, 4]], source=source, locate_workers=2)
+    try:
+        # Allow time for the workers to start up
+        deadline = time.monotonic() + 30
+        while video.grid_finder.latest()[0] is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        transform, fiducials = video.latest_transform()
+        assert transform is not None
+        assert len(fiducials) == 3
+    finally:
+        video.stop()
+
+def test_locate_backs_off_without_board():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    locate = AsyncGridLocate(reference, motion_threshold=Video.MOTION_THRESHOLD)
+    try:
+        blank = np.zeros((Video.HEIGHT, Video.WIDTH, 3), dtype=np.uint8)
+        # One second of frames at 100 fps, with no board in view
+        for i in range(100):
+            transform, _, _ = locate.process(blank, i * 0.01)
+            assert transform is None
+        # Retries at 0, 0.05, 0.15, 0.35 and 0.75s
+        assert locate.detect_count == 5
+        assert locate.skip_count == 95
+
+        # Once retried, a board is found, and detection runs for every moved frame
+        image = cv2.imread('tests/data/tags1.jpg')
+        for t in (2.0, 2.01):
+            transform, _, _ = locate.process(image, t)
+        assert transform is not None
+        assert locate.retry_delay == 0.0
+    finally:
+        locate.stop()
+
+def test_locate_still_frames_are_not_measured():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    locate = AsyncGridLocate(reference, smooth=True, motion_threshold=Video.MOTION_THRESHOLD)
+    try:
+        image = cv2.imread('tests/data/tags1.jpg')
+        first, _, _ = locate.process(image, 0.0)
+        covariance = locate.filter.P.copy()
+        # Still frames reuse the filtered transform, without updating the filter
+        for i in range(1, 50):
+            transform, _, _ = locate.process(image, i * 0.03)
+            assert np.array_equal(transform, first)
+        assert locate.detect_count == 1
+        assert locate.filter.last_update == 0.0
+        assert np.array_equal(locate.filter.P, covariance)
+    finally:
+        locate.stop()
+
+def test_locate_pool_backs_off_without_board():
+    with open('tests/data/tags_ref.json') as f:
+        reference = GridReference.from_dict(json.loads(f.read()))
+    image = cv2.imread('tests/data/tags1.jpg')
+    locate = ProcessGridLocate(reference, workers=1, shape=image.shape, smooth=True, retry_period=10.0)
+    try:
+        def wait_for_result(frame_number):
+            deadline = time.monotonic() + 30
+            while locate.latest_completed < frame_number and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert locate.latest_completed == frame_number
+
+        locate.push(image, 1, time.monotonic())
+        wait_for_result(1)
+        assert locate.latest()[0] is not None
+
+        # With the board out of view, the filter still predicts a transform,
+        # but detection backs off
+        blank = np.zeros_like(image)
+        locate.push(blank, 2, time.monotonic())
+        wait_for_result(2)
+        assert locate.latest()[0] is not None
+        for i in range(3, 13):
+            locate.push(blank, i, time.monotonic())
+        assert locate.skip_count == 10
+        assert locate.detect_count == 2
+    finally:
+        locate.stop()
+
+def test_no_locator_without_reference():
+    source = SyntheticSource(Video.WIDTH, Video.HEIGHT, ['tests/data/tags1.jpg'], fps=30)
+    video = Video(GridReference([], []), [[1, 2], [3, 4]], source=source)
+    try:
+        assert video.grid_finder is None
+        assert video.latest_transform() == (None, [])
+        assert video.transform_data()['transform'] is None
+    finally:
+        video.stop()
+
+def test_frame_ring_writer_never_waits_for_readers():
+    ring = FrameRing((4, 4, 3), nslots=2, max_slots=4)
+    borrowed = []
+    for n in range(1, 4):
+        slot = ring.acquire_write()
+        slot.image[:] = n
+        ring.publish(slot, n, None)
+        borrowed.append(ring.borrow_latest())
+
+    # Every borrowed frame is intact, so the ring grew instead of reusing them
+    assert len(ring.slots) == 3
+    assert [int(f.image[0, 0, 0]) for f in borrowed] == [1, 2, 3]
+    for f in borrowed:
+        f.release()
+    assert all(s.refcount == 0 for s in ring.slots)